@@ -0,0 +1,196 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+import psutil
+from config import Config
+from metrics import metrics
+
+MB = 1024 * 1024
+
+# Frames each encoder keeps in flight (lookahead, reference and threading buffers)
+CODEC_FRAME_BUFFERS = {
+    'libx264': 60,
+    'libx265': 120,
+    'libvpx-vp9': 50,
+    'libaom-av1': 150,
+    'libsvtav1': 100,
+    'mpeg4': 10
+}
+
+
+class AdmissionTimeout(Exception):
+    """Raised when a job's footprint did not fit within ADMISSION_MAX_WAIT"""
+
+
+class AdmissionController:
+    """Starts work only when its estimated footprint fits free resources"""
+    
+    def __init__(self):
+        self.active = 0
+        self.paused_reason = None
+        self.reserved = {'memory': 0, 'disk': 0}
+    
+    def sample(self):
+        """Sample CPU, memory, disk and IO pressure"""
+        memory = psutil.virtual_memory()
+        cores = psutil.cpu_count() or 1
+        
+        try:
+            load_per_core = os.getloadavg()[0] / cores
+        except (AttributeError, OSError):
+            load_per_core = psutil.cpu_percent(interval=None) / 100
+        
+        return {
+            'load_per_core': load_per_core,
+            'memory_available': memory.available,
+            'disk_free': psutil.disk_usage(Config.ENCODE_DIR).free,
+            'io_pressure': self._read_pressure('io'),
+            'memory_pressure': self._read_pressure('memory')
+        }
+    
+    def _read_pressure(self, resource):
+        """Read PSI 'some avg10' percentage (None if unsupported)"""
+        try:
+            with open(f"/proc/pressure/{resource}") as f:
+                for line in f:
+                    if line.startswith('some'):
+                        return float(line.split()[1].split('=')[1])
+        except (OSError, IndexError, ValueError):
+            pass
+        return None
+    
+    def estimate_encode_footprint(self, probe, quality, codec):
+        """Estimate memory and disk needed to encode a probed file"""
+        video = next((s for s in probe.get('streams', []) if s.get('codec_type') == 'video'), {})
+        src_pixels = (video.get('width') or 1920) * (video.get('height') or 1080)
+        
+        preset = Config.QUALITY_PRESETS.get(quality, Config.QUALITY_PRESETS['480p'])
+        width, height = map(int, preset['resolution'].split('x'))
+        
+        # YUV 4:2:0 frames for decoder output plus encoder buffers
+        frame_bytes = (src_pixels + width * height) * 1.5
+        memory = 150 * MB + frame_bytes * CODEC_FRAME_BUFFERS.get(codec, 60)
+        
+        # Output size with headroom for content above the nominal bitrate
+        duration = float(probe.get('format', {}).get('duration') or 0)
+        bitrate = int(preset['video_bitrate'].rstrip('k')) + 192
+        disk = duration * bitrate * 1000 / 8 * 1.5
+        
+        return {'memory': int(memory), 'disk': int(disk)}
+    
+    def estimate_download_footprint(self, file_size):
+        """Estimate resources needed to download a file"""
+        return {'memory': 0, 'disk': int(file_size)}
+    
+    def _blocked_by(self, footprint, sample):
+        """Get the reason a footprint does not fit now (None if it fits)"""
+        if sample['disk_free'] - self.reserved['disk'] - footprint['disk'] < Config.ADMISSION_MIN_FREE_DISK_MB * MB:
+            return 'disk'
+        
+        # An idle box always takes one job, however large, to avoid starvation
+        if self.active == 0:
+            return None
+        
+        if sample['memory_available'] - self.reserved['memory'] - footprint['memory'] < Config.ADMISSION_MIN_FREE_MEMORY_MB * MB:
+            return 'memory'
+        if sample['memory_pressure'] is not None and sample['memory_pressure'] > Config.ADMISSION_MAX_PRESSURE:
+            return 'memory pressure'
+        if sample['io_pressure'] is not None and sample['io_pressure'] > Config.ADMISSION_MAX_PRESSURE:
+            return 'io pressure'
+        if sample['load_per_core'] > Config.ADMISSION_MAX_LOAD:
+            return 'cpu'
+        return None
+    
+    @asynccontextmanager
+    async def admit(self, footprint):
+        """Wait until footprint fits, reserve it for the duration of the block"""
+        deadline = time.monotonic() + Config.ADMISSION_MAX_WAIT
+        waited = False
+        
+        try:
+            while True:
+                reason = self._blocked_by(footprint, self.sample())
+                if reason is None:
+                    break
+                
+                if not waited:
+                    metrics.inc('admission_waits')
+                    waited = True
+                self._set_paused(reason)
+                
+                if time.monotonic() > deadline:
+                    metrics.inc('admission_timeouts')
+                    raise AdmissionTimeout(f"Not enough {reason} to start the job, try again later")
+                await asyncio.sleep(Config.ADMISSION_POLL_INTERVAL)
+        finally:
+            self._set_paused(None)
+        
+        self._reserve(footprint, 1)
+        try:
+            yield
+        finally:
+            self._reserve(footprint, -1)
+    
+    def _reserve(self, footprint, sign):
+        """Add or remove a footprint reservation"""
+        self.active += sign
+        for key in self.reserved:
+            self.reserved[key] += sign * footprint[key]
+        metrics.set_gauge('admission_active', self.active)
+        metrics.set_gauge('admission_reserved_memory_mb', self.reserved['memory'] // MB)
+        metrics.set_gauge('admission_reserved_disk_mb', self.reserved['disk'] // MB)
+    
+    def _set_paused(self, reason):
+        """Record why admissions are paused"""
+        self.paused_reason = reason
+        metrics.set_gauge('admission_paused', 0 if reason is None else 1)
+    
+    def snapshot(self):
+        """Get admission state for admins"""
+        return {
+            'active': self.active,
+            'paused_reason': self.paused_reason,
+            'reserved': dict(self.reserved)
+        }
+
+
+class CorePartitioner:
+    """Gives each concurrent encode its own share of the CPU cores"""
+    
+    def __init__(self):
+        try:
+            self.cores = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            self.cores = list(range(psutil.cpu_count() or 1))
+        self._usage = {core: 0 for core in self.cores}
+    
+    def budget(self, workers):
+        """Get cores per job when `workers` encodes run at once"""
+        if Config.ENCODE_CORES_PER_JOB:
+            return min(Config.ENCODE_CORES_PER_JOB, len(self.cores))
+        return max(1, len(self.cores) // max(1, workers))
+    
+    @contextmanager
+    def reserve(self, workers):
+        """Reserve the least used cores for one encode; yields core IDs"""
+        # Ties go to the lowest IDs, so free cores are handed out in blocks
+        count = self.budget(workers)
+        cores = sorted(sorted(self.cores, key=lambda core: self._usage[core])[:count])
+        self._update(cores, 1)
+        try:
+            yield cores
+        finally:
+            self._update(cores, -1)
+    
+    def _update(self, cores, delta):
+        """Adjust usage counts of reserved cores"""
+        for core in cores:
+            self._usage[core] += delta
+        metrics.set_gauge('cores_reserved', sum(1 for used in self._usage.values() if used))
+        metrics.set_gauge('cores_oversubscribed', sum(1 for used in self._usage.values() if used > 1))
+
+
+# Shared instances
+admission = AdmissionController()
+cpu_cores = CorePartitioner()
@@ -1,17 +1,28 @@
 import os
 import asyncio
 import time
-from pyrogram import Client, filters, enums
+from contextlib import AsyncExitStack
+from pyrogram import Client, filters, enums, idle
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 from config import Config
-from database import Database
+from database import Database, get_async_database
 from encoder import VideoEncoder
+from progress import ProgressChannel
+from scheduler import scheduler, estimate_cost
+from pipeline import pools
+from profiles import CRF_RATE_CONTROL_MODES
+from admission import admission, cpu_cores
+from metrics import metrics
+from shortener import shortener
+from tasks import Task, TaskCancelled, TaskLimitReached, new_task_id, registry
 from utils import (
     format_progress_bar, 
     format_time, 
     format_size,
     check_user_subscription,
-    generate_shortlink
+    membership,
+    generate_shortlink,
+    is_admin
 )
 
 # Initialize bot
@@ -24,11 +35,22 @@ app = Client(
 
 # Initialize database and encoder
 db = Database()
+# Handlers await queries on the database thread instead of blocking the loop
+adb = get_async_database(db)
 encoder = VideoEncoder()
 
-# Active tasks dictionary
-active_tasks = {}
-user_settings = {}
+
+
+# Job IDs received per user while their batch window is open
+collecting_batches = {}
+
+# Fire-and-forget tasks, referenced until done so they are not collected
+background_tasks = set()
+
+
+def get_task_limit(is_premium):
+    """Get max number of queued/running tasks per user"""
+    return Config.PREMIUM_MAX_TASKS if is_premium else Config.FREE_MAX_TASKS
 
 
 @app.on_message(filters.command("start") & filters.private)
@@ -38,10 +60,10 @@ async def start_command(client, message: Message):
     
     # Check force subscribe
     if not await check_user_subscription(client, user_id):
-        channels = db.get_force_subscribe_channels()
+        channels = await adb.get_force_subscribe_channels()
         buttons = []
         for channel in channels:
-            buttons.append([InlineKeyboardButton("Join Channel", url=channel['url'])])
+            buttons.append([InlineKeyboardButton("Join Channel", url=channel['channel_url'])])
         buttons.append([InlineKeyboardButton("✅ Joined", callback_data="check_join")])
         
         await message.reply_text(
@@ -52,10 +74,10 @@ async def start_command(client, message: Message):
         return
     
     # Add user to database
-    db.add_user(user_id, message.from_user.first_name)
+    db.add_user(user_id, message.from_user.first_name, message.from_user.username)
     
     # Get start picture if set
-    start_pic = db.get_start_picture()
+    start_pic = await adb.get_start_picture()
     
     buttons = [
         [InlineKeyboardButton("📊 Help", callback_data="help"),
@@ -90,6 +112,26 @@ async def start_command(client, message: Message):
         )
 
 
+@app.on_callback_query(filters.regex(r"^check_join$"))
+async def handle_check_join_callback(client, callback_query):
+    """Re-check force subscribe after the user says they joined"""
+    user_id = callback_query.from_user.id
+    
+    # Drop cached "not a member" answers so the check asks Telegram again
+    membership.invalidate(user_id)
+    if not await check_user_subscription(client, user_id):
+        await callback_query.answer("❌ You haven't joined all channels yet!", show_alert=True)
+        return
+    
+    db.add_user(user_id, callback_query.from_user.first_name, callback_query.from_user.username)
+    await callback_query.answer("✅ Thanks for joining!", show_alert=False)
+    await callback_query.message.edit_text(
+        "✅ **Thanks for joining!**\n\n"
+        "**Send me a video to get started!**\n"
+        "Use /help to see all commands."
+    )
+
+
 @app.on_message(filters.command("help") & filters.private)
 async def help_command(client, message: Message):
     """Show help message with all commands"""
@@ -156,20 +198,13 @@ async def help_command(client, message: Message):
 async def handle_media(client, message: Message):
     """Handle incoming video/document files"""
     user_id = message.from_user.id
+    db.touch_user(user_id)
     
     # Check subscription
     if not await check_user_subscription(client, user_id):
         await message.reply_text("⚠️ Please join our channels first! Use /start")
         return
     
-    # Check if user has active task
-    if user_id in active_tasks and active_tasks[user_id].get('status') == 'processing':
-        await message.reply_text(
-            "⚠️ **You already have an active task!**\n\n"
-            "Please wait for it to complete or use /stop to cancel it."
-        )
-        return
-    
     # Get file info
     media = message.video or message.document
     file_name = media.file_name
@@ -177,7 +212,7 @@ async def handle_media(client, message: Message):
     duration = getattr(media, 'duration', 0)
     
     # Check file size limits
-    is_premium = db.is_premium_user(user_id)
+    is_premium = await adb.is_premium_user(user_id)
     max_size = Config.PREMIUM_MAX_SIZE if is_premium else Config.FREE_MAX_SIZE
     
     if file_size > max_size:
@@ -189,227 +224,590 @@ async def handle_media(client, message: Message):
         )
         return
     
-    # Show quality selection buttons
-    buttons = [
-        [
-            InlineKeyboardButton("144p", callback_data=f"encode_144p"),
-            InlineKeyboardButton("240p", callback_data=f"encode_240p"),
-            InlineKeyboardButton("360p", callback_data=f"encode_360p")
-        ],
-        [
-            InlineKeyboardButton("480p", callback_data=f"encode_480p"),
-            InlineKeyboardButton("720p", callback_data=f"encode_720p"),
-            InlineKeyboardButton("1080p", callback_data=f"encode_1080p")
-        ],
-        [
-            InlineKeyboardButton("2160p (4K)", callback_data=f"encode_2160p"),
-            InlineKeyboardButton("🗜 Compress", callback_data=f"compress")
-        ]
-    ]
+    # Check per-tier task limit
+    task_limit = get_task_limit(is_premium)
+    if registry.count(user_id) >= task_limit:
+        await message.reply_text(
+            "⚠️ **Task limit reached!**\n\n"
+            f"You have {registry.count(user_id)} queued/active tasks (max {task_limit}).\n"
+            "Use /tasks to view them or wait for one to complete."
+        )
+        return
+    
+    job_id = new_task_id()
+    
+    # Show quality selection buttons (bound to this file's job)
+    buttons = quality_buttons("encode", job_id)
+    buttons[-1].append(InlineKeyboardButton("🗜 Compress", callback_data=f"compress"))
     
     if is_premium:
         buttons.append([InlineKeyboardButton("🎯 All Qualities", callback_data="encode_all")])
     
     buttons.append([InlineKeyboardButton("ℹ️ Media Info", callback_data="show_mediainfo")])
     
-    # Store file message for later use
-    user_settings[user_id] = {
-        'file_message': message,
-        'file_name': file_name,
-        'file_size': file_size,
-        'duration': duration
-    }
+    # Persist the pending job so the selection survives restarts
+    await adb.create_job(
+        job_id,
+        user_id,
+        message.chat.id,
+        message.id,
+        media.file_id,
+        file_unique_id=media.file_unique_id,
+        file_name=file_name,
+        file_size=file_size,
+        duration=duration
+    )
+    
+    # Files sent together (albums, multi-file forwards) are asked for once
+    spawn(collect_batch(
+        message,
+        job_id,
+        lambda: message.reply_text(
+            f"📥 **File Received!**\n\n"
+            f"📝 Name: `{file_name}`\n"
+            f"📦 Size: {format_size(file_size)}\n"
+            f"⏱ Duration: {format_time(duration)}\n\n"
+            f"**Select encoding quality:**",
+            reply_markup=InlineKeyboardMarkup(buttons)
+        )
+    ))
+
+
+def spawn(coro):
+    """Run coro in the background, keeping it referenced and logging a failure"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task):
+    """Drop a finished background task; report it if it failed"""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
+
+def quality_buttons(prefix, target_id):
+    """Quality selection rows whose callbacks carry the job or batch ID"""
+    def button(label, quality):
+        return InlineKeyboardButton(label, callback_data=f"{prefix}_{quality}:{target_id}")
+    
+    return [
+        [button("144p", "144p"), button("240p", "240p"), button("360p", "360p")],
+        [button("480p", "480p"), button("720p", "720p"), button("1080p", "1080p")],
+        [button("2160p (4K)", "2160p")]
+    ]
+
+
+async def collect_batch(message, job_id, single_prompt):
+    """Group files arriving within BATCH_WINDOW and ask for settings once"""
+    user_id = message.from_user.id
+    batch = collecting_batches.setdefault(user_id, [])
+    batch.append(job_id)
+    
+    # Every new file (e.g. the rest of an album) extends the window
+    await asyncio.sleep(Config.BATCH_WINDOW)
+    if batch[-1] != job_id:
+        return
+    if collecting_batches.get(user_id) is batch:
+        del collecting_batches[user_id]
+    
+    if len(batch) == 1:
+        await single_prompt()
+        return
+    
+    batch_id = new_task_id()
+    await adb.set_job_batch(batch, batch_id)
+    jobs = await adb.get_batch_jobs(batch_id)
+    
+    text = f"📦 **Batch Received!**\n\n"
+    for job in jobs:
+        text += f"├ `{job['file_name']}` ({format_size(job['file_size'])})\n"
+    text += f"\n📁 Files: {len(jobs)}\n"
+    text += f"📦 Total Size: {format_size(sum(job['file_size'] for job in jobs))}\n\n"
+    text += f"**Select encoding quality for all files:**"
     
     await message.reply_text(
-        f"📥 **File Received!**\n\n"
-        f"📝 Name: `{file_name}`\n"
-        f"📦 Size: {format_size(file_size)}\n"
-        f"⏱ Duration: {format_time(duration)}\n\n"
-        f"**Select encoding quality:**",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        text,
+        reply_markup=InlineKeyboardMarkup(quality_buttons("batch", batch_id))
     )
 
 
+@app.on_callback_query(filters.regex(r"^batch_"))
+async def handle_batch_callback(client, callback_query):
+    """Handle quality selection for a whole batch"""
+    user_id = callback_query.from_user.id
+    quality, _, batch_id = callback_query.data.replace("batch_", "").partition(":")
+    
+    jobs = [
+        job for job in await adb.get_batch_jobs(batch_id)
+        if job['user_id'] == user_id and job['state'] == 'pending'
+    ]
+    if not jobs:
+        await callback_query.answer("❌ Batch expired! Send the files again.", show_alert=True)
+        return
+    
+    await callback_query.answer("🔄 Queueing batch...", show_alert=False)
+    
+    limit = get_task_limit(await adb.is_premium_user(user_id))
+    queued = 0
+    skipped = []
+    
+    for job in jobs:
+        if registry.count(user_id) >= limit:
+            skipped.append(job)
+            continue
+        
+        status_message = await client.send_message(
+            job['chat_id'],
+            f"⏳ **Queued**\n`{job['file_name']}`\n\n└ Quality: {quality}",
+            reply_to_message_id=job['message_id']
+        )
+        if not await adb.queue_job(job['job_id'], f"encode_{quality}", status_message.id):
+            # Another tap on the batch buttons queued it already
+            await status_message.delete()
+            continue
+        start_task(client, status_message, await adb.get_job(job['job_id']), callback_query.from_user)
+        queued += 1
+    
+    text = (
+        f"📦 **Batch Queued!**\n\n"
+        f"├ Files: {queued}\n"
+        f"└ Quality: {quality}"
+    )
+    if skipped:
+        # Their buttons go away with this edit, so the jobs are closed too
+        for job in skipped:
+            await adb.cancel_pending_job(job['job_id'], 'Task limit reached')
+        text += (
+            f"\n\n⚠️ {len(skipped)} file(s) skipped: task limit of {limit} reached.\n"
+            + "".join(f"├ `{job['file_name']}`\n" for job in skipped)
+            + "Send them again once some tasks are done."
+        )
+    
+    await callback_query.message.edit_text(text)
+
+
 @app.on_callback_query(filters.regex(r"^encode_"))
 async def handle_encode_callback(client, callback_query):
     """Handle encoding quality selection"""
     user_id = callback_query.from_user.id
-    quality = callback_query.data.replace("encode_", "")
+    quality, _, job_id = callback_query.data.replace("encode_", "").partition(":")
     
-    if user_id not in user_settings:
+    # Buttons carry their job ID; older buttons fall back to the latest file
+    job = await adb.get_job(job_id) if job_id else await adb.get_pending_job(user_id)
+    if not job or job['user_id'] != user_id or job['state'] != 'pending':
         await callback_query.answer("❌ File data expired! Send the file again.", show_alert=True)
         return
     
-    await callback_query.answer("🔄 Starting encoding...", show_alert=False)
+    if not await adb.queue_job(job['job_id'], f"encode_{quality}", callback_query.message.id):
+        # A second tap that lost the race to the first one
+        await callback_query.answer("⏳ Already queued!", show_alert=False)
+        return
+    job = await adb.get_job(job['job_id'])
     
-    file_data = user_settings[user_id]
-    file_message = file_data['file_message']
+    try:
+        start_task(client, callback_query.message, job, callback_query.from_user,
+                   get_task_limit(await adb.is_premium_user(user_id)))
+    except TaskLimitReached:
+        await adb.update_job_state(job['job_id'], 'pending')
+        await callback_query.answer("⚠️ Task limit reached! Wait for a task to finish.", show_alert=True)
+        return
     
-    # Start encoding task
-    asyncio.create_task(
-        encode_video(client, callback_query.message, file_message, user_id, quality)
+    await callback_query.answer("🔄 Starting encoding...", show_alert=False)
+
+
+def start_task(client, status_message, job, user, limit=None):
+    """Register a queued job as a task and start running it"""
+    task = registry.register(
+        Task(job['job_id'], job['user_id'], job['file_name'], job['operation'], job['batch_id']),
+        limit
     )
+    
+    # Cancelling the token kills FFmpeg and interrupts the current transfer
+    runner = asyncio.create_task(encode_video(client, status_message, job, user, task))
+    task.token.bind_task(runner)
+    return task
 
 
-async def encode_video(client, status_message, file_message, user_id, quality):
-    """Main encoding function with progress tracking"""
+def job_download_path(job):
+    """Get local path of a job's downloaded source file"""
+    return os.path.join(Config.DOWNLOAD_DIR, f"{job['job_id']}_{job['file_name']}")
+
+
+async def download_job(client, job, download_path, progress=None):
+    """Download a job's source file"""
+    return await client.download_media(
+        job['file_id'],
+        file_name=download_path,
+        progress=progress
+    )
+
+
+async def encode_video(client, status_message, job, user, task):
+    """
+    Main encoding function with progress tracking
+    
+    The fair-share scheduler admits the job into the pipeline; it then
+    passes through the download, encode and upload stage pools, waiting in
+    each pool's queue for a free worker. The pipeline slot is released
+    after encoding, so the next job can download while this one uploads.
+    """
+    user_id = job['user_id']
+    task_id = job['job_id']
+    quality = job['operation'].replace("encode_", "")
+    token = task.token
+    
+    progress = None
+    download_path = None
+    early_upload = None
+    scratch = []
+    pipeline_slot = AsyncExitStack()
+    
+    async def release():
+        """Free the slot and scratch files (safe to call more than once)"""
+        await pipeline_slot.aclose()
+        registry.remove(task_id)
+        
+        if early_upload and not early_upload.done():
+            early_upload.cancel()
+        
+        for path in (download_path, *scratch):
+            try:
+                if path and os.path.exists(path):
+                    os.remove(path)
+            except:
+                pass
+    
     try:
-        # Mark task as active
-        active_tasks[user_id] = {
-            'status': 'processing',
-            'start_time': time.time(),
-            'current_stage': 'downloading'
-        }
+        file_name = job['file_name']
+        download_path = job_download_path(job)
         
-        file_data = user_settings[user_id]
-        file_name = file_data['file_name']
+        # Settings are frozen for the whole job, even if an admin changes them
+        settings = await adb.settings_snapshot()
         
-        # Create unique task ID
-        task_id = f"{user_id}_{int(time.time())}"
+        # Wait for a fair-share slot; premium users weigh more, long and
+        # expensive encodes cost more
+        cost = estimate_cost(quality, settings.get_codec(), job['duration'], job['file_size'])
+        weight = Config.PREMIUM_WEIGHT if await adb.is_premium_user(user_id) else 1
         
-        # Download file with progress
-        download_path = os.path.join(Config.DOWNLOAD_DIR, f"{task_id}_{file_name}")
+        if scheduler.is_full():
+            await status_message.edit_text(
+                "⏳ **Queued**\n"
+                f"`{file_name}`\n\n"
+                f"├ Quality: {quality}\n"
+                f"├ Jobs ahead: {scheduler.waiting_count()}\n"
+                f"└ Task By: {user.mention}\n\n"
+                f"`/stop{task_id}` to cancel"
+            )
+        
+        await pipeline_slot.enter_async_context(scheduler.slot(task_id, user_id, cost, weight))
+        
+        task.set_stage('downloading')
+        await adb.update_job_state(task_id, 'downloading')
         
+        # Download file with progress
         progress_msg = await status_message.edit_text(
             "**1. Downloading**\n"
             f"`{file_name}`\n\n"
             f"{format_progress_bar(0)}\n"
             f"├ Speed: 0 MB/s\n"
-            f"├ Size: 0 MB / {format_size(file_data['file_size'])}\n"
+            f"├ Size: 0 MB / {format_size(job['file_size'])}\n"
             f"├ ETA: Calculating...\n"
             f"├ Elapsed: 00:00:00\n"
-            f"└ Task By: {file_message.from_user.mention}\n\n"
+            f"└ Task By: {user.mention}\n\n"
             f"`/stop{task_id}` to cancel"
         )
         
+        # Single consumer per job: callbacks only overwrite the latest value
+        progress = ProgressChannel(progress_msg.edit_text).start()
+        
         start_time = time.time()
         
-        async def download_progress(current, total):
-            """Progress callback for download"""
-            if active_tasks[user_id]['status'] == 'cancelled':
-                raise Exception("Task cancelled by user")
-            
+        def render_download(data):
+            """Render download progress message"""
+            if data is None:
+                return None
+            current, total = data
             elapsed = time.time() - start_time
             speed = current / elapsed if elapsed > 0 else 0
             eta = (total - current) / speed if speed > 0 else 0
-            percentage = (current / total) * 100
+            percentage = (current / total) * 100 if total else 0
             
-            # Update every 3 seconds to avoid flood
-            if int(elapsed) % 3 == 0:
-                try:
-                    await progress_msg.edit_text(
-                        "**1. Downloading**\n"
-                        f"`{file_name}`\n\n"
-                        f"{format_progress_bar(percentage)}\n"
-                        f"├ Speed: {format_size(speed)}/s\n"
-                        f"├ Size: {format_size(current)} / {format_size(total)}\n"
-                        f"├ ETA: {format_time(int(eta))}\n"
-                        f"├ Elapsed: {format_time(int(elapsed))}\n"
-                        f"└ Task By: {file_message.from_user.mention}\n\n"
-                        f"`/stop{task_id}` to cancel"
-                    )
-                except:
-                    pass
-        
-        # Download the file
-        await client.download_media(
-            file_message,
-            file_name=download_path,
-            progress=download_progress
-        )
+            return (
+                "**1. Downloading**\n"
+                f"`{file_name}`\n\n"
+                f"{format_progress_bar(percentage)}\n"
+                f"├ Speed: {format_size(speed)}/s\n"
+                f"├ Size: {format_size(current)} / {format_size(total)}\n"
+                f"├ ETA: {format_time(int(eta))}\n"
+                f"├ Elapsed: {format_time(int(elapsed))}\n"
+                f"└ Task By: {user.mention}\n\n"
+                f"`/stop{task_id}` to cancel"
+            )
         
-        # Update status to encoding
-        active_tasks[user_id]['current_stage'] = 'encoding'
+        async def download_progress(current, total):
+            """Progress callback for download"""
+            progress.publish((current, total))
         
-        await progress_msg.edit_text(
-            "**2. Encoding**\n"
-            f"`{file_name}`\n\n"
-            f"{format_progress_bar(0)}\n"
-            f"├ Quality: {quality}\n"
-            f"├ Codec: {db.get_codec()}\n"
-            f"├ Preset: {db.get_preset()}\n"
-            f"├ Status: Starting...\n"
-            f"└ Task By: {file_message.from_user.mention}\n\n"
-            f"`/stop{task_id}` to cancel"
-        )
+        progress.set_stage(render_download)
+        
+        # Download the file once the disk can take it
+        async with pools['download'].slot():
+            async with admission.admit(admission.estimate_download_footprint(job['file_size'])):
+                await download_job(client, job, download_path, download_progress)
         
-        # Encode video
+        codec = settings.get_codec()
+        ffmpeg_preset = settings.get_preset()
         encode_start = time.time()
-        output_path = await encoder.encode_video(
-            download_path,
-            quality,
-            progress_callback=lambda data: asyncio.create_task(
-                update_encode_progress(progress_msg, file_name, quality, data, encode_start, file_message.from_user, task_id)
+        
+        def render_encode(data):
+            """Render encoding progress message"""
+            if data is None:
+                return (
+                    "**2. Encoding**\n"
+                    f"`{file_name}`\n\n"
+                    f"{format_progress_bar(0)}\n"
+                    f"├ Quality: {quality}\n"
+                    f"├ Codec: {codec}\n"
+                    f"├ Preset: {ffmpeg_preset}\n"
+                    f"├ Status: Starting...\n"
+                    f"└ Task By: {user.mention}\n\n"
+                    f"`/stop{task_id}` to cancel"
+                )
+            return format_encode_progress(file_name, quality, data, encode_start, user, task_id)
+        
+        def render_analyze(data):
+            """Render crop detection and per-title CRF search message"""
+            return (
+                "**2. Analyzing**\n"
+                f"`{file_name}`\n\n"
+                f"├ Quality: {quality}\n"
+                f"├ Codec: {codec}\n"
+                f"├ Status: Checking samples for black bars and CRF...\n"
+                f"└ Task By: {user.mention}\n\n"
+                f"`/stop{task_id}` to cancel"
             )
-        )
         
-        # Update status to uploading
-        active_tasks[user_id]['current_stage'] = 'uploading'
+        # Get user settings for upload
+        upload_as_doc = await adb.get_user_setting(user_id, 'upload_as_document', False)
+        use_spoiler = await adb.get_user_setting(user_id, 'spoiler_mode', False)
         
-        await progress_msg.edit_text(
-            "**3. Uploading**\n"
-            f"`{file_name}`\n\n"
-            f"{format_progress_bar(0)}\n"
-            f"├ Quality: {quality}\n"
-            f"├ Status: Starting upload...\n"
-            f"└ Task By: {file_message.from_user.mention}"
-        )
+        caption = f"📹 **Encoded by Turbo Encoder Bot**\n\n"
+        caption += f"Quality: {quality}\n"
+        caption += f"Encoded by: {user.mention}"
         
-        # Upload encoded video
-        upload_start = time.time()
+        upload_start = None
+        uploads = {}
         
-        async def upload_progress(current, total):
-            """Progress callback for upload"""
+        def render_upload(data):
+            """Render upload progress message"""
+            if data is None:
+                return (
+                    "**3. Uploading**\n"
+                    f"`{file_name}`\n\n"
+                    f"{format_progress_bar(0)}\n"
+                    f"├ Quality: {quality}\n"
+                    f"├ Status: Starting upload...\n"
+                    f"└ Task By: {user.mention}"
+                )
+            current, total = data
             elapsed = time.time() - upload_start
             speed = current / elapsed if elapsed > 0 else 0
             eta = (total - current) / speed if speed > 0 else 0
-            percentage = (current / total) * 100
+            percentage = (current / total) * 100 if total else 0
+            
+            return (
+                "**3. Uploading**\n"
+                f"`{file_name}`\n\n"
+                f"{format_progress_bar(percentage)}\n"
+                f"├ Speed: {format_size(speed)}/s\n"
+                f"├ Size: {format_size(current)} / {format_size(total)}\n"
+                f"├ ETA: {format_time(int(eta))}\n"
+                f"├ Elapsed: {format_time(int(elapsed))}\n"
+                f"└ Task By: {user.mention}"
+            )
+        
+        async def upload_file(path, part=None, parts=None):
+            """Upload one output file (or numbered part) to the user"""
+            async def upload_progress(current, total):
+                """Progress callback for upload, summed over parallel parts"""
+                uploads[path] = (current, total)
+                if task.stage == 'uploading':
+                    progress.publish((
+                        sum(done for done, _ in uploads.values()),
+                        sum(size for _, size in uploads.values())
+                    ))
             
-            if int(elapsed) % 3 == 0:
-                try:
-                    await progress_msg.edit_text(
-                        "**3. Uploading**\n"
-                        f"`{file_name}`\n\n"
-                        f"{format_progress_bar(percentage)}\n"
-                        f"├ Speed: {format_size(speed)}/s\n"
-                        f"├ Size: {format_size(current)} / {format_size(total)}\n"
-                        f"├ ETA: {format_time(int(eta))}\n"
-                        f"├ Elapsed: {format_time(int(elapsed))}\n"
-                        f"└ Task By: {file_message.from_user.mention}"
+            part_caption = caption
+            if part:
+                part_caption += f"\nPart: {part}/{parts}" if parts else f"\nPart: {part}"
+            
+            async with pools['upload'].slot():
+                if upload_as_doc:
+                    await client.send_document(
+                        chat_id=user_id,
+                        document=path,
+                        caption=part_caption,
+                        progress=upload_progress
+                    )
+                else:
+                    await client.send_video(
+                        chat_id=user_id,
+                        video=path,
+                        caption=part_caption,
+                        has_spoiler=use_spoiler,
+                        progress=upload_progress
                     )
-                except:
-                    pass
         
-        # Get user settings for upload
-        upload_as_doc = db.get_user_setting(user_id, 'upload_as_document', False)
-        use_spoiler = db.get_user_setting(user_id, 'spoiler_mode', False)
+        # Wait for a free encoder while other jobs transfer
+        token.raise_if_cancelled()
+        task.stage = 'waiting for encoder'
         
-        caption = f"📹 **Encoded by Turbo Encoder Bot**\n\n"
-        caption += f"Quality: {quality}\n"
-        caption += f"Encoded by: {file_message.from_user.mention}"
-        
-        if upload_as_doc:
-            await client.send_document(
-                chat_id=user_id,
-                document=output_path,
-                caption=caption,
-                progress=upload_progress
-            )
+        try:
+            probe = await encoder.get_media_info(download_path)
+        except Exception:
+            probe = {}
+        footprint = admission.estimate_encode_footprint(probe, quality, codec)
+        
+        # Outputs above the user's limit go out in parts. With a bounded
+        # bitrate a long encode is written straight into parts, so part 1
+        # can upload while the rest is still encoding.
+        size_limit = Config.PREMIUM_MAX_SIZE if await adb.is_premium_user(user_id) else Config.FREE_MAX_SIZE
+        duration = float(probe.get('format', {}).get('duration') or job['duration'] or 0)
+        part_duration = encoder.part_duration(quality, size_limit, settings)
+        segment_time = part_duration if part_duration and duration > part_duration else None
+        encoded = asyncio.Event()
+        
+        async def upload_first_part():
+            """Upload part 1 early once the encode is projected to need splitting"""
+            pattern = encoder.output_path(download_path, quality, parts=True)
+            first, second = pattern % 0, pattern % 1
+            
+            # Part 1 is complete once FFmpeg has moved on to part 2
+            while not os.path.exists(second):
+                if encoded.is_set():
+                    return None
+                await asyncio.sleep(1)
+            
+            projected = os.path.getsize(first) * duration / segment_time
+            if projected <= size_limit:
+                return None
+            
+            metrics.inc('early_part_uploads')
+            await upload_file(first, 1)
+            return first
+        
+        async def stop_early_upload():
+            """Stop an unfinished part 1 upload before a stalled run's parts are removed"""
+            nonlocal early_upload
+            if early_upload and not early_upload.done():
+                early_upload.cancel()
+                await asyncio.gather(early_upload, return_exceptions=True)
+                uploads.pop(encoder.output_path(download_path, quality, parts=True) % 0, None)
+                early_upload = None
+        
+        # Start encoding only when the footprint fits the machine
+        async with pools['encode'].slot(), admission.admit(footprint):
+            # Update status to encoding
+            token.raise_if_cancelled()
+            task.set_stage('encoding')
+            await adb.update_job_state(task_id, 'encoding')
+            progress.set_stage(render_encode)
+            
+            # Encode video on this job's share of the cores
+            with cpu_cores.reserve(pools['encode'].size) as cores:
+                crop_mode = await adb.get_user_crop_mode(user_id)
+                # Bitrate-driven modes ignore the CRF, so searching it is wasted work
+                per_title = (settings.get_per_title_crf()
+                             and settings.get_rate_control(quality) in CRF_RATE_CONTROL_MODES)
+                if crop_mode == 'auto' or per_title:
+                    progress.set_stage(render_analyze)
+                
+                crop = await encoder.crop_filter(download_path, crop_mode, cancel_token=token)
+                
+                crf = None
+                if per_title:
+                    crf = await encoder.per_title_crf(
+                        download_path,
+                        quality,
+                        file_unique_id=job['file_unique_id'],
+                        cancel_token=token,
+                        cores=cores,
+                        crop=crop,
+                        settings=settings
+                    )
+                
+                progress.set_stage(render_encode)
+                if segment_time:
+                    early_upload = asyncio.create_task(upload_first_part())
+                
+                output = await encoder.encode_video(
+                    download_path,
+                    quality,
+                    progress_callback=progress.publish,
+                    cancel_token=token,
+                    cores=cores,
+                    crf=crf,
+                    crop=crop,
+                    segment_time=segment_time,
+                    settings=settings,
+                    on_stall=stop_early_upload
+                )
+                encoded.set()
+                outputs = output if segment_time else [output]
+                scratch.extend(outputs)
+        
+        # Admit the next job into the pipeline while this one uploads
+        await pipeline_slot.aclose()
+        
+        # Update status to uploading
+        token.raise_if_cancelled()
+        task.set_stage('uploading')
+        await adb.update_job_state(task_id, 'uploading')
+        
+        upload_start = time.time()
+        progress.set_stage(render_upload)
+        if uploads:
+            # Show the early part's progress right away
+            progress.publish((
+                sum(done for done, _ in uploads.values()),
+                sum(size for _, size in uploads.values())
+            ))
+        
+        early_part = await early_upload if early_upload else None
+        
+        # The part prediction was pessimistic: put the parts back together
+        if len(outputs) > 1 and not early_part and sum(os.path.getsize(path) for path in outputs) <= size_limit:
+            joined = encoder.output_path(download_path, quality)
+            scratch.append(joined)
+            outputs = [await encoder.merge_videos(outputs, cancel_token=token, output_file=joined)]
+        
+        # Cut anything still above the limit at keyframes, without re-encoding
+        parts = []
+        for path in outputs:
+            if path == early_part:
+                parts.append(path)
+                continue
+            split = await encoder.split_video(path, size_limit, cancel_token=token)
+            scratch.extend(split)
+            parts.extend(split)
+        
+        if len(parts) == 1:
+            await upload_file(parts[0])
         else:
-            await client.send_video(
-                chat_id=user_id,
-                video=output_path,
-                caption=caption,
-                has_spoiler=use_spoiler,
-                progress=upload_progress
-            )
+            await asyncio.gather(*[
+                upload_file(path, number, len(parts))
+                for number, path in enumerate(parts, 1)
+                if path != early_part
+            ])
         
-        # Cleanup
-        os.remove(download_path)
-        os.remove(output_path)
+        await progress.close()
+        await adb.update_job_state(task_id, 'done')
         
         # Update final status
-        total_time = time.time() - active_tasks[user_id]['start_time']
+        total_time = time.time() - task.created_at
         
         await progress_msg.edit_text(
             f"✅ **Encoding Complete!**\n\n"
@@ -418,85 +816,205 @@ async def encode_video(client, status_message, file_message, user_id, quality):
             f"⏱ Time Taken: {format_time(int(total_time))}\n\n"
             f"Thank you for using Turbo Encoder! 🚀"
         )
+    
+    except (TaskCancelled, asyncio.CancelledError):
+        if not token.cancelled:
+            # Shutdown: leave the job state so it is resumed on restart
+            raise
         
-        # Remove from active tasks
-        del active_tasks[user_id]
+        if progress:
+            await progress.close()
+        # Hand the slot on before the state write and a possibly slow edit
+        await release()
+        await adb.update_job_state(task_id, 'cancelled')
         
+        try:
+            await status_message.edit_text("🛑 **Task Cancelled!**")
+        except:
+            pass
+    
     except Exception as e:
+        if progress:
+            await progress.close()
+        await adb.update_job_state(task_id, 'failed', str(e))
+        
         await status_message.edit_text(
             f"❌ **Encoding Failed!**\n\n"
             f"Error: {str(e)}\n\n"
             f"Please try again or contact support."
         )
-        
-        if user_id in active_tasks:
-            del active_tasks[user_id]
-        
-        # Cleanup files
-        try:
-            if os.path.exists(download_path):
-                os.remove(download_path)
-        except:
-            pass
+    
+    finally:
+        # Free the slot and scratch files on every exit path
+        await release()
 
 
-async def update_encode_progress(msg, filename, quality, data, start_time, user, task_id):
-    """Update encoding progress message"""
-    try:
-        elapsed = time.time() - start_time
-        percentage = data.get('percentage', 0)
-        speed = data.get('speed', '0x')
-        time_left = data.get('time_left', '00:00:00')
-        
-        await msg.edit_text(
-            "**2. Encoding**\n"
-            f"`{filename}`\n\n"
-            f"{format_progress_bar(percentage)}\n"
-            f"├ Speed: {speed}\n"
-            f"├ Quality: {quality}\n"
-            f"├ Time Left: {time_left}\n"
-            f"├ Elapsed: {format_time(int(elapsed))}\n"
-            f"└ Task By: {user.mention}\n\n"
-            f"`/stop{task_id}` to cancel"
-        )
-    except:
-        pass
+def format_encode_progress(filename, quality, data, start_time, user, task_id):
+    """Format encoding progress message"""
+    elapsed = time.time() - start_time
+    percentage = data.get('percentage', 0)
+    speed = data.get('speed', '0x')
+    time_left = data.get('time_left', '00:00:00')
+    
+    return (
+        "**2. Encoding**\n"
+        f"`{filename}`\n\n"
+        f"{format_progress_bar(percentage)}\n"
+        f"├ Speed: {speed}\n"
+        f"├ Quality: {quality}\n"
+        f"├ Time Left: {time_left}\n"
+        f"├ Elapsed: {format_time(int(elapsed))}\n"
+        f"└ Task By: {user.mention}\n\n"
+        f"`/stop{task_id}` to cancel"
+    )
 
 
-@app.on_message(filters.command("stop") & filters.private)
+@app.on_message(filters.regex(r"^/stop(?:@\w+)?\s*([A-Za-z0-9]*)$") & filters.private)
 async def stop_task(client, message: Message):
-    """Cancel active encoding task"""
+    """Cancel a task: /stop<task_id>, or /stop when only one task is running"""
     user_id = message.from_user.id
+    task_id = message.matches[0].group(1)
     
-    if user_id not in active_tasks:
-        await message.reply_text("❌ No active task to cancel!")
-        return
+    if task_id:
+        task = registry.get(task_id)
+        if not task or (task.user_id != user_id and not is_admin(user_id)):
+            await message.reply_text("❌ No such task to cancel!")
+            return
+    else:
+        tasks = registry.for_user(user_id)
+        if not tasks:
+            await message.reply_text("❌ No active task to cancel!")
+            return
+        if len(tasks) > 1:
+            text = "**Which task should be cancelled?**\n\n"
+            for task in tasks:
+                text += f"├ `{task.file_name}`\n└ /stop{task.task_id}\n\n"
+            await message.reply_text(text)
+            return
+        task = tasks[0]
     
-    active_tasks[user_id]['status'] = 'cancelled'
-    await message.reply_text("✅ Task cancelled successfully!")
+    task.cancel()
+    await message.reply_text(f"✅ Task `{task.task_id}` cancelled successfully!")
 
 
 @app.on_message(filters.command("tasks") & filters.private)
 async def show_tasks(client, message: Message):
-    """Show active tasks"""
+    """Show user's tasks (admins also see the scheduler state)"""
     user_id = message.from_user.id
+    tasks = registry.for_user(user_id)
+    text = ""
+    
+    if tasks:
+        limit = get_task_limit(await adb.is_premium_user(user_id))
+        text += f"**📊 Your Tasks ({len(tasks)}/{limit}):**\n\n"
+        for task in tasks:
+            elapsed = time.time() - task.created_at
+            text += f"`{task.file_name}`\n"
+            text += f"├ Operation: {task.operation.replace('encode_', '')}\n"
+            text += f"├ Status: {task.status.title()}\n"
+            text += f"├ Stage: {task.stage.title()}\n"
+            text += f"├ Elapsed: {format_time(int(elapsed))}\n"
+            text += f"└ Cancel: /stop{task.task_id}\n\n"
     
-    if user_id not in active_tasks:
+    if is_admin(user_id):
+        text += format_scheduler_state(scheduler.snapshot())
+    
+    if not text:
         await message.reply_text("📭 No active tasks!")
         return
     
-    task = active_tasks[user_id]
-    elapsed = time.time() - task['start_time']
+    await message.reply_text(text)
+
+
+def format_scheduler_state(state):
+    """Format fair-share scheduler state for admins"""
+    now = time.time()
+    
+    text = "**🗂 Scheduler:**\n"
+    text += f"├ Slots: {len(state['running'])}/{state['slots']}\n"
+    text += f"├ Waiting: {len(state['waiting'])}\n"
+    text += f"└ Virtual Time: {state['virtual_time']:.0f}\n"
     
-    text = f"**📊 Active Task:**\n\n"
-    text += f"├ Status: {task['status'].title()}\n"
-    text += f"├ Stage: {task['current_stage'].title()}\n"
-    text += f"└ Elapsed: {format_time(int(elapsed))}\n\n"
-    text += f"Use /stop to cancel"
+    text += "\n**Stage Pools:**\n"
+    for name, pool in pools.items():
+        pool_state = pool.snapshot()
+        text += f"├ {name.title()}: {pool_state['busy']}/{pool_state['size']} busy, {pool_state['queued']} queued\n"
     
-    await message.reply_text(text)
+    resources = admission.snapshot()
+    text += "\n**Resources:**\n"
+    text += f"├ Admitted: {resources['active']}\n"
+    text += f"├ Reserved: {format_size(resources['reserved']['memory'])} RAM, {format_size(resources['reserved']['disk'])} disk\n"
+    text += f"├ Cores per Encode: {cpu_cores.budget(pools['encode'].size)}/{len(cpu_cores.cores)}\n"
+    text += f"└ Admissions: {'paused (' + resources['paused_reason'] + ')' if resources['paused_reason'] else 'open'}\n"
+    
+    for title, entries in (("Running", state['running']), ("Waiting", state['waiting'])):
+        if not entries:
+            continue
+        text += f"\n**{title}:**\n"
+        for entry in entries:
+            text += (
+                f"├ `{entry['job_id']}` user `{entry['user_id']}` "
+                f"cost {entry['cost']:.0f} w{entry['weight']:g} "
+                f"tag {entry['start']:.0f} ({format_time(int(now - entry['since']))})\n"
+            )
+    
+    if state['served']:
+        text += "\n**Served Cost (busy users):**\n"
+        for served_user, cost in sorted(state['served'].items(), key=lambda item: -item[1]):
+            text += f"├ `{served_user}`: {cost:.0f}\n"
+    
+    return text
+
+
+async def resume_interrupted_jobs(client):
+    """Resume jobs that were queued or running when their instance stopped (lease expired)"""
+    resumed = 0
+    
+    for job in await adb.requeue_interrupted_jobs(Config.MAX_JOB_ATTEMPTS):
+        if not job['operation'] or not job['operation'].startswith("encode_"):
+            continue
+        
+        try:
+            user = await client.get_users(job['user_id'])
+            status_message = await client.send_message(
+                job['chat_id'],
+                f"♻️ **Resuming interrupted task**\n`{job['file_name']}`"
+            )
+        except Exception as e:
+            await adb.update_job_state(job['job_id'], 'failed', str(e))
+            continue
+        
+        # Already accepted jobs are not subject to the per-tier limit
+        start_task(client, status_message, job, user)
+        resumed += 1
+    
+    if resumed:
+        print(f"♻️ Resumed {resumed} interrupted job(s)")
+
+
+async def maintain_job_leases(client):
+    """Keep this instance's job leases fresh and take over jobs of dead instances"""
+    while True:
+        await asyncio.sleep(Config.JOB_LEASE_SECONDS / 3)
+        try:
+            await adb.renew_job_leases()
+            await resume_interrupted_jobs(client)
+        except Exception as e:
+            print(f"Job lease upkeep failed: {e}")
+
+
+async def main():
+    """Start the bot and resume interrupted jobs"""
+    await app.start()
+    await resume_interrupted_jobs(app)
+    leases = asyncio.create_task(maintain_job_leases(app))
+    await idle()
+    leases.cancel()
+    await app.stop()
+    await shortener.close()
+    db.flush_user_writes()
 
 
 if __name__ == "__main__":
     print("🚀 Bot starting...")
-    app.run()
+    app.run(main())
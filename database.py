@@ -1,128 +1,422 @@
-import sqlite3
 import json
+import queue
+import asyncio
+import atexit
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
+from types import MappingProxyType
 from config import Config
+from migrations import migrate, check_query_plans
+from storage import open_backend
+
+
+class BatchConnection:
+    """Connection shared by the calls of one batch; commit and close are deferred"""
+    
+    def __init__(self, conn):
+        self._conn = conn
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    def commit(self):
+        """Committed once for the whole batch"""
+    
+    def close(self):
+        """Returned to the pool once the batch is done"""
+
+
+class SettingsCache:
+    """
+    In-process copy of a small table (bot_settings, channels), loaded whole on first read
+    
+    Writes through this process invalidate it at once; the copy also expires
+    after `ttl` seconds so writes by other instances sharing the store land.
+    """
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._settings = None
+        self._expires = 0
+        self._lock = threading.Lock()
+    
+    def get(self, loader):
+        """Get all rows as a mapping, loading them with loader() if not cached"""
+        settings = self._settings
+        if settings is None or time.monotonic() >= self._expires:
+            with self._lock:
+                if self._settings is None or time.monotonic() >= self._expires:
+                    self._settings = MappingProxyType(loader())
+                    self._expires = time.monotonic() + self.ttl
+                settings = self._settings
+        return settings
+    
+    def invalidate(self):
+        """Drop the cached settings; the next read reloads them"""
+        with self._lock:
+            self._settings = None
+
+
+class UserCache:
+    """
+    Bounded LRU cache of user profiles (settings row and premium expiry)
+    
+    An entry lives for USER_CACHE_TTL seconds, but never past the user's
+    premium expiry_date, so premium ends exactly when the database says.
+    """
+    
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+    
+    def get(self, user_id, loader):
+        """Get a user's profile, loading it with loader(user_id) on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+            generation = self._generation
+        
+        profile = loader(user_id)
+        
+        expires = now + self.ttl
+        premium_until = profile['premium_until']
+        if isinstance(premium_until, datetime):
+            expires = min(expires, now + (premium_until - datetime.utcnow()).total_seconds())
+        
+        with self._lock:
+            # Skip storing if a write invalidated anything while we loaded
+            if generation == self._generation:
+                self._entries[user_id] = (expires, profile)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return profile
+    
+    def invalidate(self, user_id):
+        """Drop a user's cached profile"""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+
+class UserWriteBuffer:
+    """
+    Write-behind buffer of user upserts and last_active touches
+    
+    Writes are coalesced per user in memory and handed to flush() in one
+    batch every USER_FLUSH_INTERVAL seconds by a daemon thread.
+    """
+    
+    def __init__(self, interval, writer):
+        self.interval = interval
+        self._writer = writer
+        self._users = {}
+        self._touches = {}
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def add(self, user_id, username, first_name):
+        """Buffer an upsert of a user's row"""
+        with self._lock:
+            self._users[user_id] = (username, first_name, _utc_timestamp())
+            self._touches.pop(user_id, None)
+            self._start()
+    
+    def touch(self, user_id):
+        """Buffer a last_active update"""
+        now = _utc_timestamp()
+        with self._lock:
+            if user_id in self._users:
+                username, first_name, _ = self._users[user_id]
+                self._users[user_id] = (username, first_name, now)
+            else:
+                self._touches[user_id] = now
+            self._start()
+    
+    def flush(self):
+        """Write everything buffered so far in one transaction"""
+        with self._lock:
+            users, touches = self._users, self._touches
+            self._users, self._touches = {}, {}
+        if not users and not touches:
+            return
+        
+        try:
+            self._writer(users, touches)
+        except Exception as e:
+            print(f"User write flush failed: {e}")
+            # Keep the rows for the next flush unless newer ones arrived
+            with self._lock:
+                for user_id, row in users.items():
+                    self._users.setdefault(user_id, row)
+                for user_id, touched in touches.items():
+                    if user_id not in self._users:
+                        self._touches.setdefault(user_id, touched)
+    
+    def _start(self):
+        """Start the flusher thread on first use (call with the lock held)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="user-writes", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+    
+    def _run(self):
+        """Flush periodically"""
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+def _utc_timestamp(offset=0):
+    """Current UTC time (plus offset seconds) in CURRENT_TIMESTAMP's format"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() + offset))
+
+
+# One backend and set of caches per DATABASE_URL, shared by every
+# Database instance so a write through one invalidates all of them
+_backends = {}
+_settings_caches = {}
+_channel_caches = {}
+_user_caches = {}
+_user_writes = {}
+_async_databases = {}
+_thread_states = {}
+_migrated = set()
+_pools_lock = threading.Lock()
+_schema_lock = threading.Lock()
+
+
+def get_backend(database_url):
+    """Get the storage backend (connection pool) for a DATABASE_URL"""
+    with _pools_lock:
+        if database_url not in _backends:
+            _backends[database_url] = open_backend(database_url, Config.DB_POOL_SIZE)
+        return _backends[database_url]
+
+
+def get_settings_cache(database_url):
+    """Get the bot_settings cache for a DATABASE_URL"""
+    with _pools_lock:
+        return _settings_caches.setdefault(database_url, SettingsCache(Config.SETTINGS_CACHE_TTL))
+
+
+def get_channel_cache(database_url):
+    """Get the force-subscribe channel cache for a DATABASE_URL"""
+    with _pools_lock:
+        return _channel_caches.setdefault(database_url, SettingsCache(Config.SETTINGS_CACHE_TTL))
+
+
+def get_user_cache(database_url):
+    """Get the user profile cache for a DATABASE_URL"""
+    with _pools_lock:
+        if database_url not in _user_caches:
+            _user_caches[database_url] = UserCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+        return _user_caches[database_url]
+
+
+def get_user_writes(database_url, writer):
+    """Get the user write-behind buffer for a DATABASE_URL"""
+    with _pools_lock:
+        if database_url not in _user_writes:
+            _user_writes[database_url] = UserWriteBuffer(Config.USER_FLUSH_INTERVAL, writer)
+        return _user_writes[database_url]
+
+
+def get_thread_state(database_url):
+    """Get the per-thread batch state for a DATABASE_URL, shared by its instances"""
+    with _pools_lock:
+        return _thread_states.setdefault(database_url, threading.local())
+
+
+def get_async_database(database):
+    """Get the one AsyncDatabase (database thread) for a Database's URL"""
+    with _pools_lock:
+        if database.database_url not in _async_databases:
+            _async_databases[database.database_url] = AsyncDatabase(database)
+        return _async_databases[database.database_url]
 
 
 class Database:
     """Database handler for bot"""
     
-    def __init__(self, db_path="bot.db"):
-        self.db_path = db_path
+    def __init__(self, database_url=None):
+        self.database_url = database_url or Config.DATABASE_URL
+        self.pool = get_backend(self.database_url)
+        self.settings = get_settings_cache(self.database_url)
+        self.channels = get_channel_cache(self.database_url)
+        self.users = get_user_cache(self.database_url)
+        self.user_writes = get_user_writes(self.database_url, self._write_users)
+        # A batch opened through any instance is this thread's batch for all
+        # of them, so the shared user flush writes on it too
+        self._local = get_thread_state(self.database_url)
         self.create_tables()
     
     def get_connection(self):
-        """Get database connection"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        """Get a pooled database connection; close() returns it to the pool"""
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            return batch
+        return self.pool.acquire()
+    
+    @contextmanager
+    def batch(self):
+        """Run this thread's calls in one transaction, committed at the end"""
+        conn = self.pool.acquire()
+        self._local.batch = BatchConnection(conn)
+        try:
+            # Take the write lock up front: a deferred BEGIN that has read
+            # fails at once with "database is locked" once another writer
+            # commits, and no busy timeout or savepoint rollback recovers it
+            conn.execute('BEGIN IMMEDIATE')
+            yield self._local.batch
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.batch = None
+            conn.close()
+            
+            # Other threads may have cached settings from before the commit
+            if getattr(self._local, 'settings_changed', False):
+                self._local.settings_changed = False
+                self.settings.invalidate()
+            if getattr(self._local, 'channels_changed', False):
+                self._local.channels_changed = False
+                self.channels.invalidate()
+            for user_id in getattr(self._local, 'users_changed', ()):
+                self.users.invalidate(user_id)
+            self._local.users_changed = set()
     
     def create_tables(self):
-        """Create necessary database tables"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                is_premium BOOLEAN DEFAULT 0,
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # User settings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_settings (
-                user_id INTEGER PRIMARY KEY,
-                watermark_text TEXT,
-                thumbnail_path TEXT,
-                upload_as_document BOOLEAN DEFAULT 0,
-                spoiler_mode BOOLEAN DEFAULT 0,
-                upload_destination TEXT DEFAULT 'private',
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
-        
-        # Premium users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS premium_users (
-                user_id INTEGER PRIMARY KEY,
-                added_by INTEGER,
-                added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expiry_date TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
-        
-        # Force subscribe channels
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS force_subscribe_channels (
-                channel_id INTEGER PRIMARY KEY,
-                channel_url TEXT,
-                channel_name TEXT,
-                added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Bot settings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        
-        # Initialize default bot settings
-        default_settings = {
-            'codec': Config.DEFAULT_CODEC,
-            'preset': Config.DEFAULT_PRESET,
-            'crf': str(Config.DEFAULT_CRF),
-            'audio_bitrate': Config.DEFAULT_AUDIO_BITRATE,
-            'fsub_mode': Config.FSUB_MODE,
-            'start_picture': '',
-            'shortener_1_api': Config.SHORTENER_1_API,
-            'shortener_1_url': Config.SHORTENER_1_URL,
-            'tutorial_1': Config.TUTORIAL_1,
-            'shortener_2_api': Config.SHORTENER_2_API,
-            'shortener_2_url': Config.SHORTENER_2_URL,
-            'tutorial_2': Config.TUTORIAL_2
-        }
-        
-        for key, value in default_settings.items():
-            cursor.execute('''
-                INSERT OR IGNORE INTO bot_settings (key, value)
-                VALUES (?, ?)
-            ''', (key, value))
-        
-        conn.commit()
-        conn.close()
+        """Migrate the schema and seed default settings, once per process"""
+        with _schema_lock:
+            if self.database_url in _migrated:
+                return
+            
+            conn = self.get_connection()
+            migrate(conn, self.pool.dialect)
+            if self.pool.dialect == 'sqlite':
+                for name, detail in check_query_plans(conn):
+                    print(f"⚠️ Query plan of {name} scans a table: {detail}")
+            cursor = conn.cursor()
+            
+            # Initialize default bot settings
+            default_settings = {
+                'codec': Config.DEFAULT_CODEC,
+                'preset': Config.DEFAULT_PRESET,
+                'crf': str(Config.DEFAULT_CRF),
+                'per_title_crf': 'off',
+                'audio_bitrate': Config.DEFAULT_AUDIO_BITRATE,
+                'fsub_mode': Config.FSUB_MODE,
+                'start_picture': '',
+                'shortener_1_api': Config.SHORTENER_1_API,
+                'shortener_1_url': Config.SHORTENER_1_URL,
+                'tutorial_1': Config.TUTORIAL_1,
+                'shortener_2_api': Config.SHORTENER_2_API,
+                'shortener_2_url': Config.SHORTENER_2_URL,
+                'tutorial_2': Config.TUTORIAL_2
+            }
+            
+            for key, value in default_settings.items():
+                cursor.execute('''
+                    INSERT INTO bot_settings (key, value)
+                    VALUES (?, ?)
+                    ON CONFLICT (key) DO NOTHING
+                ''', (key, value))
+            
+            conn.commit()
+            conn.close()
+            _migrated.add(self.database_url)
     
     # User Management
     def add_user(self, user_id, first_name, username=None):
-        """Add new user to database"""
+        """Add or update a user (buffered, written within USER_FLUSH_INTERVAL)"""
+        self.user_writes.add(user_id, username, first_name)
+    
+    def touch_user(self, user_id):
+        """Record user activity (buffered like add_user)"""
+        self.user_writes.touch(user_id)
+    
+    def flush_user_writes(self):
+        """Write buffered user upserts and touches now (in this thread's batch, if any)"""
+        self.user_writes.flush()
+    
+    def _write_users(self, users, touches):
+        """Upsert buffered users in place, keeping join_date and is_premium"""
+        # Inside a batch this is the batch's connection: it already holds the
+        # write lock, which a second connection would wait on until timeout
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_active)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, username, first_name))
-        
-        # Create user settings if not exists
-        cursor.execute('''
-            INSERT OR IGNORE INTO user_settings (user_id)
-            VALUES (?)
-        ''', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        try:
+            # Previous activity decides who is new and who is active again today
+            user_ids = list(users.keys() | touches.keys())
+            last_seen = {}
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                cursor.execute(
+                    f"SELECT user_id, last_active FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                )
+                last_seen.update((row['user_id'], str(row['last_active'] or '')[:10]) for row in cursor.fetchall())
+            
+            counters, daily = Counter(), Counter()
+            for user_id in user_ids:
+                day = (users[user_id][2] if user_id in users else touches[user_id])[:10]
+                if user_id not in last_seen:
+                    if user_id not in users:
+                        continue
+                    counters['users'] += 1
+                    daily[day, 'new_users'] += 1
+                    daily[day, 'active_users'] += 1
+                elif last_seen[user_id] < day:
+                    daily[day, 'active_users'] += 1
+            
+            cursor.executemany('''
+                INSERT INTO users (user_id, username, first_name, last_active)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_active = excluded.last_active
+            ''', [(user_id, *row) for user_id, row in users.items()])
+            
+            # Create user settings if not exists
+            cursor.executemany('''
+                INSERT INTO user_settings (user_id)
+                VALUES (?)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', [(user_id,) for user_id in users])
+            
+            cursor.executemany('''
+                UPDATE users SET last_active = ? WHERE user_id = ?
+            ''', [(touched, user_id) for user_id, touched in touches.items()])
+            
+            self._bump_stats(cursor, counters, daily)
+            
+            # The periodic flush also retires premium rows past their expiry
+            expired = self._expire_premium_users(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+        for user_id in expired:
+            self._user_changed(user_id)
     
     def get_user(self, user_id):
         """Get user information"""
+        self.flush_user_writes()
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -133,42 +427,89 @@ class Database:
         return dict(user) if user else None
     
     def is_premium_user(self, user_id):
-        """Check if user has premium access"""
+        """Check if user has premium access (served from the user cache)"""
+        premium_until = self.users.get(user_id, self._load_user_profile)['premium_until']
+        if isinstance(premium_until, datetime):
+            return datetime.utcnow() < premium_until
+        return bool(premium_until)
+    
+    def _load_user_profile(self, user_id):
+        """Read a user's settings row and premium expiry"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        cursor.execute('SELECT * FROM user_settings WHERE user_id = ?', (user_id,))
+        settings = cursor.fetchone()
+        
         cursor.execute('''
-            SELECT * FROM premium_users 
+            SELECT expiry_date FROM premium_users
             WHERE user_id = ? AND (expiry_date IS NULL OR expiry_date > CURRENT_TIMESTAMP)
         ''', (user_id,))
+        premium = cursor.fetchone()
         
-        result = cursor.fetchone()
         conn.close()
         
-        return result is not None
+        # Expiry is compared as UTC text, like CURRENT_TIMESTAMP above
+        premium_until = False
+        if premium:
+            premium_until = True
+            if premium['expiry_date']:
+                try:
+                    premium_until = datetime.fromisoformat(str(premium['expiry_date']))
+                except ValueError:
+                    pass
+        
+        return {
+            'settings': dict(settings) if settings else {},
+            'premium_until': premium_until
+        }
+    
+    def _user_changed(self, user_id):
+        """Invalidate a cached user profile now, and again once a batch commits"""
+        self.users.invalidate(user_id)
+        if getattr(self._local, 'batch', None) is not None:
+            if not hasattr(self._local, 'users_changed'):
+                self._local.users_changed = set()
+            self._local.users_changed.add(user_id)
     
     def add_premium_user(self, user_id, added_by, expiry_date=None):
         """Add premium user"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # The insert itself decides new vs. renewed, so concurrent adds of
+        # one user count it once (a check-then-insert would race)
         cursor.execute('''
-            INSERT OR REPLACE INTO premium_users (user_id, added_by, expiry_date)
+            INSERT INTO premium_users (user_id, added_by, expiry_date)
             VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id
         ''', (user_id, added_by, expiry_date))
+        if cursor.fetchall():
+            self._bump_stats(cursor, {'premium_users': 1})
+        else:
+            cursor.execute('''
+                UPDATE premium_users
+                SET added_by = ?, added_date = CURRENT_TIMESTAMP, expiry_date = ?
+                WHERE user_id = ?
+            ''', (added_by, expiry_date, user_id))
         
         conn.commit()
         conn.close()
+        self._user_changed(user_id)
     
     def remove_premium_user(self, user_id):
         """Remove premium user"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('DELETE FROM premium_users WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM premium_users WHERE user_id = ? RETURNING user_id', (user_id,))
+        if cursor.fetchall():
+            self._bump_stats(cursor, {'premium_users': -1})
         
         conn.commit()
         conn.close()
+        self._user_changed(user_id)
     
     def get_all_premium_users(self):
         """Get list of all premium users"""
@@ -189,32 +530,25 @@ class Database:
     
     # User Settings
     def get_user_setting(self, user_id, setting_key, default=None):
-        """Get specific user setting"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(f'SELECT {setting_key} FROM user_settings WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        
-        conn.close()
-        
-        if result and result[setting_key] is not None:
-            return result[setting_key]
-        return default
+        """Get specific user setting (served from the user cache)"""
+        value = self.users.get(user_id, self._load_user_profile)['settings'].get(setting_key)
+        return default if value is None else value
     
     def set_user_setting(self, user_id, setting_key, value):
         """Set user setting"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Upsert: the user's row may still be in the write-behind buffer
         cursor.execute(f'''
-            UPDATE user_settings
-            SET {setting_key} = ?
-            WHERE user_id = ?
-        ''', (value, user_id))
+            INSERT INTO user_settings (user_id, {setting_key})
+            VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET {setting_key} = excluded.{setting_key}
+        ''', (user_id, value))
         
         conn.commit()
         conn.close()
+        self._user_changed(user_id)
     
     def get_user_watermark(self, user_id):
         """Get user's watermark text"""
@@ -224,6 +558,14 @@ class Database:
         """Set user's watermark text"""
         self.set_user_setting(user_id, 'watermark_text', text)
     
+    def get_user_crop_mode(self, user_id):
+        """Get user's crop mode (auto, off or an aspect ratio)"""
+        return self.get_user_setting(user_id, 'crop_mode', Config.DEFAULT_CROP_MODE)
+    
+    def set_user_crop_mode(self, user_id, mode):
+        """Set user's crop mode"""
+        self.set_user_setting(user_id, 'crop_mode', mode)
+    
     def get_user_thumbnail(self, user_id):
         """Get user's thumbnail path"""
         return self.get_user_setting(user_id, 'thumbnail_path')
@@ -239,12 +581,17 @@ class Database:
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT OR REPLACE INTO force_subscribe_channels (channel_id, channel_url, channel_name)
+            INSERT INTO force_subscribe_channels (channel_id, channel_url, channel_name)
             VALUES (?, ?, ?)
+            ON CONFLICT (channel_id) DO UPDATE SET
+                channel_url = excluded.channel_url,
+                channel_name = excluded.channel_name,
+                added_date = CURRENT_TIMESTAMP
         ''', (channel_id, channel_url, channel_name))
         
         conn.commit()
         conn.close()
+        self._channels_changed()
     
     def remove_force_subscribe_channel(self, channel_id):
         """Remove force subscribe channel"""
@@ -255,30 +602,48 @@ class Database:
         
         conn.commit()
         conn.close()
+        self._channels_changed()
     
     def get_force_subscribe_channels(self):
-        """Get all force subscribe channels"""
+        """Get all force subscribe channels (served from the channel cache)"""
+        return [dict(channel) for channel in self.channels.get(self._load_force_subscribe_channels).values()]
+    
+    def _load_force_subscribe_channels(self):
+        """Read all force subscribe channels, keyed by channel ID"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('SELECT * FROM force_subscribe_channels')
-        channels = [dict(row) for row in cursor.fetchall()]
+        channels = {row['channel_id']: MappingProxyType(dict(row)) for row in cursor.fetchall()}
         
         conn.close()
         return channels
     
+    def _channels_changed(self):
+        """Invalidate cached channels now, and again once a batch commits"""
+        self.channels.invalidate()
+        if getattr(self._local, 'batch', None) is not None:
+            self._local.channels_changed = True
+    
     # Bot Settings
     def get_bot_setting(self, key, default=None):
-        """Get bot setting"""
+        """Get bot setting (served from the settings cache)"""
+        return self.settings.get(self._load_bot_settings).get(key, default)
+    
+    def _load_bot_settings(self):
+        """Read all bot settings"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT value FROM bot_settings WHERE key = ?', (key,))
-        result = cursor.fetchone()
+        cursor.execute('SELECT key, value FROM bot_settings')
+        settings = {row['key']: row['value'] for row in cursor.fetchall()}
         
         conn.close()
-        
-        return result['value'] if result else default
+        return settings
+    
+    def settings_snapshot(self):
+        """Get an immutable copy of the current settings for one job"""
+        return SettingsSnapshot(self.settings.get(self._load_bot_settings))
     
     def set_bot_setting(self, key, value):
         """Set bot setting"""
@@ -286,12 +651,31 @@ class Database:
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT OR REPLACE INTO bot_settings (key, value)
+            INSERT INTO bot_settings (key, value)
             VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
         ''', (key, value))
         
         conn.commit()
         conn.close()
+        self._settings_changed()
+    
+    def delete_bot_setting(self, key):
+        """Delete bot setting"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM bot_settings WHERE key = ?', (key,))
+        
+        conn.commit()
+        conn.close()
+        self._settings_changed()
+    
+    def _settings_changed(self):
+        """Invalidate cached settings now, and again once a batch commits"""
+        self.settings.invalidate()
+        if getattr(self._local, 'batch', None) is not None:
+            self._local.settings_changed = True
     
     def get_codec(self):
         """Get encoding codec"""
@@ -317,6 +701,65 @@ class Database:
         """Set CRF value"""
         self.set_bot_setting('crf', str(crf))
     
+    def get_per_title_crf(self):
+        """Check if per-title CRF search is enabled"""
+        return self.get_bot_setting('per_title_crf', 'off') == 'on'
+    
+    def set_per_title_crf(self, enabled):
+        """Enable or disable per-title CRF search"""
+        self.set_bot_setting('per_title_crf', 'on' if enabled else 'off')
+    
+    def get_cached_crf(self, file_unique_id, quality, codec, preset, rate_control, base_crf, metric, target):
+        """Get CRF found by an earlier search for the same source, encoder profile and target"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT crf FROM crf_cache
+            WHERE file_unique_id = ? AND quality = ? AND codec = ? AND preset = ?
+                AND rate_control = ? AND base_crf = ? AND metric = ? AND target = ?
+        ''', (file_unique_id, quality, codec, preset, rate_control, base_crf, metric, target))
+        result = cursor.fetchone()
+        
+        conn.close()
+        return result['crf'] if result else None
+    
+    def cache_crf(self, file_unique_id, quality, codec, preset, rate_control, base_crf, metric, target,
+                  crf, score=None):
+        """Store the result of a CRF search"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO crf_cache
+            (file_unique_id, quality, codec, preset, rate_control, base_crf, metric, target, crf, score)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (file_unique_id, quality, codec, preset, rate_control, base_crf, metric, target)
+            DO UPDATE SET
+                crf = excluded.crf,
+                score = excluded.score,
+                created_at = CURRENT_TIMESTAMP
+        ''', (file_unique_id, quality, codec, preset, rate_control, base_crf, metric, target, crf, score))
+        
+        conn.commit()
+        conn.close()
+    
+    def get_rate_control(self, quality=None):
+        """Get rate-control mode; a per-quality override wins over the global one"""
+        if quality:
+            mode = self.get_bot_setting(f'rate_control_{quality}')
+            if mode:
+                return mode
+        return self.get_bot_setting('rate_control', Config.DEFAULT_RATE_CONTROL)
+    
+    def set_rate_control(self, mode, quality=None):
+        """Set rate-control mode globally or for one quality (mode None clears it)"""
+        key = f'rate_control_{quality}' if quality else 'rate_control'
+        if mode is None:
+            self.delete_bot_setting(key)
+        else:
+            self.set_bot_setting(key, mode)
+    
     def get_audio_bitrate(self):
         """Get audio bitrate"""
         return self.get_bot_setting('audio_bitrate', Config.DEFAULT_AUDIO_BITRATE)
@@ -341,28 +784,416 @@ class Database:
         """Set force subscribe mode"""
         self.set_bot_setting('fsub_mode', mode)
     
-    # Statistics
-    def get_total_users(self):
-        """Get total user count"""
+    # Jobs
+    def create_job(self, job_id, user_id, chat_id, message_id, file_id,
+                   file_unique_id=None, file_name=None, file_size=0, duration=0):
+        """Create job waiting for the user to pick an operation"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO jobs (job_id, user_id, chat_id, message_id, file_id,
+                              file_unique_id, file_name, file_size, duration, state)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+        ''', (job_id, user_id, chat_id, message_id, file_id,
+              file_unique_id, file_name, file_size, duration))
+        
+        conn.commit()
+        conn.close()
+    
+    def get_job(self, job_id):
+        """Get job by ID"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,))
+        job = cursor.fetchone()
+        
+        conn.close()
+        return dict(job) if job else None
+    
+    def get_pending_job(self, user_id):
+        """Get user's latest job still waiting for an operation"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT COUNT(*) as count FROM users')
+        cursor.execute('''
+            SELECT * FROM jobs
+            WHERE user_id = ? AND state = 'pending'
+            ORDER BY created_at DESC, rowid DESC
+            LIMIT 1
+        ''', (user_id,))
+        job = cursor.fetchone()
+        
+        conn.close()
+        return dict(job) if job else None
+    
+    def set_job_batch(self, job_ids, batch_id):
+        """Group jobs into a batch"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.executemany(
+            'UPDATE jobs SET batch_id = ? WHERE job_id = ?',
+            [(batch_id, job_id) for job_id in job_ids]
+        )
+        
+        conn.commit()
+        conn.close()
+    
+    def get_batch_jobs(self, batch_id):
+        """Get jobs of a batch in arrival order"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM jobs
+            WHERE batch_id = ?
+            ORDER BY message_id, rowid
+        ''', (batch_id,))
+        jobs = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return jobs
+    
+    def queue_job(self, job_id, operation, status_message_id=None):
+        """Move a pending job to the queue; returns 0 if it was not pending anymore"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        # Only one of two racing button taps gets to queue the job
+        cursor.execute('''
+            UPDATE jobs
+            SET operation = ?, status_message_id = ?, state = 'queued',
+                owner = ?, lease_until = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND state = 'pending'
+            RETURNING job_id
+        ''', (operation, status_message_id, Config.INSTANCE_ID,
+              _utc_timestamp(Config.JOB_LEASE_SECONDS), job_id))
+        queued = len(cursor.fetchall())
+        
+        conn.commit()
+        conn.close()
+        return queued
+    
+    def cancel_pending_job(self, job_id, error=None):
+        """Cancel a job still waiting for an operation; returns 0 if it was not pending"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE jobs
+            SET state = 'cancelled', error = ?,
+                finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND state = 'pending'
+            RETURNING job_id
+        ''', (error, job_id))
+        cancelled = len(cursor.fetchall())
+        
+        conn.commit()
+        conn.close()
+        return cancelled
+    
+    def update_job_state(self, job_id, state, error=None):
+        """Record a job state transition"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        if state == 'done':
+            cursor.execute('SELECT operation, file_size, state FROM jobs WHERE job_id = ?', (job_id,))
+            job = cursor.fetchone()
+            if job and job['state'] != 'done':
+                self._count_finished_job(cursor, job)
+        
+        # Single statement per transition: attempts count runs, timestamps
+        # mark the first start and the terminal state; this instance holds
+        # the lease while the job is live
+        live = state in ('queued', 'downloading', 'encoding', 'uploading')
+        cursor.execute('''
+            UPDATE jobs
+            SET state = ?,
+                error = COALESCE(?, error),
+                attempts = attempts + (CASE WHEN ? = 'downloading' THEN 1 ELSE 0 END),
+                started_at = COALESCE(started_at, CASE WHEN ? = 'downloading' THEN CURRENT_TIMESTAMP END),
+                finished_at = CASE WHEN ? IN ('done', 'failed', 'cancelled') THEN CURRENT_TIMESTAMP END,
+                owner = ?,
+                lease_until = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        ''', (state, error, state, state, state, Config.INSTANCE_ID,
+              _utc_timestamp(Config.JOB_LEASE_SECONDS) if live else None, job_id))
+        
+        conn.commit()
+        conn.close()
+    
+    def renew_job_leases(self):
+        """Extend the lease of every live job this instance owns"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE jobs SET lease_until = ?
+            WHERE state IN ('queued', 'downloading', 'encoding', 'uploading') AND owner = ?
+        ''', (_utc_timestamp(Config.JOB_LEASE_SECONDS), Config.INSTANCE_ID))
+        
+        conn.commit()
+        conn.close()
+    
+    def requeue_interrupted_jobs(self, max_attempts):
+        """
+        Claim jobs whose instance died (lease ran out); fail those out of attempts
+        
+        Jobs of live instances sharing the store keep a fresh lease and are
+        left alone. Claimed jobs are queued under this instance's lease.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        now = _utc_timestamp()
+        
+        cursor.execute('''
+            UPDATE jobs
+            SET state = 'failed', error = 'Too many attempts', lease_until = NULL,
+                finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE state IN ('downloading', 'encoding', 'uploading') AND attempts >= ?
+                AND (lease_until IS NULL OR lease_until < ?)
+        ''', (max_attempts, now))
+        
+        # The lease is re-checked per row, so racing instances claim a job once
+        cursor.execute('''
+            UPDATE jobs
+            SET state = 'queued', owner = ?, lease_until = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE state IN ('queued', 'downloading', 'encoding', 'uploading')
+                AND (lease_until IS NULL OR lease_until < ?)
+            RETURNING job_id
+        ''', (Config.INSTANCE_ID, _utc_timestamp(Config.JOB_LEASE_SECONDS), now))
+        claimed = [row['job_id'] for row in cursor.fetchall()]
+        
+        jobs = []
+        for start in range(0, len(claimed), 500):
+            chunk = claimed[start:start + 500]
+            cursor.execute(
+                f"SELECT * FROM jobs WHERE job_id IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )
+            jobs.extend(dict(row) for row in cursor.fetchall())
+        jobs.sort(key=lambda job: str(job['created_at']))
+        
+        conn.commit()
+        conn.close()
+        return jobs
+    
+    def get_job_history(self, user_id=None, limit=50):
+        """Get finished jobs, newest first"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        query = '''
+            SELECT * FROM jobs
+            WHERE state IN ('done', 'failed', 'cancelled')
+        '''
+        params = []
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        query += ' ORDER BY finished_at DESC LIMIT ?'
+        params.append(limit)
+        
+        cursor.execute(query, params)
+        jobs = [dict(row) for row in cursor.fetchall()]
+        
+        conn.close()
+        return jobs
+    
+    # Statistics (counters and daily rollups kept up to date by the writes)
+    def _bump_stats(self, cursor, counters, daily=None):
+        """Add deltas to counters and to (day, name) daily rollups"""
+        cursor.executemany('''
+            INSERT INTO stats_counters (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + excluded.value
+        ''', [(name, delta) for name, delta in counters.items() if delta])
+        
+        cursor.executemany('''
+            INSERT INTO stats_daily (day, name, value) VALUES (?, ?, ?)
+            ON CONFLICT (day, name) DO UPDATE SET value = stats_daily.value + excluded.value
+        ''', [(day, name, delta) for (day, name), delta in (daily or {}).items() if delta])
+    
+    def _count_finished_job(self, cursor, job):
+        """Count a finished job by quality, and its source bytes"""
+        day = _utc_timestamp()[:10]
+        jobs_name = f"jobs_{(job['operation'] or 'unknown').replace('encode_', '')}"
+        size = job['file_size'] or 0
+        
+        self._bump_stats(
+            cursor,
+            {'jobs': 1, jobs_name: 1, 'bytes_processed': size},
+            {(day, 'jobs'): 1, (day, jobs_name): 1, (day, 'bytes_processed'): size}
+        )
+    
+    def _expire_premium_users(self, cursor):
+        """Delete expired premium rows and take them off the premium counter"""
+        cursor.execute('''
+            DELETE FROM premium_users
+            WHERE expiry_date <= CURRENT_TIMESTAMP
+            RETURNING user_id
+        ''')
+        expired = [row['user_id'] for row in cursor.fetchall()]
+        if expired:
+            self._bump_stats(cursor, {'premium_users': -len(expired)})
+        return expired
+    
+    def get_counter(self, name):
+        """Get a statistics counter"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT value FROM stats_counters WHERE name = ?', (name,))
         result = cursor.fetchone()
         
         conn.close()
-        return result['count']
+        return result['value'] if result else 0
+    
+    def get_total_users(self):
+        """Get total user count"""
+        self.flush_user_writes()
+        return self.get_counter('users')
+    
+    def _count_expired_premium(self, cursor):
+        """Count premium rows that expired since the last purge"""
+        cursor.execute('SELECT COUNT(*) AS count FROM premium_users WHERE expiry_date <= CURRENT_TIMESTAMP')
+        return cursor.fetchone()['count']
     
     def get_premium_count(self):
         """Get premium user count"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM premium_users
-            WHERE expiry_date IS NULL OR expiry_date > CURRENT_TIMESTAMP
-        ''')
+        cursor.execute("SELECT value FROM stats_counters WHERE name = 'premium_users'")
         result = cursor.fetchone()
+        expired = self._count_expired_premium(cursor)
+        
+        conn.close()
+        return (result['value'] if result else 0) - expired
+    
+    def get_stats(self, days=7):
+        """Get all counters and the daily rollups of the last `days` days"""
+        self.flush_user_writes()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT name, value FROM stats_counters')
+        counters = {row['name']: row['value'] for row in cursor.fetchall()}
+        counters['premium_users'] = counters.get('premium_users', 0) - self._count_expired_premium(cursor)
+        
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400))
+        cursor.execute('SELECT day, name, value FROM stats_daily WHERE day >= ? ORDER BY day', (since,))
+        daily = {}
+        for row in cursor.fetchall():
+            daily.setdefault(row['day'], {})[row['name']] = row['value']
         
         conn.close()
-        return result['count']
+        return {'counters': counters, 'daily': daily}
+
+
+class SettingsSnapshot:
+    """Immutable bot settings of one job, with the Database setting getters"""
+    
+    def __init__(self, settings):
+        self._settings = settings
+    
+    def get_bot_setting(self, key, default=None):
+        """Get bot setting as it was when the snapshot was taken"""
+        return self._settings.get(key, default)
+    
+    get_codec = Database.get_codec
+    get_preset = Database.get_preset
+    get_crf = Database.get_crf
+    get_audio_bitrate = Database.get_audio_bitrate
+    get_rate_control = Database.get_rate_control
+    get_per_title_crf = Database.get_per_title_crf
+
+
+class AsyncDatabase:
+    """
+    Awaitable facade over Database for handlers
+    
+    No call runs on the event loop, so it never waits on SQLite locks or
+    disk. Writes run on one dedicated thread: calls that queue up while it
+    is busy run together in one transaction, each in its own savepoint,
+    and are answered after the single commit. Reads (get_*, is_*,
+    settings_snapshot) skip that queue and the write lock and run on
+    reader threads, each on a plain pooled connection. The sync Database
+    stays usable.
+    """
+    
+    READ_PREFIXES = ('get_', 'is_', 'settings_snapshot')
+    
+    def __init__(self, database, batch_size=None):
+        self.db = database
+        self.batch_size = batch_size or Config.DB_WRITE_BATCH
+        self._queue = queue.SimpleQueue()
+        self._readers = ThreadPoolExecutor(Config.DB_POOL_SIZE, thread_name_prefix="database-read")
+        self._thread = threading.Thread(target=self._run, name="database", daemon=True)
+        self._thread.start()
+    
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+        
+        if name.startswith(self.READ_PREFIXES):
+            async def call(*args, **kwargs):
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._readers, partial(method, *args, **kwargs)
+                )
+        else:
+            async def call(*args, **kwargs):
+                future = asyncio.get_running_loop().create_future()
+                self._queue.put((method, args, kwargs, future))
+                return await future
+        
+        call.__name__ = name
+        return call
+    
+    def _run(self):
+        """Database thread: run queued calls in batches"""
+        while True:
+            calls = [self._queue.get()]
+            while len(calls) < self.batch_size:
+                try:
+                    calls.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            results = []
+            try:
+                with self.db.batch() as conn:
+                    for method, args, kwargs, _ in calls:
+                        # A failing call only rolls back its own savepoint
+                        conn.execute('SAVEPOINT call')
+                        try:
+                            results.append((method(*args, **kwargs), None))
+                            conn.execute('RELEASE call')
+                        except Exception as e:
+                            conn.execute('ROLLBACK TO call')
+                            conn.execute('RELEASE call')
+                            results.append((None, e))
+            except Exception as e:
+                # Commit failed: nothing in the batch was stored
+                results = [(None, e)] * len(calls)
+            
+            for (_, _, _, future), (result, error) in zip(calls, results):
+                try:
+                    future.get_loop().call_soon_threadsafe(self._resolve, future, result, error)
+                except RuntimeError:
+                    # The caller's event loop is already closed
+                    pass
+    
+    @staticmethod
+    def _resolve(future, result, error):
+        """Hand a call's outcome to its awaiting coroutine"""
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
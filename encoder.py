@@ -1,124 +1,716 @@
 import os
 import re
+import glob
+import shutil
+import math
+import time
+import signal
 import asyncio
 import subprocess
+from collections import deque
 from config import Config
-from database import Database
+from database import Database, get_async_database
+from metrics import metrics
+from profiles import video_codec_args, rate_control_args, peak_bitrate
+from tasks import TaskCancelled
 
 db = Database()
+# The CRF cache is read and written from the event loop
+adb = get_async_database(db)
+
+LINE_SPLIT = re.compile(rb'[\r\n]')
+
+
+class EncodeStalled(Exception):
+    """Raised when FFmpeg stopped making progress and was killed"""
+
+
+class StallWatchdog:
+    """Tracks progress events (out_time, frame, total_size) of one FFmpeg process"""
+    
+    def __init__(self, timeout, startup=0):
+        self.timeout = timeout
+        self.startup = max(timeout, startup)
+        self.stalled = False
+        self.progressed = False
+        self.last_out_time = 0
+        self.last_frame = 0
+        self.last_size = 0
+        self.last_advance = time.monotonic()
+    
+    def advance(self, out_time, frame=0, total_size=0):
+        """Record a progress event; counts if out_time, frame or total_size grew"""
+        if out_time > self.last_out_time or frame > self.last_frame or total_size > self.last_size:
+            self.last_out_time = max(self.last_out_time, out_time)
+            self.last_frame = max(self.last_frame, frame)
+            self.last_size = max(self.last_size, total_size)
+            self.last_advance = time.monotonic()
+            self.progressed = True
+    
+    def expired(self):
+        """Check if no progress was made within the timeout (startup grace before the first)"""
+        limit = self.timeout if self.progressed else self.startup
+        return bool(self.timeout) and time.monotonic() - self.last_advance > limit
 
 
 class VideoEncoder:
     """Video encoding class with FFmpeg"""
     
+    _encoders = None
+    
     def __init__(self):
         self.ffmpeg = Config.FFMPEG_PATH
         self.ffprobe = Config.FFPROBE_PATH
     
-    async def encode_video(self, input_file, quality, progress_callback=None):
+    async def encode_video(self, input_file, quality, progress_callback=None, cancel_token=None,
+                           cores=None, crf=None, crop=None, segment_time=None, settings=None,
+                           on_stall=None):
         """
         Encode video to specified quality
         
+        If FFmpeg stops advancing for ENCODE_STALL_TIMEOUT seconds it is
+        killed and the encode is retried once with the fallback profile.
+        With a core budget, decoder and encoder threads are sized to it
+        instead of every FFmpeg sizing itself to the whole machine. Codec
+        options come from profiles.video_codec_args, bitrate options from
+        the rate-control mode of the quality (profiles.rate_control_args).
+        
         Args:
             input_file: Path to input video
             quality: Target quality (144p, 240p, etc.)
-            progress_callback: Async callback function for progress updates
+            progress_callback: Callback for progress updates (plain function,
+                e.g. ProgressChannel.publish, or coroutine function)
+            cancel_token: Optional CancellationToken; kills FFmpeg when fired
+            cores: Optional list of CPU IDs budgeted for this encode
+            crf: CRF to use instead of the global one (e.g. from per_title_crf)
+            crop: Optional crop filter (from crop_filter) applied before scaling
+            segment_time: Encode straight into parts of this many seconds, with
+                keyframes forced at the cut points (see part_duration)
+            settings: Job's settings snapshot (default: current bot settings)
+            on_stall: Optional coroutine function awaited after a stalled
+                FFmpeg is killed and before its output is removed, e.g. to
+                stop an early upload that is still reading part 1
         
         Returns:
-            Path to encoded video
+            Path to encoded video, or list of part paths with segment_time
         """
         # Get quality settings
         preset = Config.QUALITY_PRESETS.get(quality, Config.QUALITY_PRESETS['480p'])
-        codec = db.get_codec()
-        ffmpeg_preset = db.get_preset()
-        crf = db.get_crf()
-        audio_bitrate = db.get_audio_bitrate()
+        settings = settings or db.settings_snapshot()
+        codec = settings.get_codec()
+        ffmpeg_preset = settings.get_preset()
+        if crf is None:
+            crf = settings.get_crf()
+        rate_control = settings.get_rate_control(quality)
+        audio_bitrate = settings.get_audio_bitrate()
         
         # Generate output filename
-        base_name = os.path.splitext(os.path.basename(input_file))[0]
-        output_file = os.path.join(
+        output_file = self.output_path(input_file, quality, parts=bool(segment_time))
+        
+        # Get video duration for progress calculation
+        duration = await self.get_duration(input_file)
+        width = int(preset['resolution'].split('x')[0])
+        
+        # Primary profile first, then one retry with the safer fallback
+        profiles = [
+            (codec, ffmpeg_preset),
+            (Config.FALLBACK_CODEC, Config.FALLBACK_PRESET)
+        ]
+        
+        for attempt, (codec, ffmpeg_preset) in enumerate(profiles):
+            if attempt:
+                # A searched CRF was tuned for the primary codec and preset
+                crf = settings.get_crf()
+            
+            # Build FFmpeg command
+            cmd = [self.ffmpeg]
+            if cores:
+                cmd += ['-threads', str(len(cores))]
+            cmd += ['-i', input_file]
+            cmd += video_codec_args(codec, ffmpeg_preset, width, len(cores) if cores else None)
+            cmd += rate_control_args(codec, rate_control, crf, preset['video_bitrate'])
+            cmd += self._size_args(preset['resolution'], crop)
+            cmd += [
+                '-c:a', 'aac',
+                '-b:a', audio_bitrate,
+                '-map', '0'
+            ]
+            if segment_time:
+                cmd += [
+                    '-force_key_frames', f"expr:gte(t,n_forced*{segment_time})",
+                    '-f', 'segment',
+                    '-segment_time', str(segment_time),
+                    '-segment_format', 'matroska',
+                    '-reset_timestamps', '1'
+                ]
+            cmd += ['-y', output_file]
+            
+            # Run FFmpeg with progress monitoring
+            try:
+                returncode, stderr = await self._run_ffmpeg(
+                    cmd, duration, progress_callback, cancel_token, output_file,
+                    cores=cores, on_stall=on_stall
+                )
+                break
+            except EncodeStalled:
+                metrics.inc('encode_stalls')
+                if attempt == len(profiles) - 1:
+                    metrics.inc('encode_stall_failures')
+                    raise
+                metrics.inc('encode_stall_retries')
+        
+        if returncode != 0:
+            self._remove_partial(output_file)
+            raise Exception(f"FFmpeg error: {stderr}")
+        
+        if segment_time:
+            return self.segment_files(output_file)
+        return output_file
+    
+    def output_path(self, input_file, quality, parts=False):
+        """Get encode output path; with parts, a %03d pattern for the segments"""
+        # A literal % would be read as part of the segment pattern
+        base_name = os.path.splitext(os.path.basename(input_file))[0].replace('%', '_')
+        suffix = "part%03d" if parts else "encoded"
+        return os.path.join(Config.ENCODE_DIR, f"{base_name}_{quality}_{suffix}.mkv")
+    
+    def segment_files(self, pattern):
+        """Get existing files of a %03d segment pattern, in order"""
+        return sorted(glob.glob(glob.escape(pattern).replace('%03d', '[0-9][0-9][0-9]')))
+    
+    def part_duration(self, quality, max_size, settings=None):
+        """
+        Get the part length that keeps an encode's parts under max_size
+        
+        Only bitrate-capped rate control has a known peak bitrate; pure CRF
+        output can only be split after encoding.
+        
+        Returns:
+            Seconds per part, or None if the peak bitrate is unknown
+        """
+        preset = Config.QUALITY_PRESETS.get(quality, Config.QUALITY_PRESETS['480p'])
+        settings = settings or db.settings_snapshot()
+        peak = peak_bitrate(settings.get_rate_control(quality), preset['video_bitrate'], settings.get_audio_bitrate())
+        if not peak:
+            return None
+        return max(1, int(max_size * Config.SPLIT_SIZE_MARGIN * 8 / peak))
+    
+    async def split_video(self, input_file, max_size, cancel_token=None):
+        """
+        Split a file into parts under max_size with stream copy
+        
+        Parts are cut at the first keyframe after each boundary. If uneven
+        bitrate leaves a part too large, the split is redone with more parts.
+        
+        Returns:
+            List of part paths ([input_file] if it already fits)
+        """
+        size = os.path.getsize(input_file)
+        if size <= max_size:
+            return [input_file]
+        
+        duration = await self.get_duration(input_file)
+        if duration <= 0:
+            raise Exception("Cannot split a file of unknown duration")
+        
+        pattern = os.path.join(
             Config.ENCODE_DIR,
-            f"{base_name}_{quality}_encoded.mkv"
+            f"{os.path.splitext(os.path.basename(input_file))[0].replace('%', '_')}_split%03d.mkv"
         )
+        count = math.ceil(size / (max_size * Config.SPLIT_SIZE_MARGIN))
+        
+        for _ in range(5):
+            cmd = [
+                self.ffmpeg,
+                '-i', input_file,
+                '-map', '0',
+                '-c', 'copy',
+                '-f', 'segment',
+                '-segment_time', f"{duration / count:.3f}",
+                '-segment_format', 'matroska',
+                '-reset_timestamps', '1',
+                '-y',
+                pattern
+            ]
+            
+            returncode, stderr = await self._run_ffmpeg(
+                cmd, cancel_token=cancel_token, output_file=pattern
+            )
+            if returncode != 0:
+                self._remove_partial(pattern)
+                raise Exception(f"Splitting failed: {stderr}")
+            
+            parts = self.segment_files(pattern)
+            if all(os.path.getsize(part) <= max_size for part in parts):
+                metrics.inc('outputs_split')
+                return parts
+            
+            # Keyframes fell badly for this part length; cut shorter parts
+            self._remove_partial(pattern)
+            count += 1
+        
+        raise Exception("Could not split the output under the size limit")
+    
+    async def per_title_crf(self, input_file, quality, file_unique_id=None,
+                            cancel_token=None, cores=None, crop=None, settings=None):
+        """
+        Pick a CRF for this source from sample encodes
+        
+        Short samples are encoded at CRF_SEARCH_STEP below, at and above the
+        global CRF in parallel and scored against the source with FFmpeg's
+        ssim/psnr filter. The highest CRF whose worst sample still meets
+        CRF_SEARCH_TARGET wins. Results are cached by file_unique_id.
+        
+        Returns:
+            CRF to encode with (the global CRF if the search fails)
+        """
+        settings = settings or db.settings_snapshot()
+        codec = settings.get_codec()
+        base_crf = settings.get_crf()
+        metric = Config.CRF_SEARCH_METRIC
+        target = Config.CRF_SEARCH_TARGET
+        # Everything besides the source that changes what a CRF looks like
+        profile = (codec, settings.get_preset(), settings.get_rate_control(quality), base_crf)
+        
+        # Cropped and uncropped encodes of one file score differently
+        if file_unique_id and crop:
+            file_unique_id = f"{file_unique_id}:{crop}"
+        
+        if file_unique_id:
+            cached = await adb.get_cached_crf(file_unique_id, quality, *profile, metric, target)
+            if cached is not None:
+                metrics.inc('crf_search_cache_hits')
+                return cached
         
-        # Get video duration for progress calculation
         duration = await self.get_duration(input_file)
+        if duration <= 0:
+            return base_crf
+        
+        # Evenly spaced samples, skipping the very start and end
+        sample_seconds = min(Config.CRF_SAMPLE_SECONDS, duration)
+        count = Config.CRF_SAMPLE_COUNT if duration > sample_seconds * 2 else 1
+        positions = [
+            max(0, duration * (i + 1) / (count + 1) - sample_seconds / 2)
+            for i in range(count)
+        ]
+        
+        step = Config.CRF_SEARCH_STEP
+        candidates = sorted({max(0, base_crf - step), base_crf, min(51, base_crf + step)})
+        threads = max(1, len(cores) // len(candidates)) if cores else None
+        
+        try:
+            scores = await asyncio.gather(*[
+                self._score_crf(input_file, quality, crf, positions, sample_seconds, settings,
+                                threads, cancel_token, crop)
+                for crf in candidates
+            ])
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            print(f"CRF search failed for {input_file}: {e}")
+            metrics.inc('crf_search_failures')
+            return base_crf
+        
+        metrics.inc('crf_searches')
+        
+        # Highest CRF meeting the target, else the best quality we tried
+        chosen, chosen_score = candidates[0], scores[0]
+        for crf, score in zip(candidates, scores):
+            if score >= target:
+                chosen, chosen_score = crf, score
+        
+        if file_unique_id:
+            await adb.cache_crf(file_unique_id, quality, *profile, metric, target, chosen, chosen_score)
+        return chosen
+    
+    async def _score_crf(self, input_file, quality, crf, positions, sample_seconds, settings,
+                         threads=None, cancel_token=None, crop=None):
+        """Encode samples at one CRF and return the worst ssim/psnr score"""
+        preset = Config.QUALITY_PRESETS.get(quality, Config.QUALITY_PRESETS['480p'])
+        codec = settings.get_codec()
+        width, height = preset['resolution'].split('x')
+        metric = Config.CRF_SEARCH_METRIC
+        base_name = os.path.splitext(os.path.basename(input_file))[0]
+        worst = None
+        
+        for index, position in enumerate(positions):
+            sample_file = os.path.join(Config.ENCODE_DIR, f"{base_name}_{quality}_crf{crf}_{index}.mkv")
+            
+            encode_cmd = [self.ffmpeg]
+            if threads:
+                encode_cmd += ['-threads', str(threads)]
+            encode_cmd += ['-ss', str(position), '-t', str(sample_seconds), '-i', input_file]
+            encode_cmd += video_codec_args(codec, settings.get_preset(), int(width), threads)
+            encode_cmd += rate_control_args(codec, settings.get_rate_control(quality), crf, preset['video_bitrate'])
+            encode_cmd += self._size_args(preset['resolution'], crop)
+            encode_cmd += ['-an', '-sn', '-y', sample_file]
+            
+            # Score against the source cropped and scaled like the sample
+            reference = self._size_args(preset['resolution'], crop)[1] if crop else f"scale={width}:{height}"
+            score_cmd = [
+                self.ffmpeg,
+                '-i', sample_file,
+                '-ss', str(position), '-t', str(sample_seconds), '-i', input_file,
+                '-lavfi', f"[1:v]{reference},format=yuv420p[ref];"
+                          f"[0:v]format=yuv420p[dist];[dist][ref]{metric}",
+                '-f', 'null', '-'
+            ]
+            
+            try:
+                returncode, stderr = await self._run_ffmpeg(
+                    encode_cmd, cancel_token=cancel_token, output_file=sample_file
+                )
+                if returncode != 0:
+                    raise Exception(f"Sample encode failed: {stderr}")
+                
+                returncode, stderr = await self._run_ffmpeg(score_cmd, cancel_token=cancel_token)
+                score = self._parse_score(stderr, metric)
+                if returncode != 0 or score is None:
+                    raise Exception(f"Sample scoring failed: {stderr}")
+            finally:
+                self._remove_partial(sample_file)
+            
+            worst = score if worst is None else min(worst, score)
         
-        # Build FFmpeg command
+        return worst
+    
+    def _parse_score(self, stderr, metric):
+        """Parse the summary line of the ssim or psnr filter"""
+        pattern = r'All:([\d.]+)' if metric == 'ssim' else r'average:([\d.]+|inf)'
+        matches = re.findall(pattern, stderr)
+        if not matches:
+            return None
+        return 100.0 if matches[-1] == 'inf' else float(matches[-1])
+    
+    def _size_args(self, resolution, crop=None):
+        """Get output size options, cropping first and keeping the aspect ratio"""
+        if not crop:
+            return ['-s', resolution]
+        
+        width, height = resolution.split('x')
+        return ['-vf', f"{crop},scale={width}:{height}:force_original_aspect_ratio=decrease:force_divisible_by=2"]
+    
+    async def crop_filter(self, input_file, mode, cancel_token=None):
+        """
+        Get the crop filter for a user's crop mode
+        
+        Args:
+            input_file: Path to input video
+            mode: 'off', 'auto' (remove black bars) or an aspect ratio like '16:9'
+            cancel_token: Optional CancellationToken
+        
+        Returns:
+            FFmpeg crop filter or None
+        """
+        if not mode or mode == 'off':
+            return None
+        
+        if mode == 'auto':
+            rect = await self.detect_crop(input_file, cancel_token)
+            return f"crop={rect}" if rect else None
+        
+        # Centered crop to the aspect ratio, even dimensions for 4:2:0
+        num, den = mode.split(':')
+        return (
+            f"crop='trunc(min(iw,ih*{num}/{den})/2)*2':"
+            f"'trunc(min(ih,iw*{den}/{num})/2)*2'"
+        )
+    
+    async def detect_crop(self, input_file, cancel_token=None):
+        """
+        Find black bars with cropdetect on a few seeked samples
+        
+        Each sample decodes CROP_SAMPLE_FRAMES frames. The crop is the union
+        of all detected rectangles, so a dark scene cannot cut into the
+        picture, and is dropped if it removes less than CROP_MIN_BORDER of
+        the frame.
+        
+        Returns:
+            Crop rectangle 'w:h:x:y' or None
+        """
+        try:
+            info = await self.get_media_info(input_file)
+        except ValueError:
+            return None
+        
+        video = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'), None)
+        duration = float(info.get('format', {}).get('duration') or 0)
+        if not video or not video.get('width') or not video.get('height'):
+            return None
+        
+        frame_width, frame_height = video['width'], video['height']
+        count = Config.CROP_SAMPLE_COUNT
+        positions = [duration * (i + 1) / (count + 1) for i in range(count)] if duration else [0]
+        
+        rects = await asyncio.gather(*[
+            self._cropdetect_at(input_file, position, cancel_token) for position in positions
+        ])
+        
+        # Skip samples that were fully black or unreadable
+        rects = [r for r in rects if r and r[0] > frame_width // 4 and r[1] > frame_height // 4]
+        if not rects:
+            return None
+        
+        left = min(r[2] for r in rects)
+        top = min(r[3] for r in rects)
+        right = max(r[2] + r[0] for r in rects)
+        bottom = max(r[3] + r[1] for r in rects)
+        width, height = right - left, bottom - top
+        
+        min_border = Config.CROP_MIN_BORDER
+        if width > frame_width * (1 - min_border) and height > frame_height * (1 - min_border):
+            return None
+        
+        return f"{width - width % 2}:{height - height % 2}:{left}:{top}"
+    
+    async def _cropdetect_at(self, input_file, position, cancel_token=None):
+        """Run cropdetect on a few frames from position; returns (w, h, x, y)"""
         cmd = [
             self.ffmpeg,
+            '-ss', str(position),
             '-i', input_file,
-            '-c:v', codec,
-            '-preset', ffmpeg_preset,
-            '-crf', str(crf),
-            '-s', preset['resolution'],
-            '-b:v', preset['video_bitrate'],
-            '-c:a', 'aac',
-            '-b:a', audio_bitrate,
-            '-map', '0',
-            '-y',
-            output_file
+            '-frames:v', str(Config.CROP_SAMPLE_FRAMES),
+            '-vf', 'cropdetect=limit=24:round=2:reset=0',
+            '-an', '-sn',
+            '-f', 'null', '-'
         ]
         
-        # Run FFmpeg with progress monitoring
+        try:
+            _, stderr = await self._run_ffmpeg(cmd, cancel_token=cancel_token)
+        except TaskCancelled:
+            raise
+        except Exception:
+            return None
+        
+        matches = re.findall(r'crop=(-?\d+):(-?\d+):(\d+):(\d+)', stderr)
+        return tuple(map(int, matches[-1])) if matches else None
+    
+    async def available_encoders(self):
+        """Get video encoders this FFmpeg build provides (cached)"""
+        if VideoEncoder._encoders is None:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    self.ffmpeg, '-hide_banner', '-encoders',
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL
+                )
+                stdout, _ = await process.communicate()
+            except OSError:
+                return set()
+            
+            # Lines look like " V....D libx264   libx264 H.264 ..."; skip the legend
+            VideoEncoder._encoders = {
+                parts[1] for parts in (line.split() for line in stdout.decode(errors='replace').splitlines())
+                if len(parts) > 2 and parts[0].startswith('V') and parts[1] != '='
+            }
+        return VideoEncoder._encoders
+    
+    async def _run_ffmpeg(self, cmd, duration=0, progress_callback=None,
+                          cancel_token=None, output_file=None,
+                          stall_timeout=None, cores=None, on_stall=None):
+        """
+        Run an FFmpeg command in its own process group
+        
+        The process group is killed as soon as cancel_token fires or the
+        calling task is cancelled, and the partial output file is removed.
+        A watchdog kills it when out_time, frame and total_size all stop
+        advancing for stall_timeout seconds (default
+        Config.ENCODE_STALL_TIMEOUT, Config.ENCODE_STALL_STARTUP before the
+        first progress), awaits on_stall, removes the partial output and
+        raises EncodeStalled.
+        The process is pinned to `cores` and reniced as configured.
+        
+        Returns:
+            Tuple of (returncode, tail of stderr)
+        """
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        
+        if stall_timeout is None:
+            stall_timeout = Config.ENCODE_STALL_TIMEOUT
+        
+        # Machine-readable progress on stdout, plain log lines on stderr
+        cmd = self._cpu_policy(cores) + [cmd[0], '-progress', 'pipe:1', '-nostats'] + list(cmd[1:])
+        
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
         )
         
-        # Monitor progress
-        if progress_callback:
+        unregister = None
+        if cancel_token:
+            unregister = cancel_token.on_cancel(lambda: self._kill_process_group(process))
+        
+        # Always drain both pipes, otherwise FFmpeg blocks once one fills up
+        watchdog = StallWatchdog(stall_timeout, Config.ENCODE_STALL_STARTUP)
+        stderr_tail = deque(maxlen=20)
+        helpers = [
             asyncio.create_task(
-                self._monitor_progress(process, duration, progress_callback)
+                self._monitor_progress(process, duration, progress_callback, watchdog)
+            ),
+            asyncio.create_task(self._drain_stderr(process, stderr_tail)),
+            asyncio.create_task(self._watch_stall(process, watchdog))
+        ]
+        
+        try:
+            await process.wait()
+            await asyncio.gather(*helpers[:2])
+        except asyncio.CancelledError:
+            self._kill_process_group(process)
+            self._remove_partial(output_file)
+            raise
+        finally:
+            for helper in helpers:
+                helper.cancel()
+            if unregister:
+                unregister()
+        
+        if cancel_token and cancel_token.cancelled:
+            self._remove_partial(output_file)
+            raise TaskCancelled("Task cancelled by user")
+        
+        if watchdog.stalled:
+            # Let readers of the partial output finish before it goes away
+            if on_stall:
+                await on_stall()
+            self._remove_partial(output_file)
+            raise EncodeStalled(
+                f"FFmpeg made no progress for {stall_timeout}s "
+                f"(stuck at {self._format_time(int(watchdog.last_out_time))})"
             )
         
-        # Wait for completion
-        await process.wait()
+        return process.returncode, '\n'.join(stderr_tail)
+    
+    def _cpu_policy(self, cores):
+        """
+        Build a taskset/nice command prefix pinning FFmpeg to its cores and renicing it
         
-        if process.returncode != 0:
-            stderr = await process.stderr.read()
-            raise Exception(f"FFmpeg error: {stderr.decode()}")
+        Both exec into FFmpeg, so every thread it creates inherits the mask
+        and priority; setting them after spawn only reaches the thread whose
+        TID equals the PID. Tools that are not installed are skipped.
+        """
+        prefix = []
+        if cores and Config.ENCODE_CPU_AFFINITY and shutil.which('taskset'):
+            prefix += ['taskset', '-c', ','.join(str(core) for core in cores)]
+        if Config.ENCODE_NICE and shutil.which('nice'):
+            prefix += ['nice', '-n', str(Config.ENCODE_NICE)]
+        return prefix
+    
+    def _kill_process_group(self, process):
+        """Kill FFmpeg together with any child processes it spawned"""
+        if process.returncode is not None:
+            return
         
-        return output_file
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
     
-    async def _monitor_progress(self, process, total_duration, callback):
-        """Monitor FFmpeg progress and call callback"""
-        pattern = re.compile(r'time=(\d+):(\d+):(\d+\.\d+)')
+    def _remove_partial(self, output_file):
+        """Remove a partially written output file (or all files of a %03d pattern)"""
+        if not output_file:
+            return
+        
+        paths = self.segment_files(output_file) if '%03d' in output_file else [output_file]
+        for path in paths:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                pass
+    
+    async def _watch_stall(self, process, watchdog):
+        """Kill FFmpeg once it has made no progress for too long"""
+        if not watchdog.timeout:
+            return
+        
+        while process.returncode is None:
+            await asyncio.sleep(min(5, watchdog.timeout))
+            if watchdog.expired():
+                watchdog.stalled = True
+                self._kill_process_group(process)
+                return
+    
+    async def _drain_stderr(self, process, stderr_tail):
+        """Keep the last stderr lines for error messages"""
+        buffer = b''
         
         while True:
-            line = await process.stderr.readline()
+            chunk = await process.stderr.read(4096)
+            if not chunk:
+                break
+            
+            *lines, buffer = LINE_SPLIT.split(buffer + chunk)
+            for line in lines:
+                if line:
+                    stderr_tail.append(line.decode('utf-8', errors='ignore'))
+    
+    async def _monitor_progress(self, process, total_duration, callback, watchdog):
+        """Parse FFmpeg -progress output, feed the watchdog and call callback"""
+        fields = {}
+        
+        while True:
+            line = await process.stdout.readline()
             if not line:
                 break
             
-            line = line.decode('utf-8', errors='ignore')
-            match = pattern.search(line)
+            key, _, value = line.decode('utf-8', errors='ignore').strip().partition('=')
+            if key != 'progress':
+                fields[key] = value
+                continue
             
-            if match:
-                hours, minutes, seconds = map(float, match.groups())
-                current_time = hours * 3600 + minutes * 60 + seconds
-                
-                if total_duration > 0:
-                    percentage = min((current_time / total_duration) * 100, 100)
-                else:
-                    percentage = 0
-                
-                # Extract speed
-                speed_match = re.search(r'speed=\s*(\S+)x', line)
-                speed = speed_match.group(1) + 'x' if speed_match else '0x'
-                
-                # Calculate time left
-                time_left = self._calculate_time_left(current_time, total_duration, speed)
-                
-                # Call callback
-                if callback:
-                    await callback({
-                        'percentage': percentage,
-                        'current_time': current_time,
-                        'total_duration': total_duration,
-                        'speed': speed,
-                        'time_left': time_left
-                    })
+            # One progress block is complete
+            current_time = self._parse_out_time(fields.get('out_time_us'))
+            watchdog.advance(
+                current_time,
+                self._parse_count(fields.get('frame')),
+                self._parse_count(fields.get('total_size'))
+            )
+            
+            if not callback:
+                continue
+            
+            if total_duration > 0:
+                percentage = min((current_time / total_duration) * 100, 100)
+            else:
+                percentage = 0
+            
+            speed = fields.get('speed', '0x').strip()
+            if not speed.endswith('x'):
+                speed = '0x'
+            
+            # Calculate time left
+            time_left = self._calculate_time_left(current_time, total_duration, speed)
+            
+            # Call callback (sync publishers return None)
+            result = callback({
+                'percentage': percentage,
+                'current_time': current_time,
+                'total_duration': total_duration,
+                'speed': speed,
+                'time_left': time_left
+            })
+            if asyncio.iscoroutine(result):
+                await result
+    
+    def _parse_out_time(self, out_time_us):
+        """Convert FFmpeg out_time_us to seconds"""
+        try:
+            return max(int(out_time_us) / 1000000, 0)
+        except (TypeError, ValueError):
+            return 0
+    
+    def _parse_count(self, value):
+        """Convert an FFmpeg frame or total_size field to int (N/A is 0)"""
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return 0
     
     def _calculate_time_left(self, current, total, speed_str):
         """Calculate estimated time remaining"""
@@ -183,7 +775,7 @@ class VideoEncoder:
         import json
         return json.loads(stdout.decode())
     
-    async def compress_video(self, input_file, percentage, progress_callback=None):
+    async def compress_video(self, input_file, percentage, progress_callback=None, cancel_token=None):
         """Compress video by percentage"""
         # Calculate target bitrate
         info = await self.get_media_info(input_file)
@@ -208,25 +800,16 @@ class VideoEncoder:
             output_file
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        returncode, _ = await self._run_ffmpeg(
+            cmd, duration, progress_callback, cancel_token, output_file
         )
         
-        if progress_callback:
-            asyncio.create_task(
-                self._monitor_progress(process, duration, progress_callback)
-            )
-        
-        await process.wait()
-        
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception("Compression failed")
         
         return output_file
     
-    async def add_watermark(self, input_file, watermark_text, progress_callback=None):
+    async def add_watermark(self, input_file, watermark_text, progress_callback=None, cancel_token=None):
         """Add text watermark to video"""
         output_file = os.path.join(
             Config.ENCODE_DIR,
@@ -247,25 +830,16 @@ class VideoEncoder:
             output_file
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        returncode, _ = await self._run_ffmpeg(
+            cmd, duration, progress_callback, cancel_token, output_file
         )
         
-        if progress_callback:
-            asyncio.create_task(
-                self._monitor_progress(process, duration, progress_callback)
-            )
-        
-        await process.wait()
-        
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception("Watermark addition failed")
         
         return output_file
     
-    async def add_subtitle(self, input_file, subtitle_file, hard=False, progress_callback=None):
+    async def add_subtitle(self, input_file, subtitle_file, hard=False, progress_callback=None, cancel_token=None):
         """Add subtitles to video"""
         output_file = os.path.join(
             Config.ENCODE_DIR,
@@ -296,25 +870,16 @@ class VideoEncoder:
                 output_file
             ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        returncode, _ = await self._run_ffmpeg(
+            cmd, duration, progress_callback, cancel_token, output_file
         )
         
-        if progress_callback:
-            asyncio.create_task(
-                self._monitor_progress(process, duration, progress_callback)
-            )
-        
-        await process.wait()
-        
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception("Subtitle addition failed")
         
         return output_file
     
-    async def extract_audio(self, input_file, progress_callback=None):
+    async def extract_audio(self, input_file, progress_callback=None, cancel_token=None):
         """Extract audio from video as MP3"""
         output_file = os.path.join(
             Config.ENCODE_DIR,
@@ -333,25 +898,16 @@ class VideoEncoder:
             output_file
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        returncode, _ = await self._run_ffmpeg(
+            cmd, duration, progress_callback, cancel_token, output_file
         )
         
-        if progress_callback:
-            asyncio.create_task(
-                self._monitor_progress(process, duration, progress_callback)
-            )
-        
-        await process.wait()
-        
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception("Audio extraction failed")
         
         return output_file
     
-    async def trim_video(self, input_file, start_time, end_time, progress_callback=None):
+    async def trim_video(self, input_file, start_time, end_time, progress_callback=None, cancel_token=None):
         """Trim video between start and end time"""
         output_file = os.path.join(
             Config.ENCODE_DIR,
@@ -368,28 +924,26 @@ class VideoEncoder:
             output_file
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        returncode, _ = await self._run_ffmpeg(
+            cmd, cancel_token=cancel_token, output_file=output_file
         )
         
-        await process.wait()
-        
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception("Video trimming failed")
         
         return output_file
     
-    async def merge_videos(self, input_files, progress_callback=None):
+    async def merge_videos(self, input_files, progress_callback=None, cancel_token=None,
+                           output_file=None):
         """Merge multiple videos into one"""
-        # Create concat file
-        concat_file = os.path.join(Config.ENCODE_DIR, "concat_list.txt")
+        if output_file is None:
+            output_file = os.path.join(Config.ENCODE_DIR, "merged_video.mkv")
+        
+        # Create concat file next to the output so merges do not collide
+        concat_file = f"{os.path.splitext(output_file)[0]}_concat.txt"
         with open(concat_file, 'w') as f:
             for file in input_files:
-                f.write(f"file '{file}'\n")
-        
-        output_file = os.path.join(Config.ENCODE_DIR, "merged_video.mkv")
+                f.write(f"file '{os.path.abspath(file)}'\n")
         
         cmd = [
             self.ffmpeg,
@@ -401,23 +955,20 @@ class VideoEncoder:
             output_file
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        await process.wait()
-        
-        # Cleanup
-        os.remove(concat_file)
+        try:
+            returncode, _ = await self._run_ffmpeg(
+                cmd, cancel_token=cancel_token, output_file=output_file
+            )
+        finally:
+            # Cleanup
+            os.remove(concat_file)
         
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception("Video merging failed")
         
         return output_file
     
-    async def extract_thumbnail(self, input_file, time="00:00:01"):
+    async def extract_thumbnail(self, input_file, time="00:00:01", cancel_token=None):
         """Extract thumbnail from video"""
         output_file = os.path.join(
             Config.THUMB_DIR,
@@ -434,15 +985,11 @@ class VideoEncoder:
             output_file
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        returncode, _ = await self._run_ffmpeg(
+            cmd, cancel_token=cancel_token, output_file=output_file
         )
         
-        await process.wait()
-        
-        if process.returncode != 0:
+        if returncode != 0:
             raise Exception("Thumbnail extraction failed")
         
         return output_file
@@ -1,12 +1,17 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from config import Config
-from database import Database
+from database import Database, get_async_database
 from encoder import VideoEncoder
+from metrics import metrics
+from pipeline import pools
+from profiles import CODECS, OPTIONAL_CODECS, RATE_CONTROL_MODES
 from utils import is_admin, format_size, format_time
 import os
 
 db = Database()
+# Handlers await queries on the database thread instead of blocking the loop
+adb = get_async_database(db)
 encoder = VideoEncoder()
 
 
@@ -29,27 +34,30 @@ async def set_codec_command(client, message: Message):
     """Set encoding codec (admin only)"""
     args = message.text.split(maxsplit=1)
     
+    # SVT-AV1 is only offered when this FFmpeg build has it
+    available = await encoder.available_encoders()
+    valid_codecs = [
+        name for name in CODECS
+        if name not in OPTIONAL_CODECS or name in available
+    ]
+    
     if len(args) < 2:
-        current_codec = db.get_codec()
-        await message.reply_text(
-            f"**Current Codec:** `{current_codec}`\n\n"
-            "**Available Codecs:**\n"
-            "├ `libx264` - H.264 (fast, compatible)\n"
-            "├ `libx265` - H.265/HEVC (better compression)\n"
-            "├ `libvpx-vp9` - VP9 (web-friendly)\n"
-            "└ `libaom-av1` - AV1 (best compression)\n\n"
-            "**Usage:** `/codec libx265`"
-        )
+        current_codec = await adb.get_codec()
+        text = f"**Current Codec:** `{current_codec}`\n\n**Available Codecs:**\n"
+        for index, name in enumerate(valid_codecs):
+            branch = "└" if index == len(valid_codecs) - 1 else "├"
+            text += f"{branch} `{name}` - {CODECS[name]}\n"
+        text += "\n**Usage:** `/codec libx265`"
+        await message.reply_text(text)
         return
     
     codec = args[1].strip()
-    valid_codecs = ['libx264', 'libx265', 'libvpx-vp9', 'libaom-av1', 'mpeg4']
     
     if codec not in valid_codecs:
         await message.reply_text(f"❌ Invalid codec! Choose from: {', '.join(valid_codecs)}")
         return
     
-    db.set_codec(codec)
+    await adb.set_codec(codec)
     await message.reply_text(f"✅ Codec set to: `{codec}`")
 
 
@@ -60,7 +68,7 @@ async def set_preset_command(client, message: Message):
     args = message.text.split(maxsplit=1)
     
     if len(args) < 2:
-        current_preset = db.get_preset()
+        current_preset = await adb.get_preset()
         await message.reply_text(
             f"**Current Preset:** `{current_preset}`\n\n"
             "**Available Presets:**\n"
@@ -73,6 +81,7 @@ async def set_preset_command(client, message: Message):
             "├ `slow` - Slower (better quality)\n"
             "├ `slower` - Very slow\n"
             "└ `veryslow` - Slowest (best quality)\n\n"
+            "VP9/AV1 map these to their own speed settings.\n\n"
             "**Usage:** `/preset medium`"
         )
         return
@@ -84,7 +93,7 @@ async def set_preset_command(client, message: Message):
         await message.reply_text(f"❌ Invalid preset! Choose from: {', '.join(valid_presets)}")
         return
     
-    db.set_preset(preset)
+    await adb.set_preset(preset)
     await message.reply_text(f"✅ Preset set to: `{preset}`")
 
 
@@ -95,7 +104,7 @@ async def set_crf_command(client, message: Message):
     args = message.text.split(maxsplit=1)
     
     if len(args) < 2:
-        current_crf = db.get_crf()
+        current_crf = await adb.get_crf()
         await message.reply_text(
             f"**Current CRF:** `{current_crf}`\n\n"
             "**CRF Range:** 0-51\n"
@@ -118,10 +127,78 @@ async def set_crf_command(client, message: Message):
         await message.reply_text("❌ CRF must be a number between 0 and 51!")
         return
     
-    db.set_crf(crf)
+    await adb.set_crf(crf)
     await message.reply_text(f"✅ CRF set to: `{crf}`")
 
 
+@Client.on_message(filters.command("pertitle") & filters.private)
+@admin_only
+async def per_title_crf_command(client, message: Message):
+    """Toggle per-title CRF search (admin only)"""
+    args = message.text.split(maxsplit=1)
+    
+    if len(args) < 2:
+        status = "on" if await adb.get_per_title_crf() else "off"
+        await message.reply_text(
+            f"**Per-Title CRF:** `{status}`\n\n"
+            "When on, short samples of each file are encoded at a few CRF "
+            f"values around the global CRF and the highest CRF reaching "
+            f"{Config.CRF_SEARCH_METRIC.upper()} {Config.CRF_SEARCH_TARGET:g} is used.\n\n"
+            "**Usage:** `/pertitle on` or `/pertitle off`"
+        )
+        return
+    
+    value = args[1].strip().lower()
+    if value not in ('on', 'off'):
+        await message.reply_text("❌ Use `/pertitle on` or `/pertitle off`")
+        return
+    
+    await adb.set_per_title_crf(value == 'on')
+    await message.reply_text(f"✅ Per-title CRF turned {value}")
+
+
+@Client.on_message(filters.command("ratecontrol") & filters.private)
+@admin_only
+async def set_rate_control_command(client, message: Message):
+    """Set rate-control mode globally or per quality (admin only)"""
+    args = message.text.split()[1:]
+    
+    if not args:
+        text = f"**Rate Control:** `{await adb.get_rate_control()}`\n\n**Per Quality:**\n"
+        for quality in Config.QUALITY_PRESETS:
+            text += f"├ {quality}: `{await adb.get_rate_control(quality)}`\n"
+        text += "\n**Modes:**\n"
+        for mode, description in RATE_CONTROL_MODES.items():
+            text += f"├ `{mode}` - {description}\n"
+        text += (
+            "\n**Usage:**\n"
+            "`/ratecontrol capped_crf` - Set for all qualities\n"
+            "`/ratecontrol 1080p abr` - Set for one quality\n"
+            "`/ratecontrol 1080p default` - Use the global mode again"
+        )
+        await message.reply_text(text)
+        return
+    
+    quality = args[0] if len(args) == 2 else None
+    mode = args[-1]
+    
+    if quality and quality not in Config.QUALITY_PRESETS:
+        await message.reply_text(f"❌ Invalid quality! Choose from: {', '.join(Config.QUALITY_PRESETS)}")
+        return
+    
+    if quality and mode == 'default':
+        await adb.set_rate_control(None, quality)
+        await message.reply_text(f"✅ {quality} now uses the global rate control: `{await adb.get_rate_control()}`")
+        return
+    
+    if mode not in RATE_CONTROL_MODES:
+        await message.reply_text(f"❌ Invalid mode! Choose from: {', '.join(RATE_CONTROL_MODES)}")
+        return
+    
+    await adb.set_rate_control(mode, quality)
+    await message.reply_text(f"✅ Rate control {'for ' + quality + ' ' if quality else ''}set to: `{mode}`")
+
+
 @Client.on_message(filters.command("audio") & filters.private)
 @admin_only
 async def set_audio_bitrate_command(client, message: Message):
@@ -129,7 +206,7 @@ async def set_audio_bitrate_command(client, message: Message):
     args = message.text.split(maxsplit=1)
     
     if len(args) < 2:
-        current_bitrate = db.get_audio_bitrate()
+        current_bitrate = await adb.get_audio_bitrate()
         await message.reply_text(
             f"**Current Audio Bitrate:** `{current_bitrate}`\n\n"
             "**Common Bitrates:**\n"
@@ -149,7 +226,7 @@ async def set_audio_bitrate_command(client, message: Message):
         await message.reply_text("❌ Invalid format! Use format like: 128k, 192k, 320k")
         return
     
-    db.set_audio_bitrate(bitrate)
+    await adb.set_audio_bitrate(bitrate)
     await message.reply_text(f"✅ Audio bitrate set to: `{bitrate}`")
 
 
@@ -177,7 +254,7 @@ async def add_premium_user_command(client, message: Message):
             from datetime import datetime, timedelta
             expiry_date = datetime.now() + timedelta(days=days)
         
-        db.add_premium_user(user_id, message.from_user.id, expiry_date)
+        await adb.add_premium_user(user_id, message.from_user.id, expiry_date)
         
         expiry_text = f"for {days} days" if days else "permanently"
         await message.reply_text(f"✅ User {user_id} added to premium {expiry_text}!")
@@ -211,7 +288,7 @@ async def remove_premium_user_command(client, message: Message):
     
     try:
         user_id = int(args[1])
-        db.remove_premium_user(user_id)
+        await adb.remove_premium_user(user_id)
         await message.reply_text(f"✅ User {user_id} removed from premium!")
         
         # Notify user
@@ -234,7 +311,7 @@ async def remove_premium_user_command(client, message: Message):
 @admin_only
 async def list_premium_users_command(client, message: Message):
     """List all premium users (admin only)"""
-    users = db.get_all_premium_users()
+    users = await adb.get_all_premium_users()
     
     if not users:
         await message.reply_text("📭 No premium users found!")
@@ -270,7 +347,7 @@ async def add_force_subscribe_channel_command(client, message: Message):
         # Get channel info
         chat = await client.get_chat(channel)
         
-        db.add_force_subscribe_channel(
+        await adb.add_force_subscribe_channel(
             chat.id,
             f"https://t.me/{chat.username}" if chat.username else "",
             chat.title
@@ -298,7 +375,7 @@ async def delete_force_subscribe_channel_command(client, message: Message):
     
     try:
         channel_id = int(args[1])
-        db.remove_force_subscribe_channel(channel_id)
+        await adb.remove_force_subscribe_channel(channel_id)
         await message.reply_text(f"✅ Channel removed from force subscribe!")
     
     except ValueError:
@@ -311,7 +388,7 @@ async def delete_force_subscribe_channel_command(client, message: Message):
 @admin_only
 async def list_force_subscribe_channels_command(client, message: Message):
     """List all force subscribe channels (admin only)"""
-    channels = db.get_force_subscribe_channels()
+    channels = await adb.get_force_subscribe_channels()
     
     if not channels:
         await message.reply_text("📭 No force subscribe channels!")
@@ -333,7 +410,7 @@ async def set_fsub_mode_command(client, message: Message):
     args = message.text.split()
     
     if len(args) < 2:
-        current_mode = db.get_fsub_mode()
+        current_mode = await adb.get_fsub_mode()
         await message.reply_text(
             f"**Current Mode:** `{current_mode}`\n\n"
             "**Usage:** `/fsub_mode on` or `/fsub_mode off`"
@@ -346,7 +423,7 @@ async def set_fsub_mode_command(client, message: Message):
         await message.reply_text("❌ Mode must be 'on' or 'off'!")
         return
     
-    db.set_fsub_mode(mode)
+    await adb.set_fsub_mode(mode)
     await message.reply_text(f"✅ Force subscribe mode set to: `{mode}`")
 
 
@@ -356,7 +433,7 @@ async def set_start_picture_command(client, message: Message):
     """Set start picture (admin only)"""
     if message.reply_to_message and message.reply_to_message.photo:
         file_id = message.reply_to_message.photo.file_id
-        db.set_start_picture(file_id)
+        await adb.set_start_picture(file_id)
         await message.reply_text("✅ Start picture updated!")
     else:
         await message.reply_text("❌ Please reply to a photo with this command!")
@@ -366,7 +443,7 @@ async def set_start_picture_command(client, message: Message):
 @admin_only
 async def get_start_picture_command(client, message: Message):
     """Get current start picture (admin only)"""
-    pic = db.get_start_picture()
+    pic = await adb.get_start_picture()
     
     if pic:
         await message.reply_photo(pic, caption="**Current Start Picture**")
@@ -378,10 +455,97 @@ async def get_start_picture_command(client, message: Message):
 @admin_only
 async def delete_start_picture_command(client, message: Message):
     """Delete start picture (admin only)"""
-    db.set_start_picture("")
+    await adb.set_start_picture("")
     await message.reply_text("✅ Start picture removed!")
 
 
+@Client.on_message(filters.command("metrics") & filters.private)
+@admin_only
+async def metrics_command(client, message: Message):
+    """Show runtime metrics (admin only)"""
+    snapshot = metrics.snapshot()
+    
+    text = "**📈 Bot Metrics**\n\n"
+    text += f"**Uptime:** {format_time(int(snapshot['uptime']))}\n\n"
+    
+    if snapshot['counters']:
+        text += "**Counters:**\n"
+        for name, value in sorted(snapshot['counters'].items()):
+            text += f"├ {name}: `{value}`\n"
+        text += "\n"
+    
+    if snapshot['gauges']:
+        text += "**Gauges:**\n"
+        for name, value in sorted(snapshot['gauges'].items()):
+            text += f"├ {name}: `{value}`\n"
+    
+    await message.reply_text(text)
+
+
+@Client.on_message(filters.command("stats") & filters.private)
+@admin_only
+async def stats_command(client, message: Message):
+    """Show user and job statistics (admin only)"""
+    stats = await adb.get_stats(7)
+    counters = stats['counters']
+    
+    text = "**📊 Bot Statistics**\n\n"
+    text += f"**Users:** `{counters.get('users', 0)}`\n"
+    text += f"**Premium Users:** `{counters.get('premium_users', 0)}`\n"
+    text += f"**Jobs Done:** `{counters.get('jobs', 0)}`\n"
+    text += f"**Processed:** {format_size(counters.get('bytes_processed', 0))}\n\n"
+    
+    qualities = sorted(name for name in counters if name.startswith('jobs_'))
+    if qualities:
+        text += "**Jobs by Quality:**\n"
+        for name in qualities:
+            text += f"├ {name[5:]}: `{counters[name]}`\n"
+        text += "\n"
+    
+    if stats['daily']:
+        text += "**Last 7 Days (UTC):**\n"
+        for day, values in sorted(stats['daily'].items(), reverse=True):
+            text += (
+                f"├ {day}: {values.get('active_users', 0)} active, "
+                f"{values.get('new_users', 0)} new, {values.get('jobs', 0)} jobs, "
+                f"{format_size(values.get('bytes_processed', 0))}\n"
+            )
+    
+    await message.reply_text(text)
+
+
+@Client.on_message(filters.command("pool") & filters.private)
+@admin_only
+async def set_pool_size_command(client, message: Message):
+    """Resize a pipeline stage pool (admin only)"""
+    args = message.text.split()
+    
+    if len(args) < 3:
+        text = "**Stage Pools:**\n"
+        for name, pool in pools.items():
+            state = pool.snapshot()
+            text += f"├ `{name}`: {state['busy']}/{state['size']} busy, {state['queued']} queued\n"
+        text += "\n**Usage:** `/pool encode 3`"
+        await message.reply_text(text)
+        return
+    
+    name = args[1].strip().lower()
+    if name not in pools:
+        await message.reply_text(f"❌ Invalid stage! Choose from: {', '.join(pools)}")
+        return
+    
+    try:
+        size = int(args[2])
+        if size < 1:
+            raise ValueError
+    except ValueError:
+        await message.reply_text("❌ Pool size must be a positive number!")
+        return
+    
+    pools[name].resize(size)
+    await message.reply_text(f"✅ {name.title()} pool size set to: `{size}`")
+
+
 # ============= User Commands =============
 
 @Client.on_message(filters.command("rename") & filters.private)
@@ -487,7 +651,7 @@ async def set_watermark_command(client, message: Message):
     args = message.text.split(maxsplit=1)
     
     if len(args) < 2:
-        current = db.get_user_watermark(message.from_user.id)
+        current = await adb.get_user_watermark(message.from_user.id)
         await message.reply_text(
             f"**Current Watermark:** `{current}`\n\n"
             "**Usage:** `/setwatermark Your Text Here`"
@@ -495,14 +659,14 @@ async def set_watermark_command(client, message: Message):
         return
     
     watermark = args[1].strip()
-    db.set_user_watermark(message.from_user.id, watermark)
+    await adb.set_user_watermark(message.from_user.id, watermark)
     await message.reply_text(f"✅ Watermark set to: `{watermark}`")
 
 
 @Client.on_message(filters.command("getwatermark") & filters.private)
 async def get_watermark_command(client, message: Message):
     """Get current watermark"""
-    watermark = db.get_user_watermark(message.from_user.id)
+    watermark = await adb.get_user_watermark(message.from_user.id)
     await message.reply_text(f"**Your Watermark:** `{watermark}`")
 
 
@@ -516,7 +680,7 @@ async def set_media_type_command(client, message: Message):
         ]
     ]
     
-    current = "Document" if db.get_user_setting(message.from_user.id, 'upload_as_document', False) else "Video"
+    current = "Document" if await adb.get_user_setting(message.from_user.id, 'upload_as_document', False) else "Video"
     
     await message.reply_text(
         f"**Current Upload Type:** {current}\n\n"
@@ -528,13 +692,43 @@ async def set_media_type_command(client, message: Message):
 @Client.on_message(filters.command("spoiler") & filters.private)
 async def toggle_spoiler_command(client, message: Message):
     """Toggle spoiler mode"""
-    current = db.get_user_setting(message.from_user.id, 'spoiler_mode', False)
+    current = await adb.get_user_setting(message.from_user.id, 'spoiler_mode', False)
     new_value = not current
     
-    db.set_user_setting(message.from_user.id, 'spoiler_mode', new_value)
+    await adb.set_user_setting(message.from_user.id, 'spoiler_mode', new_value)
     
     status = "enabled" if new_value else "disabled"
     await message.reply_text(f"✅ Spoiler mode {status}!")
 
 
+
+@Client.on_message(filters.command("crop") & filters.private)
+async def set_crop_command(client, message: Message):
+    """Set crop mode for encodes"""
+    args = message.text.split(maxsplit=1)
+    
+    if len(args) < 2:
+        current = await adb.get_user_crop_mode(message.from_user.id)
+        await message.reply_text(
+            f"**Current Crop:** `{current}`\n\n"
+            "**Modes:**\n"
+            "├ `auto` - Remove black bars\n"
+            "├ `off` - Keep the full frame\n"
+            "└ `16:9`, `4:3`, `1:1`, `9:16`, ... - Crop to aspect ratio\n\n"
+            "**Usage:** `/crop auto`"
+        )
+        return
+    
+    mode = args[1].strip().lower()
+    
+    if mode not in ('auto', 'off'):
+        parts = mode.split(':')
+        if len(parts) != 2 or not all(p.isdigit() and 0 < int(p) <= 100 for p in parts):
+            await message.reply_text("❌ Use `auto`, `off` or an aspect ratio like `16:9`")
+            return
+    
+    await adb.set_user_crop_mode(message.from_user.id, mode)
+    await message.reply_text(f"✅ Crop set to: `{mode}`")
+
+
 print("Handlers module loaded successfully!")
@@ -0,0 +1,40 @@
+import threading
+import time
+
+
+class Metrics:
+    """In-process counters and gauges for admin monitoring"""
+    
+    def __init__(self):
+        self.started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, name, value=1):
+        """Increment a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+    
+    def set_gauge(self, name, value):
+        """Set a gauge to its current value"""
+        with self._lock:
+            self._gauges[name] = value
+    
+    def get(self, name, default=0):
+        """Get a counter or gauge value"""
+        with self._lock:
+            return self._counters.get(name, self._gauges.get(name, default))
+    
+    def snapshot(self):
+        """Get a copy of all counters and gauges"""
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'uptime': time.time() - self.started
+            }
+
+
+# Shared instance
+metrics = Metrics()
@@ -0,0 +1,423 @@
+import sys
+import sqlite3
+
+
+def _add_column(cursor, table, column, definition):
+    """Add column to an existing table if it is missing"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _base_schema(cursor, dialect):
+    """Base schema; also brings databases from before versioning up to date"""
+    if dialect == 'postgres':
+        return _base_schema_postgres(cursor)
+    
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            is_premium BOOLEAN DEFAULT 0,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # User settings table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            watermark_text TEXT,
+            thumbnail_path TEXT,
+            upload_as_document BOOLEAN DEFAULT 0,
+            spoiler_mode BOOLEAN DEFAULT 0,
+            upload_destination TEXT DEFAULT 'private',
+            crop_mode TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+    
+    # Premium users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS premium_users (
+            user_id INTEGER PRIMARY KEY,
+            added_by INTEGER,
+            added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expiry_date TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+    
+    # Force subscribe channels
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS force_subscribe_channels (
+            channel_id INTEGER PRIMARY KEY,
+            channel_url TEXT,
+            channel_name TEXT,
+            added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Bot settings table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    
+    # Jobs table (durable queue and finished-job history)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER,
+            message_id INTEGER,
+            status_message_id INTEGER,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            batch_id TEXT,
+            file_name TEXT,
+            file_size INTEGER DEFAULT 0,
+            duration INTEGER DEFAULT 0,
+            operation TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    
+    # Columns added after the first release of a table
+    _add_column(cursor, 'jobs', 'batch_id', 'TEXT')
+    _add_column(cursor, 'user_settings', 'crop_mode', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id)')
+    
+    # Per-title CRF search results, keyed by source file and target
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS crf_cache (
+            file_unique_id TEXT NOT NULL,
+            quality TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            target REAL NOT NULL,
+            crf INTEGER NOT NULL,
+            score REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (file_unique_id, quality, codec, metric, target)
+        )
+    ''')
+
+
+def _base_schema_postgres(cursor):
+    """Base schema with PostgreSQL types; rowid keeps insertion order like SQLite's"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            is_premium INTEGER DEFAULT 0,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id BIGINT PRIMARY KEY,
+            watermark_text TEXT,
+            thumbnail_path TEXT,
+            upload_as_document INTEGER DEFAULT 0,
+            spoiler_mode INTEGER DEFAULT 0,
+            upload_destination TEXT DEFAULT 'private',
+            crop_mode TEXT
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS premium_users (
+            user_id BIGINT PRIMARY KEY,
+            added_by BIGINT,
+            added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expiry_date TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS force_subscribe_channels (
+            channel_id BIGINT PRIMARY KEY,
+            channel_url TEXT,
+            channel_name TEXT,
+            added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            rowid BIGSERIAL,
+            job_id TEXT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            message_id BIGINT,
+            status_message_id BIGINT,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT,
+            batch_id TEXT,
+            file_name TEXT,
+            file_size BIGINT DEFAULT 0,
+            duration INTEGER DEFAULT 0,
+            operation TEXT,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id)')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS crf_cache (
+            file_unique_id TEXT NOT NULL,
+            quality TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            target DOUBLE PRECISION NOT NULL,
+            crf INTEGER NOT NULL,
+            score DOUBLE PRECISION,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (file_unique_id, quality, codec, metric, target)
+        )
+    ''')
+
+
+def _hot_query_indexes(cursor, dialect):
+    """Indexes for premium expiry, activity and job queue queries"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_premium_expiry ON premium_users (expiry_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)')
+    
+    # Queue and history reads filter by state and sort by time
+    cursor.execute('DROP INDEX IF EXISTS idx_jobs_state')
+    cursor.execute('DROP INDEX IF EXISTS idx_jobs_user_state')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state_created ON jobs (state, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user_state_created ON jobs (user_id, state, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state_finished ON jobs (state, finished_at)')
+
+
+def _stats_tables(cursor, dialect):
+    """Statistics counters and daily rollups, backfilled from existing rows"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, name)
+        )
+    ''')
+    
+    cursor.execute('''
+        INSERT INTO stats_counters (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'premium_users', COUNT(*) FROM premium_users
+        UNION ALL SELECT 'jobs', COUNT(*) FROM jobs WHERE state = 'done'
+        UNION ALL SELECT 'bytes_processed', COALESCE(SUM(file_size), 0) FROM jobs WHERE state = 'done'
+    ''')
+    cursor.execute('''
+        INSERT INTO stats_counters (name, value)
+        SELECT 'jobs_' || REPLACE(operation, 'encode_', ''), COUNT(*)
+        FROM jobs WHERE state = 'done' AND operation IS NOT NULL
+        GROUP BY operation
+    ''')
+    
+    # Only the latest activity of each user is known for past days
+    cursor.execute('''
+        INSERT INTO stats_daily (day, name, value)
+        SELECT SUBSTR(CAST(join_date AS TEXT), 1, 10), 'new_users', COUNT(*)
+        FROM users WHERE join_date IS NOT NULL
+        GROUP BY SUBSTR(CAST(join_date AS TEXT), 1, 10)
+        UNION ALL
+        SELECT SUBSTR(CAST(last_active AS TEXT), 1, 10), 'active_users', COUNT(*)
+        FROM users WHERE last_active IS NOT NULL
+        GROUP BY SUBSTR(CAST(last_active AS TEXT), 1, 10)
+        UNION ALL
+        SELECT SUBSTR(CAST(finished_at AS TEXT), 1, 10), 'jobs', COUNT(*)
+        FROM jobs WHERE state = 'done' AND finished_at IS NOT NULL
+        GROUP BY SUBSTR(CAST(finished_at AS TEXT), 1, 10)
+        UNION ALL
+        SELECT SUBSTR(CAST(finished_at AS TEXT), 1, 10), 'bytes_processed', COALESCE(SUM(file_size), 0)
+        FROM jobs WHERE state = 'done' AND finished_at IS NOT NULL
+        GROUP BY SUBSTR(CAST(finished_at AS TEXT), 1, 10)
+        UNION ALL
+        SELECT SUBSTR(CAST(finished_at AS TEXT), 1, 10), 'jobs_' || REPLACE(operation, 'encode_', ''), COUNT(*)
+        FROM jobs WHERE state = 'done' AND finished_at IS NOT NULL AND operation IS NOT NULL
+        GROUP BY SUBSTR(CAST(finished_at AS TEXT), 1, 10), operation
+    ''')
+
+
+def _job_leases(cursor, dialect):
+    """Job owner instance and lease expiry, so shared stores resume only dead instances' jobs"""
+    if dialect == 'postgres':
+        cursor.execute('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS owner TEXT')
+        cursor.execute('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP')
+    else:
+        _add_column(cursor, 'jobs', 'owner', 'TEXT')
+        _add_column(cursor, 'jobs', 'lease_until', 'TIMESTAMP')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state_lease ON jobs (state, lease_until)')
+
+
+def _crf_cache_profile_key(cursor, dialect):
+    """Key per-title CRF results by preset, rate control and base CRF too (cache is reset)"""
+    real = 'DOUBLE PRECISION' if dialect == 'postgres' else 'REAL'
+    cursor.execute('DROP TABLE IF EXISTS crf_cache')
+    cursor.execute(f'''
+        CREATE TABLE crf_cache (
+            file_unique_id TEXT NOT NULL,
+            quality TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            preset TEXT NOT NULL,
+            rate_control TEXT NOT NULL,
+            base_crf INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            target {real} NOT NULL,
+            crf INTEGER NOT NULL,
+            score {real},
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (file_unique_id, quality, codec, preset, rate_control, base_crf, metric, target)
+        )
+    ''')
+
+
+# PostgreSQL advisory lock serializing migrations across bot instances
+MIGRATION_LOCK_ID = 7324901
+
+# (version, migration); append new ones, never edit applied ones
+MIGRATIONS = [
+    (1, _base_schema),
+    (2, _hot_query_indexes),
+    (3, _stats_tables),
+    (4, _job_leases),
+    (5, _crf_cache_profile_key)
+]
+
+# Queries on per-message or per-job paths, with sample parameters; keep in
+# sync with Database. Aggregates are served from stats_counters instead.
+HOT_QUERIES = {
+    'get_user': ('SELECT * FROM users WHERE user_id = ?', (1,)),
+    'user_settings': ('SELECT * FROM user_settings WHERE user_id = ?', (1,)),
+    'user_premium': ('''
+        SELECT expiry_date FROM premium_users
+        WHERE user_id = ? AND (expiry_date IS NULL OR expiry_date > CURRENT_TIMESTAMP)
+    ''', (1,)),
+    'get_all_premium_users': ('''
+        SELECT u.user_id, u.first_name, p.added_date, p.expiry_date
+        FROM premium_users p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE p.expiry_date IS NULL OR p.expiry_date > CURRENT_TIMESTAMP
+    ''', ()),
+    'users_last_seen': ('SELECT user_id, last_active FROM users WHERE user_id IN (?, ?)', (1, 2)),
+    'expire_premium_users': ('DELETE FROM premium_users WHERE expiry_date <= CURRENT_TIMESTAMP', ()),
+    'get_counter': ('SELECT value FROM stats_counters WHERE name = ?', ('users',)),
+    'get_stats': ('SELECT day, name, value FROM stats_daily WHERE day >= ? ORDER BY day', ('2000-01-01',)),
+    'get_job': ('SELECT * FROM jobs WHERE job_id = ?', ('',)),
+    'get_pending_job': ('''
+        SELECT * FROM jobs
+        WHERE user_id = ? AND state = 'pending'
+        ORDER BY created_at DESC, rowid DESC
+        LIMIT 1
+    ''', (1,)),
+    'get_batch_jobs': ('SELECT * FROM jobs WHERE batch_id = ? ORDER BY message_id, rowid', ('',)),
+    'requeue_interrupted_jobs': ('''
+        SELECT * FROM jobs
+        WHERE state IN ('queued', 'downloading', 'encoding', 'uploading')
+            AND (lease_until IS NULL OR lease_until < ?)
+    ''', ('2000-01-01 00:00:00',)),
+    'renew_job_leases': ('''
+        SELECT * FROM jobs
+        WHERE state IN ('queued', 'downloading', 'encoding', 'uploading') AND owner = ?
+    ''', ('',)),
+    'get_job_history': ('''
+        SELECT * FROM jobs
+        WHERE state IN ('done', 'failed', 'cancelled') AND user_id = ?
+        ORDER BY finished_at DESC LIMIT ?
+    ''', (1, 50)),
+    'get_cached_crf': ('''
+        SELECT crf FROM crf_cache
+        WHERE file_unique_id = ? AND quality = ? AND codec = ? AND preset = ?
+            AND rate_control = ? AND base_crf = ? AND metric = ? AND target = ?
+    ''', ('', '', '', '', '', 0, '', 0.0))
+}
+
+
+def schema_version(cursor):
+    """Get the applied schema version (0 for a new or pre-versioning database)"""
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    return cursor.fetchone()[0] or 0
+
+
+def migrate(conn, dialect='sqlite'):
+    """Apply pending migrations, each in its own transaction; returns the version"""
+    cursor = conn.cursor()
+    
+    for version, migration in MIGRATIONS:
+        # IMMEDIATE takes the write lock, so concurrent processes apply each
+        # migration once; the version is re-read under that lock
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            if dialect == 'postgres':
+                cursor.execute('SELECT pg_advisory_xact_lock(?)', (MIGRATION_LOCK_ID,))
+            if schema_version(cursor) < version:
+                migration(cursor, dialect)
+                cursor.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+                print(f"Database migrated to version {version}: {migration.__doc__}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    
+    return schema_version(cursor)
+
+
+def check_query_plans(conn):
+    """Get (query, plan step) for every hot query step that scans a table"""
+    scans = []
+    for name, (query, params) in HOT_QUERIES.items():
+        for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params):
+            detail = row[3]
+            if detail.startswith('SCAN ') and not detail.startswith('SCAN CONSTANT ROW'):
+                scans.append((name, detail))
+    return scans
+
+
+if __name__ == "__main__":
+    # python migrations.py [bot.db]: migrate and fail if a hot query scans
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else "bot.db")
+    print(f"Schema version {migrate(conn)}")
+    
+    scans = check_query_plans(conn)
+    for name, detail in scans:
+        print(f"❌ {name}: {detail}")
+    if scans:
+        sys.exit(1)
+    print(f"✅ {len(HOT_QUERIES)} hot queries use indexes")
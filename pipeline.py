@@ -0,0 +1,83 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from config import Config
+from metrics import metrics
+
+
+class StagePool:
+    """Bounded pool for one pipeline stage; waiting jobs are served FIFO"""
+    
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.busy = 0
+        self._waiters = deque()
+        self._publish()
+    
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a free worker and hold it for the duration of the block"""
+        if self.busy >= self.size or self._waiters:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self._publish()
+            
+            try:
+                await waiter
+            except BaseException:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._publish()
+                elif waiter.done() and not waiter.cancelled():
+                    # Slot was already handed to us; pass it on
+                    self._release()
+                raise
+        else:
+            self.busy += 1
+            self._publish()
+        
+        try:
+            yield
+        finally:
+            self._release()
+    
+    def resize(self, size):
+        """Change the number of workers; extra waiters start immediately"""
+        self.size = size
+        while self._waiters and self.busy < self.size:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.busy += 1
+                waiter.set_result(True)
+        self._publish()
+    
+    def _release(self):
+        """Hand the worker to the next waiter, or free it"""
+        while self._waiters and self.busy <= self.size:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                self._publish()
+                return
+        
+        self.busy -= 1
+        self._publish()
+    
+    def _publish(self):
+        """Expose pool state as metrics gauges"""
+        metrics.set_gauge(f"pool_{self.name}_size", self.size)
+        metrics.set_gauge(f"pool_{self.name}_busy", self.busy)
+        metrics.set_gauge(f"pool_{self.name}_queued", len(self._waiters))
+    
+    def snapshot(self):
+        """Get pool state"""
+        return {'size': self.size, 'busy': self.busy, 'queued': len(self._waiters)}
+
+
+# Shared stage pools
+pools = {
+    'download': StagePool('download', Config.DOWNLOAD_WORKERS),
+    'encode': StagePool('encode', Config.ENCODE_WORKERS),
+    'upload': StagePool('upload', Config.UPLOAD_WORKERS)
+}
@@ -0,0 +1,172 @@
+import math
+import os
+from config import Config
+
+# Codecs offered by /codec; SVT-AV1 only when FFmpeg was built with it
+CODECS = {
+    'libx264': "H.264 (fast, compatible)",
+    'libx265': "H.265/HEVC (better compression)",
+    'libvpx-vp9': "VP9 (web-friendly)",
+    'libaom-av1': "AV1 (best compression)",
+    'libsvtav1': "SVT-AV1 (fast AV1)",
+    'mpeg4': "MPEG-4 Part 2 (legacy)"
+}
+OPTIONAL_CODECS = ('libsvtav1',)
+
+# Rate-control modes selectable globally and per quality
+RATE_CONTROL_MODES = {
+    'crf': "Constant quality, no bitrate limit",
+    'capped_crf': "Constant quality capped at the quality's bitrate",
+    'abr': "Average bitrate of the quality"
+}
+
+# Modes whose quality follows the CRF, the only ones per-title search tunes
+CRF_RATE_CONTROL_MODES = ('crf', 'capped_crf')
+
+# Admin preset -> (VP9 deadline, VP9 cpu-used, libaom cpu-used, SVT-AV1 preset)
+SPEED_PROFILES = {
+    'ultrafast': ('realtime', 8, 8, 12),
+    'superfast': ('realtime', 7, 7, 11),
+    'veryfast': ('good', 5, 6, 10),
+    'faster': ('good', 4, 6, 9),
+    'fast': ('good', 3, 5, 8),
+    'medium': ('good', 2, 4, 7),
+    'slow': ('good', 1, 3, 5),
+    'slower': ('good', 1, 2, 4),
+    'veryslow': ('good', 0, 1, 2)
+}
+
+
+def tile_columns(width, min_tile_width=256):
+    """Get log2 tile columns for a frame width (VP9/AV1 tiles are >= 256px)"""
+    return max(0, min(6, int(math.log2(max(1, width // min_tile_width)))))
+
+
+def video_codec_args(codec, preset, width, threads=None):
+    """
+    Build FFmpeg video encoder options for a codec
+    
+    x264/x265 understand the admin preset directly; for VP9 and AV1 it is
+    mapped to the encoder's own speed knobs, with row multithreading and
+    tiles so a single encode can use more than one core.
+    
+    Args:
+        codec: FFmpeg encoder name
+        preset: x264-style preset name (ultrafast ... veryslow)
+        width: Output frame width, used to pick tile columns
+        threads: Core budget of the job (None = let the encoder decide)
+    
+    Returns:
+        List of FFmpeg arguments starting with -c:v
+    """
+    deadline, vp9_speed, aom_speed, svt_preset = SPEED_PROFILES.get(preset, SPEED_PROFILES['medium'])
+    
+    if codec == 'libvpx-vp9':
+        return [
+            '-c:v', codec,
+            '-deadline', deadline,
+            '-cpu-used', str(vp9_speed),
+            '-row-mt', '1',
+            '-tile-columns', str(tile_columns(width)),
+            '-threads', str(threads or os.cpu_count() or 1)
+        ]
+    
+    if codec == 'libaom-av1':
+        args = [
+            '-c:v', codec,
+            '-cpu-used', str(aom_speed),
+            '-row-mt', '1',
+            '-tile-columns', str(tile_columns(width)),
+            '-tile-rows', '1' if width >= 1280 else '0',
+            '-threads', str(threads or os.cpu_count() or 1)
+        ]
+        if aom_speed > 6:
+            # Good-quality mode stops at cpu-used 6
+            args[2:2] = ['-usage', 'realtime']
+        return args
+    
+    if codec == 'libsvtav1':
+        args = ['-c:v', codec, '-preset', str(svt_preset)]
+        if threads:
+            args += ['-svtav1-params', f"lp={threads}"]
+        return args
+    
+    if codec == 'mpeg4':
+        # No presets
+        args = ['-c:v', codec]
+        if threads:
+            args += ['-threads', str(threads)]
+        return args
+    
+    args = ['-c:v', codec, '-preset', preset]
+    if threads:
+        if codec == 'libx265':
+            # x265 ignores -threads; size its pool and frame parallelism
+            frame_threads = max(1, min(4, threads // 2))
+            args += ['-x265-params', f"pools={threads}:frame-threads={frame_threads}"]
+        else:
+            args += ['-threads', str(threads)]
+    return args
+
+
+def _scale_bitrate(bitrate, factor):
+    """Scale an FFmpeg bitrate string such as '2000k'"""
+    if bitrate[-1].lower() in 'km':
+        return f"{int(float(bitrate[:-1]) * factor)}{bitrate[-1]}"
+    return str(int(float(bitrate) * factor))
+
+
+def bitrate_bps(bitrate):
+    """Convert an FFmpeg bitrate string such as '2000k' to bits per second"""
+    units = {'k': 1000, 'm': 1000000}
+    if bitrate[-1].lower() in units:
+        return float(bitrate[:-1]) * units[bitrate[-1].lower()]
+    return float(bitrate)
+
+
+def peak_bitrate(mode, bitrate, audio_bitrate):
+    """
+    Estimate the highest sustained bitrate of an encode in bits per second
+    
+    Returns:
+        Bits per second, or None for pure CRF which has no bound
+    """
+    if mode == 'crf':
+        return None
+    # ABR drifts above its average on hard scenes; VBV holds capped CRF
+    overshoot = 1.3 if mode == 'abr' else 1.05
+    return bitrate_bps(bitrate) * overshoot + bitrate_bps(audio_bitrate)
+
+
+def rate_control_args(codec, mode, crf, bitrate):
+    """
+    Build FFmpeg rate-control options for a codec
+    
+    Args:
+        codec: FFmpeg encoder name
+        mode: 'crf', 'capped_crf' or 'abr'
+        crf: Constant rate factor for the CRF modes
+        bitrate: Target bitrate of the quality (e.g. '2000k'); the cap for
+            capped_crf, the average for abr
+    
+    Returns:
+        List of FFmpeg arguments
+    """
+    if mode == 'abr':
+        return ['-b:v', bitrate]
+    
+    vbv = ['-maxrate', bitrate, '-bufsize', _scale_bitrate(bitrate, Config.VBV_BUFSIZE_FACTOR)]
+    
+    if codec == 'mpeg4':
+        # No CRF; map the 0-51 scale onto the 2-31 quantizer scale
+        args = ['-q:v', str(max(2, min(31, round(crf * 31 / 51))))]
+    elif codec in ('libvpx-vp9', 'libaom-av1'):
+        # libvpx/libaom need -b:v 0 for pure CRF; a bitrate turns it into
+        # constrained quality with that bitrate as the ceiling
+        args = ['-crf', str(crf), '-b:v', bitrate if mode == 'capped_crf' else '0']
+    else:
+        args = ['-crf', str(crf)]
+    
+    if mode == 'capped_crf':
+        args += vbv
+    return args
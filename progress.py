@@ -0,0 +1,65 @@
+import asyncio
+
+
+class ProgressChannel:
+    """Latest-value progress channel with a single rendering consumer
+    
+    Producers (download/encode/upload callbacks) call publish(), which only
+    overwrites the stored value. One consumer coroutine renders the newest
+    value and sends it, so at most one message edit is in flight per job.
+    """
+    
+    def __init__(self, send, interval=3):
+        self.send = send
+        self.interval = interval
+        self._render = None
+        self._latest = None
+        self._last_text = None
+        self._pending = asyncio.Event()
+        self._consumer = None
+    
+    def start(self):
+        """Start the consumer coroutine"""
+        if self._consumer is None:
+            self._consumer = asyncio.create_task(self._run())
+        return self
+    
+    def set_stage(self, render, data=None):
+        """Switch renderer and publish the first value of a new stage"""
+        self._render = render
+        self.publish(data)
+    
+    def publish(self, data):
+        """Overwrite the latest value (never blocks, never spawns tasks)"""
+        self._latest = data
+        self._pending.set()
+    
+    async def _run(self):
+        """Render and send the newest value, at most once per interval"""
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            
+            try:
+                text = self._render(self._latest)
+                if text and text != self._last_text:
+                    await self.send(text)
+                    self._last_text = text
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            
+            await asyncio.sleep(self.interval)
+    
+    async def close(self):
+        """Stop the consumer; pending values are dropped"""
+        if self._consumer is None:
+            return
+        
+        self._consumer.cancel()
+        try:
+            await self._consumer
+        except asyncio.CancelledError:
+            pass
+        self._consumer = None
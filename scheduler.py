@@ -0,0 +1,172 @@
+import asyncio
+import itertools
+import time
+from contextlib import asynccontextmanager
+from config import Config
+
+# Relative encode cost per second of source, by target quality and codec
+QUALITY_COST = {
+    '144p': 0.2,
+    '240p': 0.35,
+    '360p': 0.6,
+    '480p': 1.0,
+    '720p': 2.0,
+    '1080p': 4.0,
+    '2160p': 12.0
+}
+
+CODEC_COST = {
+    'libx264': 1.0,
+    'libx265': 2.5,
+    'libvpx-vp9': 3.0,
+    'libaom-av1': 6.0,
+    'libsvtav1': 2.0,
+    'mpeg4': 0.5
+}
+
+
+def estimate_cost(quality, codec, duration, file_size=0):
+    """Estimate job cost from target quality, codec and source length"""
+    # Documents often carry no duration; assume ~4 Mbps sources then
+    seconds = duration or file_size / 500000
+    seconds = max(seconds, 60)
+    return seconds * QUALITY_COST.get(quality, 1.0) * CODEC_COST.get(codec, 1.0)
+
+
+class _Entry:
+    """Scheduler bookkeeping for one job"""
+    
+    __slots__ = ('job_id', 'user_id', 'cost', 'weight', 'start', 'finish',
+                 'seq', 'ready', 'enqueued_at', 'started_at')
+    
+    def __init__(self, job_id, user_id, cost, weight, start, seq):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.cost = cost
+        self.weight = weight
+        self.start = start
+        self.finish = start + cost / weight
+        self.seq = seq
+        self.ready = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.time()
+        self.started_at = None
+
+
+class FairScheduler:
+    """
+    Weighted fair queueing of jobs across users (start-time fair queueing)
+    
+    Every job gets a virtual start tag max(V, user's last finish tag) and a
+    finish tag start + cost / weight. Free slots go to the waiting job with
+    the smallest start tag, so a user's share of slots follows their weight
+    and the cost of their jobs rather than how many jobs they queued.
+    """
+    
+    def __init__(self, slots):
+        self.slots = slots
+        self.virtual_time = 0.0
+        self._seq = itertools.count()
+        self._waiting = []
+        self._running = {}
+        self._last_finish = {}
+        self._served = {}
+    
+    @asynccontextmanager
+    async def slot(self, job_id, user_id, cost, weight=1):
+        """Wait for a fair-share slot and hold it for the duration of the block"""
+        start = max(self.virtual_time, self._last_finish.get(user_id, 0.0))
+        entry = _Entry(job_id, user_id, cost, weight, start, next(self._seq))
+        self._last_finish[user_id] = entry.finish
+        self._waiting.append(entry)
+        self._dispatch()
+        
+        try:
+            await entry.ready
+        except BaseException:
+            self._release(entry)
+            raise
+        
+        try:
+            yield entry
+        finally:
+            self._release(entry)
+    
+    def is_full(self):
+        """Check if all slots are taken"""
+        return len(self._running) >= self.slots
+    
+    def waiting_count(self):
+        """Get number of waiting jobs"""
+        return len(self._waiting)
+    
+    def position(self, job_id):
+        """Get 1-based queue position of a waiting job (0 if not waiting)"""
+        order = sorted(self._waiting, key=lambda e: (e.start, e.seq))
+        for index, entry in enumerate(order, 1):
+            if entry.job_id == job_id:
+                return index
+        return 0
+    
+    def _dispatch(self):
+        """Start waiting jobs while slots are free"""
+        while self._waiting and len(self._running) < self.slots:
+            entry = min(self._waiting, key=lambda e: (e.start, e.seq))
+            self._waiting.remove(entry)
+            self.virtual_time = max(self.virtual_time, entry.start)
+            entry.started_at = time.time()
+            self._running[entry.job_id] = entry
+            self._served[entry.user_id] = self._served.get(entry.user_id, 0.0) + entry.cost
+            entry.ready.set_result(True)
+    
+    def _release(self, entry):
+        """Remove a finished or cancelled job and hand its slot on"""
+        if entry in self._waiting:
+            self._waiting.remove(entry)
+            self._rewind(entry)
+        if self._running.get(entry.job_id) is entry:
+            del self._running[entry.job_id]
+        
+        # Forget idle users once virtual time has caught up with their last
+        # finish tag; dropping it sooner would let a user who submits one
+        # job at a time restart at V every job and dodge its cost
+        busy = {e.user_id for e in self._waiting} | {e.user_id for e in self._running.values()}
+        if not busy and self._last_finish:
+            # Idle scheduler: nobody is owed anything, start everyone afresh
+            self.virtual_time = max(self.virtual_time, max(self._last_finish.values()))
+        caught_up = [user_id for user_id, finish in self._last_finish.items()
+                     if finish <= self.virtual_time and user_id not in busy]
+        for user_id in caught_up:
+            del self._last_finish[user_id]
+            self._served.pop(user_id, None)
+        
+        self._dispatch()
+    
+    def _rewind(self, entry):
+        """Give back the virtual time of a job that never ran"""
+        if self._last_finish.get(entry.user_id) == entry.finish:
+            self._last_finish[entry.user_id] = entry.start
+    
+    def snapshot(self):
+        """Get scheduler state for admins"""
+        def describe(entry):
+            return {
+                'job_id': entry.job_id,
+                'user_id': entry.user_id,
+                'cost': entry.cost,
+                'weight': entry.weight,
+                'start': entry.start,
+                'finish': entry.finish,
+                'since': entry.started_at or entry.enqueued_at
+            }
+        
+        return {
+            'slots': self.slots,
+            'virtual_time': self.virtual_time,
+            'running': [describe(e) for e in self._running.values()],
+            'waiting': [describe(e) for e in sorted(self._waiting, key=lambda e: (e.start, e.seq))],
+            'served': dict(self._served)
+        }
+
+
+# Shared instance
+scheduler = FairScheduler(Config.MAX_CONCURRENT_JOBS)
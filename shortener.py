@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict
+import aiohttp
+from config import Config
+from metrics import metrics
+
+
+class CircuitBreaker:
+    """Stops calling a failing provider; one trial call per cooldown probes it"""
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+    
+    def allow(self):
+        """Check if a call may go through now"""
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            # Half-open: let this call try, keep short-circuiting the rest
+            self.opened_at = time.monotonic()
+            return True
+        return False
+    
+    def success(self):
+        """Close the breaker"""
+        self.failures = 0
+        self.opened_at = None
+    
+    def failure(self):
+        """Count a failure; open the breaker at the threshold"""
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                metrics.inc('shortener_breaker_opened')
+            self.opened_at = time.monotonic()
+
+
+class ShortenerClient:
+    """Async shortener API client with a pooled session, result cache and breakers"""
+    
+    def __init__(self):
+        self._session = None
+        self._limit = asyncio.Semaphore(Config.SHORTENER_MAX_CONCURRENCY)
+        self._cache = OrderedDict()
+        self._breakers = {}
+    
+    def _get_session(self):
+        """Get the shared session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=Config.SHORTENER_MAX_CONCURRENCY, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=Config.SHORTENER_TIMEOUT)
+            )
+        return self._session
+    
+    async def shorten(self, url, api_url, api_key):
+        """Shorten url; returns url itself if the provider fails or is tripped"""
+        key = (api_url, api_key, url)
+        short = self._cache.get(key)
+        if short:
+            self._cache.move_to_end(key)
+            metrics.inc('shortener_cache_hits')
+            return short
+        
+        breaker = self._breakers.setdefault(
+            api_url, CircuitBreaker(Config.SHORTENER_FAILURE_THRESHOLD, Config.SHORTENER_COOLDOWN)
+        )
+        if not breaker.allow():
+            metrics.inc('shortener_short_circuits')
+            return url
+        
+        async with self._limit:
+            try:
+                async with self._get_session().get(
+                    f"{api_url}/api",
+                    params={'api': api_key, 'url': url}
+                ) as response:
+                    if response.status != 200:
+                        raise ValueError(f"HTTP {response.status}")
+                    data = await response.json(content_type=None)
+                
+                short = data.get('shortenedUrl')
+                if not short:
+                    raise ValueError(data.get('message') or "No shortenedUrl in response")
+            except Exception as e:
+                breaker.failure()
+                metrics.inc('shortener_failures')
+                print(f"Shortener {api_url} failed: {e}")
+                return url
+        
+        breaker.success()
+        self._cache[key] = short
+        while len(self._cache) > Config.SHORTENER_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return short
+    
+    async def close(self):
+        """Close the shared session"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+# Shared instance
+shortener = ShortenerClient()
@@ -0,0 +1,296 @@
+import asyncio
+import queue
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from functools import lru_cache
+from config import Config
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+class PooledConnection:
+    """Connection borrowed from a backend's pool; close() hands it back"""
+    
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    def close(self):
+        """Return the connection to the pool"""
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+    
+    def __del__(self):
+        # A method that raised before close() still returns its connection
+        if getattr(self, '_conn', None) is not None:
+            self.close()
+
+
+class SQLiteBackend:
+    """Thread-safe pool of long-lived SQLite connections"""
+    
+    dialect = 'sqlite'
+    
+    def __init__(self, db_path, size):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=size)
+    
+    def acquire(self):
+        """Borrow an idle connection, opening a new one if none is idle"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        return PooledConnection(self, conn)
+    
+    def release(self, conn):
+        """Take a connection back; extras beyond the pool size are closed"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+    
+    def _connect(self):
+        """Open a connection with the pool's pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=Config.DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=Config.DB_STATEMENT_CACHE
+        )
+        conn.row_factory = sqlite3.Row
+        
+        # WAL keeps frequent job state writes from blocking readers, and
+        # with WAL synchronous=NORMAL only syncs at checkpoints
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{Config.DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={Config.DB_MMAP_SIZE_MB * 1024 * 1024}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    def close_all(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+@lru_cache(maxsize=512)
+def _numbered_placeholders(sql):
+    """Turn qmark placeholders into $1, $2, ... outside string literals"""
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    count = 0
+    for index in range(0, len(parts), 2):
+        pieces = parts[index].split('?')
+        text = pieces[0]
+        for piece in pieces[1:]:
+            count += 1
+            text += f"${count}{piece}"
+        parts[index] = text
+    return ''.join(parts)
+
+
+def _adapt_params(types, params):
+    """Coerce parameters the way SQLite's type affinity would accept them"""
+    values = []
+    for param_type, value in zip(types, params):
+        if isinstance(value, bool):
+            value = int(value)
+        if value is not None:
+            if param_type.name in ('timestamp', 'timestamptz') and isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            elif param_type.name in ('text', 'varchar') and not isinstance(value, str):
+                value = str(value)
+            elif param_type.name in ('float4', 'float8') and isinstance(value, int):
+                value = float(value)
+        values.append(value)
+    return values
+
+
+class PostgresCursor:
+    """DB-API style cursor over a PostgresConnection"""
+    
+    def __init__(self, conn):
+        self._conn = conn
+        self._rows = []
+    
+    def execute(self, sql, params=()):
+        """Run a statement and keep its rows for fetching"""
+        self._rows = self._conn._run(sql, params)
+        return self
+    
+    def executemany(self, sql, seq_of_params):
+        """Run a statement once per parameter tuple"""
+        self._conn._run_many(sql, seq_of_params)
+        self._rows = []
+        return self
+    
+    def fetchone(self):
+        """Get the next row (None when exhausted)"""
+        return self._rows.pop(0) if self._rows else None
+    
+    def fetchall(self):
+        """Get all remaining rows"""
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class PostgresConnection:
+    """
+    One pooled asyncpg connection driven from synchronous code
+    
+    Mirrors the sqlite3 module: qmark placeholders, rows readable by name
+    and index, and a transaction opened implicitly by the first write and
+    ended by commit() or rollback().
+    """
+    
+    def __init__(self, backend, conn):
+        self._backend = backend
+        self._conn = conn
+        self.in_transaction = False
+    
+    def cursor(self):
+        """Create a cursor"""
+        return PostgresCursor(self)
+    
+    def execute(self, sql, params=()):
+        """Run a statement on a new cursor"""
+        return self.cursor().execute(sql, params)
+    
+    def executemany(self, sql, seq_of_params):
+        """Run a statement once per parameter tuple on a new cursor"""
+        return self.cursor().executemany(sql, seq_of_params)
+    
+    def commit(self):
+        """Commit the open transaction, if any"""
+        if self.in_transaction:
+            self.in_transaction = False
+            self._backend.call(self._conn.execute('COMMIT'))
+    
+    def rollback(self):
+        """Roll back the open transaction, if any"""
+        if self.in_transaction:
+            self.in_transaction = False
+            self._backend.call(self._conn.execute('ROLLBACK'))
+    
+    def _begin(self, sql):
+        """Handle transaction control; returns True if sql was one"""
+        keyword = sql.lstrip().split(None, 1)[0].upper()
+        if keyword == 'BEGIN':
+            # BEGIN IMMEDIATE has no PostgreSQL form; writers lock rows anyway
+            self._backend.call(self._conn.execute('BEGIN'))
+            self.in_transaction = True
+            return True
+        if keyword in ('INSERT', 'UPDATE', 'DELETE') and not self.in_transaction:
+            self._backend.call(self._conn.execute('BEGIN'))
+            self.in_transaction = True
+        return False
+    
+    def _run(self, sql, params):
+        if self._begin(sql):
+            return []
+        return self._backend.call(self._fetch(_numbered_placeholders(sql), tuple(params)))
+    
+    def _run_many(self, sql, seq_of_params):
+        seq_of_params = [tuple(params) for params in seq_of_params]
+        if self._begin(sql) or not seq_of_params:
+            return
+        self._backend.call(self._executemany(_numbered_placeholders(sql), seq_of_params))
+    
+    async def _param_types(self, sql):
+        """Get the parameter types of a statement (cached per SQL text)"""
+        types = self._backend.param_types.get(sql)
+        if types is None:
+            statement = await self._conn.prepare(sql)
+            types = self._backend.param_types[sql] = statement.get_parameters()
+        return types
+    
+    async def _fetch(self, sql, params):
+        if not params:
+            return await self._conn.fetch(sql)
+        types = await self._param_types(sql)
+        return await self._conn.fetch(sql, *_adapt_params(types, params))
+    
+    async def _executemany(self, sql, seq_of_params):
+        types = await self._param_types(sql)
+        await self._conn.executemany(sql, [_adapt_params(types, params) for params in seq_of_params])
+
+
+class PostgresBackend:
+    """Pool of asyncpg connections, run on the backend's own event loop thread"""
+    
+    dialect = 'postgres'
+    
+    def __init__(self, url, size):
+        self.url = url
+        self.param_types = {}
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="postgres", daemon=True).start()
+        self._pool = self.call(asyncpg.create_pool(
+            url,
+            min_size=1,
+            max_size=size,
+            command_timeout=Config.DB_BUSY_TIMEOUT * 6,
+            statement_cache_size=Config.DB_STATEMENT_CACHE,
+            # CURRENT_TIMESTAMP is compared with naive UTC timestamps
+            server_settings={'timezone': 'UTC'}
+        ))
+    
+    def call(self, coro):
+        """Run a coroutine on the backend loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+    
+    def acquire(self):
+        """Borrow a connection from the pool"""
+        return PooledConnection(self, PostgresConnection(self, self.call(self._pool.acquire())))
+    
+    def release(self, conn):
+        """Roll back anything left open and return the connection"""
+        try:
+            conn.rollback()
+        finally:
+            self.call(self._pool.release(conn._conn))
+    
+    def close_all(self):
+        """Close every connection"""
+        self.call(self._pool.close())
+
+
+def open_backend(url, size):
+    """
+    Open the storage backend for a DATABASE_URL
+    
+    sqlite:///path and plain file paths open SQLite; postgres:// and
+    postgresql:// open PostgreSQL (RuntimeError if asyncpg is missing, as a
+    local bot.db would split state across instances). Anything else falls
+    back to SQLite in bot.db with a warning.
+    """
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        return SQLiteBackend(url, size)
+    
+    scheme = scheme.lower()
+    if scheme == 'sqlite':
+        return SQLiteBackend(rest[1:] if rest.startswith('/') else rest or 'bot.db', size)
+    
+    if scheme in ('postgres', 'postgresql'):
+        if asyncpg is None:
+            raise RuntimeError("DATABASE_URL is PostgreSQL but asyncpg is not installed (pip install asyncpg)")
+        return PostgresBackend(url, size)
+    
+    print(f"⚠️ Unsupported DATABASE_URL scheme '{scheme}'; using SQLite bot.db")
+    return SQLiteBackend('bot.db', size)
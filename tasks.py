@@ -0,0 +1,145 @@
+import asyncio
+import secrets
+import string
+import time
+
+TASK_ID_ALPHABET = string.ascii_letters + string.digits
+
+
+def new_task_id(length=10):
+    """Generate a short task ID usable in /stop<task_id> commands"""
+    return ''.join(secrets.choice(TASK_ID_ALPHABET) for _ in range(length))
+
+
+class TaskCancelled(Exception):
+    """Raised when a task was cancelled by the user"""
+
+
+class CancellationToken:
+    """Cancellation token shared by every stage of a job"""
+    
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+    
+    def cancel(self):
+        """Cancel the job and run all registered callbacks once"""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+    
+    def on_cancel(self, callback):
+        """Register callback to run on cancel; returns an unregister function"""
+        if self.cancelled:
+            callback()
+            return lambda: None
+        
+        self._callbacks.append(callback)
+        
+        def unregister():
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+        return unregister
+    
+    def bind_task(self, task=None):
+        """Cancel the given asyncio task (default: current) when the token fires"""
+        task = task or asyncio.current_task()
+        return self.on_cancel(task.cancel)
+    
+    def raise_if_cancelled(self):
+        """Raise TaskCancelled if the token has fired"""
+        if self.cancelled:
+            raise TaskCancelled("Task cancelled by user")
+
+
+class TaskLimitReached(Exception):
+    """Raised when a user already has the maximum number of tasks"""
+
+
+class TaskExists(Exception):
+    """Raised when a task ID is already registered"""
+
+
+class Task:
+    """A user job tracked while it is queued or running"""
+    
+    def __init__(self, task_id, user_id, file_name, operation, batch_id=None):
+        self.task_id = task_id
+        self.user_id = user_id
+        self.file_name = file_name
+        self.operation = operation
+        self.batch_id = batch_id
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.token = CancellationToken()
+        self.created_at = time.time()
+    
+    def cancel(self):
+        """Cancel the task in whatever stage it is"""
+        self.status = 'cancelled'
+        self.token.cancel()
+    
+    def set_stage(self, stage):
+        """Mark task as processing the given stage"""
+        self.status = 'processing'
+        self.stage = stage
+
+
+class TaskRegistry:
+    """Registry of queued and running tasks, many per user"""
+    
+    def __init__(self):
+        self._tasks = {}
+        self._by_user = {}
+    
+    def register(self, task, limit=None):
+        """Register task; raises TaskLimitReached if user is at limit, TaskExists if already registered"""
+        if task.task_id in self._tasks:
+            raise TaskExists(f"Task {task.task_id} is already registered")
+        
+        user_tasks = self._by_user.setdefault(task.user_id, {})
+        if limit is not None and len(user_tasks) >= limit:
+            if not user_tasks:
+                del self._by_user[task.user_id]
+            raise TaskLimitReached(f"Task limit of {limit} reached")
+        
+        user_tasks[task.task_id] = task
+        self._tasks[task.task_id] = task
+        return task
+    
+    def remove(self, task_id):
+        """Remove a finished task"""
+        task = self._tasks.pop(task_id, None)
+        if task:
+            user_tasks = self._by_user.get(task.user_id, {})
+            user_tasks.pop(task_id, None)
+            if not user_tasks:
+                self._by_user.pop(task.user_id, None)
+        return task
+    
+    def get(self, task_id):
+        """Get task by ID"""
+        return self._tasks.get(task_id)
+    
+    def for_user(self, user_id):
+        """Get user's tasks, oldest first"""
+        return sorted(self._by_user.get(user_id, {}).values(), key=lambda t: t.created_at)
+    
+    def count(self, user_id):
+        """Get number of user's tasks"""
+        return len(self._by_user.get(user_id, ()))
+    
+    def all(self):
+        """Get all tasks, oldest first"""
+        return sorted(self._tasks.values(), key=lambda t: t.created_at)
+
+
+# Shared instance
+registry = TaskRegistry()
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# The bot's modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules that open the database on import get a throwaway one
+os.environ['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp()}/bot.db"
@@ -0,0 +1,81 @@
+"""
+In-process stand-in for asyncpg, backed by SQLite
+
+Implements the slice of asyncpg that storage.PostgresBackend uses, so the
+PostgreSQL code path (numbered placeholders, explicit transactions, the
+sync-over-async pool) runs in tests without a server.
+"""
+import re
+import sqlite3
+from urllib.parse import urlparse
+
+# PostgreSQL-only DDL and the SQLite form the stand-in runs instead
+DDL_REWRITES = [
+    (re.compile(r'\browid BIGSERIAL,'), ''),
+    (re.compile(r'ADD COLUMN IF NOT EXISTS'), 'ADD COLUMN'),
+]
+
+
+class _Type:
+    """Parameter type as reported by a prepared statement"""
+    
+    def __init__(self, name):
+        self.name = name
+
+
+class _Statement:
+    def __init__(self, count):
+        self._count = count
+    
+    def get_parameters(self):
+        # Untyped, so values reach SQLite as the caller passed them
+        return [_Type('unknown')] * self._count
+
+
+class Connection:
+    """One SQLite connection behind asyncpg's coroutine API"""
+    
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.create_function('pg_advisory_xact_lock', 1, lambda key: None)
+    
+    @staticmethod
+    def _translate(sql):
+        for pattern, replacement in DDL_REWRITES:
+            sql = pattern.sub(replacement, sql)
+        return re.sub(r'\$(\d+)', r'?\1', sql)
+    
+    async def prepare(self, sql):
+        return _Statement(len(set(re.findall(r'\$(\d+)', sql))))
+    
+    async def fetch(self, sql, *args):
+        return self._conn.execute(self._translate(sql), args).fetchall()
+    
+    async def execute(self, sql, *args):
+        self._conn.execute(self._translate(sql), args)
+    
+    async def executemany(self, sql, args):
+        self._conn.executemany(self._translate(sql), args)
+
+
+class Pool:
+    def __init__(self, path):
+        self._path = path
+        self._idle = []
+    
+    async def acquire(self):
+        return self._idle.pop() if self._idle else Connection(self._path)
+    
+    async def release(self, conn):
+        self._idle.append(conn)
+    
+    async def close(self):
+        for conn in self._idle:
+            conn._conn.close()
+        self._idle = []
+
+
+async def create_pool(url, **kwargs):
+    """Open a pool on the SQLite file named by the URL's path"""
+    return Pool(urlparse(url).path)
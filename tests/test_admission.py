@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+from admission import MB, AdmissionController, AdmissionTimeout, CorePartitioner
+from config import Config
+
+GB = 1024 * MB
+
+
+def sample(**overrides):
+    """Resource sample of a comfortable machine"""
+    values = {
+        'load_per_core': 0.2,
+        'memory_available': 8 * GB,
+        'disk_free': 100 * GB,
+        'io_pressure': 0.0,
+        'memory_pressure': None
+    }
+    values.update(overrides)
+    return values
+
+
+@pytest.fixture
+def thresholds(monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_MIN_FREE_MEMORY_MB', 512)
+    monkeypatch.setattr(Config, 'ADMISSION_MIN_FREE_DISK_MB', 1024)
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_LOAD', 1.5)
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_PRESSURE', 40)
+
+
+@pytest.mark.parametrize('overrides, reason', [
+    ({}, None),
+    ({'memory_available': 1 * GB}, 'memory'),
+    ({'memory_pressure': 60.0}, 'memory pressure'),
+    ({'io_pressure': 60.0}, 'io pressure'),
+    ({'load_per_core': 2.0}, 'cpu')
+])
+def test_busy_machine_blocks_on_each_threshold(thresholds, overrides, reason):
+    controller = AdmissionController()
+    controller.active = 1
+    footprint = {'memory': 600 * MB, 'disk': GB}
+    
+    assert controller._blocked_by(footprint, sample(**overrides)) == reason
+
+
+def test_idle_machine_takes_one_job_unless_the_disk_is_full(thresholds):
+    controller = AdmissionController()
+    footprint = {'memory': 16 * GB, 'disk': GB}
+    
+    assert controller._blocked_by(footprint, sample(load_per_core=4.0)) is None
+    assert controller._blocked_by(footprint, sample(disk_free=GB + 512 * MB)) == 'disk'
+
+
+def test_reservations_count_against_free_resources(thresholds):
+    controller = AdmissionController()
+    footprint = {'memory': 3 * GB, 'disk': 40 * GB}
+    controller._reserve(footprint, 1)
+    
+    assert controller._blocked_by(footprint, sample(memory_available=6 * GB)) == 'memory'
+    assert controller._blocked_by({'memory': 0, 'disk': 60 * GB}, sample()) == 'disk'
+    
+    controller._reserve(footprint, -1)
+    assert controller.snapshot() == {'active': 0, 'paused_reason': None, 'reserved': {'memory': 0, 'disk': 0}}
+
+
+def test_admit_gives_up_after_the_max_wait(thresholds, monkeypatch):
+    monkeypatch.setattr(Config, 'ADMISSION_MAX_WAIT', 0)
+    monkeypatch.setattr(Config, 'ADMISSION_POLL_INTERVAL', 0.01)
+    controller = AdmissionController()
+    controller.sample = lambda: sample(disk_free=0)
+    
+    async def run():
+        async with controller.admit({'memory': 0, 'disk': GB}):
+            pass
+    
+    with pytest.raises(AdmissionTimeout):
+        asyncio.run(run())
+    assert controller.snapshot()['paused_reason'] is None
+    assert controller.active == 0
+
+
+def test_concurrent_encodes_get_disjoint_cores(monkeypatch):
+    monkeypatch.setattr(Config, 'ENCODE_CORES_PER_JOB', 0)
+    partitioner = CorePartitioner()
+    partitioner.cores = list(range(8))
+    partitioner._usage = {core: 0 for core in partitioner.cores}
+    
+    with partitioner.reserve(2) as first, partitioner.reserve(2) as second:
+        assert first == [0, 1, 2, 3]
+        assert second == [4, 5, 6, 7]
+    assert not any(partitioner._usage.values())
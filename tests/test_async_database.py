@@ -0,0 +1,134 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import pytest
+from database import Database, AsyncDatabase, get_async_database
+
+
+@pytest.fixture
+def db(tmp_path):
+    return Database(f"sqlite:///{tmp_path / 'bot.db'}")
+
+
+async def _max_loop_lag(work, interval=0.005):
+    """Run work() while a ticker measures the longest event loop stall"""
+    lag = 0.0
+    done = False
+    
+    async def ticker():
+        nonlocal lag
+        while not done:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(lag, time.monotonic() - start - interval)
+    
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(interval)
+    try:
+        result = await work()
+    finally:
+        done = True
+        await task
+    return lag, result
+
+
+def _hold_write_lock(path, seconds, locked):
+    """Keep the database write-locked from another connection for a while"""
+    conn = sqlite3.connect(path)
+    conn.execute('BEGIN IMMEDIATE')
+    locked.set()
+    time.sleep(seconds)
+    conn.rollback()
+    conn.close()
+
+
+def test_event_loop_keeps_running_while_database_is_locked(db, tmp_path):
+    adb = AsyncDatabase(db)
+    locked = threading.Event()
+    holder = threading.Thread(target=_hold_write_lock, args=(str(tmp_path / 'bot.db'), 0.5, locked))
+    holder.start()
+    locked.wait()
+    
+    async def work():
+        await asyncio.gather(*(adb.set_bot_setting(f"key_{i}", str(i)) for i in range(50)))
+        return await adb.get_bot_setting('key_49')
+    
+    try:
+        lag, value = asyncio.run(_max_loop_lag(work))
+    finally:
+        holder.join()
+    
+    # The writes waited ~0.5 s for the lock on the database thread only
+    assert value == '49'
+    assert lag < 0.1
+
+
+def test_batch_write_survives_a_concurrent_commit(db):
+    done = threading.Event()
+    
+    def writer():
+        # Another thread (the user flush, another AsyncDatabase) commits
+        db.set_bot_setting('other', '1')
+        done.set()
+    
+    with db.batch():
+        db.get_bot_setting('codec')
+        thread = threading.Thread(target=writer)
+        thread.start()
+        # The batch holds the write lock, so the other writer waits for it
+        assert not done.wait(0.2)
+        db.set_bot_setting('batched', '1')
+    thread.join()
+    
+    assert db.get_bot_setting('batched') == '1'
+    assert db.get_bot_setting('other') == '1'
+
+
+def test_async_database_is_shared_per_url(db):
+    other = Database(db.database_url)
+    assert get_async_database(db) is get_async_database(other)
+
+
+def test_user_flush_inside_a_batch_does_not_wait_for_the_lock(db):
+    db.add_user(1, 'One')
+    db.add_user(2, 'Two')
+    
+    start = time.monotonic()
+    with db.batch():
+        total, user = db.get_total_users(), db.get_user(2)
+    assert time.monotonic() - start < 1
+    assert total == 2
+    assert user['first_name'] == 'Two'
+
+
+def test_user_flush_from_another_instance_inside_a_batch(db):
+    # The buffer is shared per URL but was created with db's writer
+    other = Database(db.database_url)
+    db.add_user(1, 'One')
+    
+    start = time.monotonic()
+    with other.batch():
+        assert other.get_total_users() == 1
+    assert time.monotonic() - start < 1
+
+
+def test_reads_do_not_wait_behind_the_write_lock(db, tmp_path):
+    adb = AsyncDatabase(db)
+    locked = threading.Event()
+    holder = threading.Thread(target=_hold_write_lock, args=(str(tmp_path / 'bot.db'), 1, locked))
+    holder.start()
+    locked.wait()
+    
+    async def work():
+        write = asyncio.ensure_future(adb.set_bot_setting('key', '1'))
+        start = time.monotonic()
+        await adb.get_job('missing')
+        read_time = time.monotonic() - start
+        await write
+        return read_time
+    
+    try:
+        assert asyncio.run(work()) < 0.5
+    finally:
+        holder.join()
@@ -0,0 +1,19 @@
+import asyncio
+import bot
+
+
+def test_spawned_tasks_stay_referenced_and_failures_are_logged(capsys):
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+    
+    async def run():
+        task = bot.spawn(fail())
+        assert task in bot.background_tasks
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+        return task
+    
+    task = asyncio.run(run())
+    assert task not in bot.background_tasks
+    assert "boom" in capsys.readouterr().out
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import time
+import pytest
+from config import Config
+from encoder import EncodeStalled, StallWatchdog, VideoEncoder
+from tasks import CancellationToken, TaskCancelled
+
+# Reports affinity and priority from a thread the child starts after exec
+CHILD = '''
+import os, threading
+def report():
+    print(sorted(os.sched_getaffinity(0)), os.nice(0))
+thread = threading.Thread(target=report)
+thread.start()
+thread.join()
+'''
+
+
+def is_running(pid):
+    """Check a pid is alive (killed orphans may linger as zombies)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(not shutil.which('taskset') or not shutil.which('nice'), reason="needs taskset and nice")
+def test_cpu_policy_reaches_threads_created_by_the_child(monkeypatch):
+    monkeypatch.setattr(Config, 'ENCODE_CPU_AFFINITY', True)
+    monkeypatch.setattr(Config, 'ENCODE_NICE', 5)
+    core = sorted(os.sched_getaffinity(0))[0]
+    
+    output = subprocess.run(
+        VideoEncoder()._cpu_policy([core]) + [sys.executable, '-c', CHILD],
+        capture_output=True, text=True, check=True
+    ).stdout
+    
+    assert output.split() == [f"[{core}]", str(os.nice(0) + 5)]
+
+
+def test_no_cpu_policy_when_disabled(monkeypatch):
+    monkeypatch.setattr(Config, 'ENCODE_CPU_AFFINITY', False)
+    monkeypatch.setattr(Config, 'ENCODE_NICE', 0)
+    assert VideoEncoder()._cpu_policy([0, 1]) == []
+
+
+def test_watchdog_counts_frames_and_size_as_progress():
+    watchdog = StallWatchdog(120)
+    watchdog.last_advance -= 100
+    watchdog.advance(0, frame=0, total_size=48)
+    assert watchdog.progressed
+    assert watchdog.last_advance > time.monotonic() - 1
+
+
+def test_watchdog_gives_the_first_progress_a_startup_grace():
+    watchdog = StallWatchdog(120, startup=600)
+    watchdog.last_advance -= 300
+    assert not watchdog.expired()
+    
+    watchdog.advance(1.0)
+    watchdog.last_advance -= 300
+    assert watchdog.expired()
+
+
+def test_stall_hook_runs_before_the_partial_output_is_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'ENCODE_CPU_AFFINITY', False)
+    monkeypatch.setattr(Config, 'ENCODE_NICE', 0)
+    monkeypatch.setattr(Config, 'ENCODE_STALL_STARTUP', 1)
+    
+    # Writes part 1, then hangs without reporting progress
+    ffmpeg = tmp_path / 'ffmpeg'
+    ffmpeg.write_text(f"#!/bin/sh\necho part > {tmp_path}/out_000.mkv\nsleep 30\n")
+    ffmpeg.chmod(0o755)
+    pattern = str(tmp_path / 'out_%03d.mkv')
+    seen = []
+    
+    async def on_stall():
+        seen.append(os.path.exists(pattern % 0))
+    
+    async def run():
+        await VideoEncoder()._run_ffmpeg(
+            [str(ffmpeg)], duration=10, output_file=pattern,
+            stall_timeout=1, on_stall=on_stall
+        )
+    
+    with pytest.raises(EncodeStalled):
+        asyncio.run(run())
+    
+    assert seen == [True]
+    assert not os.path.exists(pattern % 0)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason="needs /proc")
+def test_cancel_kills_ffmpeg_with_its_children(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'ENCODE_CPU_AFFINITY', False)
+    monkeypatch.setattr(Config, 'ENCODE_NICE', 0)
+    
+    # Leaves a grandchild running, as filters and helper processes can
+    ffmpeg = tmp_path / 'ffmpeg'
+    ffmpeg.write_text(f"#!/bin/sh\nsleep 30 &\necho $! > {tmp_path}/child\nwait\n")
+    ffmpeg.chmod(0o755)
+    output = tmp_path / 'out.mkv'
+    output.write_text('partial')
+    token = CancellationToken()
+    
+    async def run():
+        ffmpeg_run = asyncio.create_task(VideoEncoder()._run_ffmpeg(
+            [str(ffmpeg)], cancel_token=token, output_file=str(output)
+        ))
+        while not (tmp_path / 'child').exists():
+            await asyncio.sleep(0.01)
+        token.cancel()
+        await ffmpeg_run
+    
+    started = time.monotonic()
+    with pytest.raises(TaskCancelled):
+        asyncio.run(run())
+    
+    assert time.monotonic() - started < 5
+    assert not output.exists()
+    child = (tmp_path / 'child').read_text().strip()
+    time.sleep(0.1)
+    assert not is_running(child)
+
+
+def test_cropdetect_keeps_the_last_detected_rectangle(monkeypatch):
+    encoder = VideoEncoder()
+    stderr = (
+        "[Parsed_cropdetect_0 @ 0x1] x1:0 x2:1919 y1:140 y2:939 w:1920 h:800 x:0 y:140 crop=1920:800:0:140\n"
+        "[Parsed_cropdetect_0 @ 0x1] x1:0 x2:1919 y1:132 y2:947 w:1920 h:816 x:0 y:132 crop=1920:816:0:132\n"
+    )
+    
+    async def run_ffmpeg(cmd, **kwargs):
+        return 0, stderr
+    monkeypatch.setattr(encoder, '_run_ffmpeg', run_ffmpeg)
+    
+    assert asyncio.run(encoder._cropdetect_at('in.mkv', 10)) == (1920, 816, 0, 132)
+
+
+def test_detected_crop_is_the_union_of_the_samples(monkeypatch):
+    monkeypatch.setattr(Config, 'CROP_SAMPLE_COUNT', 4)
+    monkeypatch.setattr(Config, 'CROP_MIN_BORDER', 0.02)
+    encoder = VideoEncoder()
+    rects = iter([
+        (1920, 800, 0, 140),
+        (1904, 816, 8, 132),
+        (-1920, -1080, 1920, 1080),  # fully black sample
+        None  # unreadable sample
+    ])
+    
+    async def media_info(path):
+        return {'streams': [{'codec_type': 'video', 'width': 1920, 'height': 1080}], 'format': {'duration': '100'}}
+    
+    async def cropdetect_at(path, position, cancel_token=None):
+        return next(rects)
+    monkeypatch.setattr(encoder, 'get_media_info', media_info)
+    monkeypatch.setattr(encoder, '_cropdetect_at', cropdetect_at)
+    
+    assert asyncio.run(encoder.crop_filter('in.mkv', 'auto')) == "crop=1920:816:0:132"
+
+
+def test_thin_borders_are_not_cropped(monkeypatch):
+    monkeypatch.setattr(Config, 'CROP_SAMPLE_COUNT', 1)
+    monkeypatch.setattr(Config, 'CROP_MIN_BORDER', 0.02)
+    encoder = VideoEncoder()
+    
+    async def media_info(path):
+        return {'streams': [{'codec_type': 'video', 'width': 1920, 'height': 1080}], 'format': {}}
+    
+    async def cropdetect_at(path, position, cancel_token=None):
+        return (1916, 1076, 2, 2)
+    monkeypatch.setattr(encoder, 'get_media_info', media_info)
+    monkeypatch.setattr(encoder, '_cropdetect_at', cropdetect_at)
+    
+    assert asyncio.run(encoder.detect_crop('in.mkv')) is None
+
+
+def test_aspect_ratio_crop_is_centered_with_even_dimensions():
+    assert asyncio.run(VideoEncoder().crop_filter('in.mkv', '1:1')) == (
+        "crop='trunc(min(iw,ih*1/1)/2)*2':'trunc(min(ih,iw*1/1)/2)*2'"
+    )
+    assert asyncio.run(VideoEncoder().crop_filter('in.mkv', 'off')) is None
@@ -0,0 +1,25 @@
+import sqlite3
+from migrations import HOT_QUERIES, MIGRATIONS, check_query_plans, migrate
+
+
+def migrated(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'bot.db')
+    migrate(conn)
+    return conn
+
+
+def test_hot_queries_use_indexes_on_a_migrated_database(tmp_path):
+    assert check_query_plans(migrated(tmp_path)) == []
+
+
+def test_query_plan_check_reports_a_missing_index(tmp_path):
+    conn = migrated(tmp_path)
+    conn.execute('DROP INDEX idx_premium_expiry')
+    
+    assert 'expire_premium_users' in {name for name, _ in check_query_plans(conn)}
+
+
+def test_migrate_is_idempotent(tmp_path):
+    conn = migrated(tmp_path)
+    assert migrate(conn) == MIGRATIONS[-1][0]
+    assert len(HOT_QUERIES) and check_query_plans(conn) == []
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from pipeline import StagePool
+
+
+def test_pool_bounds_concurrency_and_serves_waiters_fifo():
+    pool = StagePool('test', 2)
+    running, peak, order = 0, 0, []
+    
+    async def job(name):
+        nonlocal running, peak
+        async with pool.slot():
+            order.append(name)
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+    
+    async def run():
+        await asyncio.gather(*(job(i) for i in range(6)))
+    
+    asyncio.run(run())
+    assert peak == 2
+    assert order == list(range(6))
+    assert pool.snapshot() == {'size': 2, 'busy': 0, 'queued': 0}
+
+
+def test_cancelled_waiter_does_not_leak_the_slot():
+    pool = StagePool('test', 1)
+    
+    async def run():
+        release = asyncio.Event()
+        
+        async def holder():
+            async with pool.slot():
+                await release.wait()
+        
+        async def waiter():
+            async with pool.slot():
+                pass
+        
+        held = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert pool.snapshot() == {'size': 1, 'busy': 1, 'queued': 1}
+        
+        # Cancelled right after the slot was handed over
+        release.set()
+        await asyncio.sleep(0)
+        assert held.done() and not waiting.done()
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+    
+    asyncio.run(run())
+    assert pool.snapshot() == {'size': 1, 'busy': 0, 'queued': 0}
+
+
+def test_growing_the_pool_starts_waiters():
+    pool = StagePool('test', 1)
+    
+    async def run():
+        release = asyncio.Event()
+        started = []
+        
+        async def job(name):
+            async with pool.slot():
+                started.append(name)
+                await release.wait()
+        
+        jobs = [asyncio.create_task(job(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert started == [0]
+        
+        pool.resize(3)
+        await asyncio.sleep(0)
+        assert started == [0, 1, 2]
+        
+        release.set()
+        await asyncio.gather(*jobs)
+    
+    asyncio.run(run())
+    assert pool.snapshot() == {'size': 3, 'busy': 0, 'queued': 0}
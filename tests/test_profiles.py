@@ -0,0 +1,67 @@
+import pytest
+from config import Config
+from profiles import peak_bitrate, rate_control_args, tile_columns, video_codec_args
+
+
+def test_vp9_maps_the_preset_to_deadline_and_cpu_used():
+    args = video_codec_args('libvpx-vp9', 'veryfast', 1920, threads=4)
+    
+    assert args[:6] == ['-c:v', 'libvpx-vp9', '-deadline', 'good', '-cpu-used', '5']
+    assert args[args.index('-tile-columns') + 1] == '2'
+    assert args[args.index('-threads') + 1] == '4'
+
+
+def test_fast_libaom_presets_switch_to_realtime_usage():
+    assert video_codec_args('libaom-av1', 'slow', 1280)[:4] == ['-c:v', 'libaom-av1', '-cpu-used', '3']
+    assert video_codec_args('libaom-av1', 'ultrafast', 640)[:6] == [
+        '-c:v', 'libaom-av1', '-usage', 'realtime', '-cpu-used', '8'
+    ]
+
+
+def test_svtav1_gets_its_preset_and_core_budget():
+    assert video_codec_args('libsvtav1', 'medium', 1920, threads=6) == [
+        '-c:v', 'libsvtav1', '-preset', '7', '-svtav1-params', 'lp=6'
+    ]
+
+
+def test_x265_sizes_its_pool_instead_of_threads():
+    assert video_codec_args('libx265', 'fast', 1920, threads=8) == [
+        '-c:v', 'libx265', '-preset', 'fast', '-x265-params', 'pools=8:frame-threads=4'
+    ]
+    assert video_codec_args('libx264', 'fast', 1920) == ['-c:v', 'libx264', '-preset', 'fast']
+
+
+def test_unknown_presets_fall_back_to_medium():
+    assert video_codec_args('libvpx-vp9', 'bogus', 640)[5] == '2'
+
+
+def test_tile_columns_follow_the_256px_minimum():
+    assert [tile_columns(w) for w in (200, 640, 1280, 1920, 3840)] == [0, 1, 2, 2, 3]
+
+
+@pytest.fixture
+def vbv(monkeypatch):
+    monkeypatch.setattr(Config, 'VBV_BUFSIZE_FACTOR', 2)
+
+
+@pytest.mark.parametrize('codec, mode, expected', [
+    ('libx264', 'crf', ['-crf', '23']),
+    ('libx264', 'capped_crf', ['-crf', '23', '-maxrate', '2000k', '-bufsize', '4000k']),
+    ('libx265', 'abr', ['-b:v', '2000k']),
+    ('libvpx-vp9', 'crf', ['-crf', '23', '-b:v', '0']),
+    ('libaom-av1', 'capped_crf', ['-crf', '23', '-b:v', '2000k', '-maxrate', '2000k', '-bufsize', '4000k']),
+    ('mpeg4', 'crf', ['-q:v', '14'])
+])
+def test_rate_control_args(vbv, codec, mode, expected):
+    assert rate_control_args(codec, mode, 23, '2000k') == expected
+
+
+def test_mpeg4_quantizer_stays_in_range(vbv):
+    assert rate_control_args('mpeg4', 'crf', 0, '1M') == ['-q:v', '2']
+    assert rate_control_args('mpeg4', 'crf', 51, '1M') == ['-q:v', '31']
+
+
+def test_peak_bitrate_is_unbounded_only_for_pure_crf():
+    assert peak_bitrate('crf', '2000k', '128k') is None
+    assert peak_bitrate('capped_crf', '2000k', '128k') == 2000000 * 1.05 + 128000
+    assert peak_bitrate('abr', '2M', '128k') == 2000000 * 1.3 + 128000
@@ -0,0 +1,70 @@
+import asyncio
+from progress import ProgressChannel
+
+
+def test_slow_sends_only_see_the_latest_value():
+    sent = []
+    in_flight = 0
+    
+    async def send(text):
+        nonlocal in_flight
+        in_flight += 1
+        assert in_flight == 1
+        await asyncio.sleep(0.05)
+        sent.append(text)
+        in_flight -= 1
+    
+    async def run():
+        channel = ProgressChannel(send, interval=0).start()
+        channel.set_stage(str, 0)
+        await asyncio.sleep(0.01)
+        
+        # A burst while the first send is in flight collapses to its last value
+        for value in range(1, 101):
+            channel.publish(value)
+        await asyncio.sleep(0.2)
+        await channel.close()
+    
+    asyncio.run(run())
+    assert sent == ['0', '100']
+
+
+def test_unchanged_text_is_not_sent_again():
+    sent = []
+    
+    async def send(text):
+        sent.append(text)
+    
+    async def run():
+        channel = ProgressChannel(send, interval=0).start()
+        channel.set_stage(lambda data: f"{data // 10}0%", 1)
+        for value in (3, 5, 12):
+            await asyncio.sleep(0.01)
+            channel.publish(value)
+        await asyncio.sleep(0.01)
+        await channel.close()
+    
+    asyncio.run(run())
+    assert sent == ['00%', '10%']
+
+
+def test_render_errors_do_not_stop_the_consumer():
+    sent = []
+    
+    async def send(text):
+        sent.append(text)
+    
+    async def run():
+        channel = ProgressChannel(send, interval=0).start()
+        channel.set_stage(lambda data: 1 / data and f"{data}", 0)
+        await asyncio.sleep(0.01)
+        channel.publish(2)
+        await asyncio.sleep(0.01)
+        await channel.close()
+        
+        # Closed channels drop later values
+        channel.publish(3)
+        await asyncio.sleep(0.01)
+    
+    asyncio.run(run())
+    assert sent == ['2']
@@ -0,0 +1,43 @@
+import asyncio
+from scheduler import FairScheduler
+
+
+async def _job(scheduler, job_id, user_id, cost, order):
+    async with scheduler.slot(job_id, user_id, cost):
+        order.append(user_id)
+        await asyncio.sleep(0)
+
+
+async def _one_at_a_time(scheduler, user_id, cost, jobs, order):
+    """Submit jobs one at a time, each after the previous one finished"""
+    for index in range(jobs):
+        await _job(scheduler, f"{user_id}{index}", user_id, cost, order)
+
+
+def test_one_job_at_a_time_still_pays_for_cost():
+    async def run():
+        scheduler = FairScheduler(1)
+        order = []
+        await asyncio.gather(
+            _one_at_a_time(scheduler, 'A', 1000, 2, order),
+            *(_job(scheduler, f"b{index}", 'b', 10, order) for index in range(30))
+        )
+        return order
+    
+    order = asyncio.run(run())
+    
+    # A's second job waits until the light user's queue has drained
+    assert order == ['A'] + ['b'] * 30 + ['A']
+
+
+def test_idle_users_are_forgotten_once_caught_up():
+    async def run():
+        scheduler = FairScheduler(1)
+        async with scheduler.slot('a', 'A', 100):
+            pass
+        async with scheduler.slot('b', 'B', 100):
+            pass
+        return scheduler
+    
+    scheduler = asyncio.run(run())
+    assert 'A' not in scheduler._last_finish
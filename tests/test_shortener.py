@@ -0,0 +1,74 @@
+import asyncio
+import time
+from config import Config
+from shortener import CircuitBreaker, ShortenerClient
+
+
+class FakeResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        return False
+    
+    async def json(self, content_type=None):
+        return self.data
+
+
+class FakeSession:
+    """Answers every request with the next queued (status, data)"""
+    
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+    
+    def get(self, url, params=None):
+        self.requests.append(params['url'])
+        return FakeResponse(*self.responses.pop(0))
+
+
+def test_breaker_opens_at_the_threshold_and_probes_after_the_cooldown():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    breaker.failure()
+    assert breaker.allow()
+    
+    breaker.failure()
+    assert not breaker.allow()
+    
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # only one trial call per cooldown
+    
+    breaker.success()
+    assert breaker.allow() and breaker.failures == 0
+
+
+def test_failing_provider_is_short_circuited(monkeypatch):
+    monkeypatch.setattr(Config, 'SHORTENER_FAILURE_THRESHOLD', 2)
+    monkeypatch.setattr(Config, 'SHORTENER_COOLDOWN', 60)
+    client = ShortenerClient()
+    session = FakeSession([(500, {}), (200, {'status': 'error', 'message': 'bad key'})])
+    monkeypatch.setattr(client, '_get_session', lambda: session)
+    
+    async def run():
+        return [await client.shorten(f"https://t.me/{i}", 'https://short.example', 'key') for i in range(4)]
+    
+    # Every failure falls back to the long link; calls stop once tripped
+    assert asyncio.run(run()) == [f"https://t.me/{i}" for i in range(4)]
+    assert session.requests == ["https://t.me/0", "https://t.me/1"]
+
+
+def test_short_links_are_cached(monkeypatch):
+    client = ShortenerClient()
+    session = FakeSession([(200, {'shortenedUrl': 'https://short.example/a'})])
+    monkeypatch.setattr(client, '_get_session', lambda: session)
+    
+    async def run():
+        return [await client.shorten("https://t.me/x", 'https://short.example', 'key') for _ in range(3)]
+    
+    assert asyncio.run(run()) == ['https://short.example/a'] * 3
+    assert len(session.requests) == 1
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+import pytest
+from database import Database, AsyncDatabase
+
+
+@pytest.fixture
+def db(tmp_path):
+    return Database(f"sqlite:///{tmp_path / 'bot.db'}")
+
+
+def _premium_rows(db):
+    conn = db.get_connection()
+    rows = conn.execute('SELECT COUNT(*) AS count FROM premium_users').fetchone()['count']
+    conn.close()
+    return rows
+
+
+def test_stats_through_the_database_thread(db):
+    adb = AsyncDatabase(db)
+    db.add_user(1, 'One')
+    db.add_user(2, 'Two')
+    
+    async def work():
+        return await asyncio.gather(adb.get_stats(7), adb.get_total_users())
+    
+    start = time.monotonic()
+    stats, total = asyncio.run(work())
+    assert time.monotonic() - start < 1
+    assert stats['counters']['users'] == 2
+    assert total == 2
+
+
+def test_premium_count_is_a_pure_read(db):
+    db.add_user(1, 'One')
+    db.add_user(2, 'Two')
+    db.flush_user_writes()
+    db.add_premium_user(1, 0)
+    db.add_premium_user(2, 0, datetime.utcnow() - timedelta(seconds=1))
+    
+    assert db.get_premium_count() == 1
+    assert db.get_stats()['counters']['premium_users'] == 1
+    assert _premium_rows(db) == 2
+    
+    # The expired row goes with the next periodic user flush
+    db.touch_user(1)
+    db.flush_user_writes()
+    assert _premium_rows(db) == 1
+    assert db.get_premium_count() == 1
+
+
+def test_concurrent_premium_adds_count_once(db):
+    adb = AsyncDatabase(db)
+    other = AsyncDatabase(Database(db.database_url))
+    
+    async def run():
+        await asyncio.gather(*(
+            database.add_premium_user(1, 0)
+            for _ in range(5) for database in (adb, other)
+        ))
+    
+    asyncio.run(run())
+    assert db.get_premium_count() == 1
+    
+    db.add_premium_user(1, 0, datetime.utcnow() + timedelta(days=1))
+    assert db.get_premium_count() == 1
+    assert db.is_premium_user(1)
@@ -0,0 +1,170 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+import pytest
+import storage
+from config import Config
+from database import Database, AsyncDatabase
+import fake_asyncpg
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def db(request, tmp_path, monkeypatch):
+    """A Database on each backend; PostgreSQL runs on the in-process stand-in"""
+    if request.param == 'sqlite':
+        return Database(f"sqlite:///{tmp_path / 'bot.db'}")
+    monkeypatch.setattr(storage, 'asyncpg', fake_asyncpg)
+    return Database(f"postgresql://localhost{tmp_path / 'pg.db'}")
+
+
+def test_backend_matches_url(db):
+    expected = storage.SQLiteBackend if db.database_url.startswith('sqlite') else storage.PostgresBackend
+    assert isinstance(db.pool, expected)
+
+
+def test_postgres_url_without_asyncpg_is_an_error(monkeypatch):
+    monkeypatch.setattr(storage, 'asyncpg', None)
+    with pytest.raises(RuntimeError):
+        storage.open_backend('postgresql://localhost/bot', 1)
+
+
+def test_bot_settings(db):
+    assert db.get_codec()
+    db.set_bot_setting('codec', 'libx264')
+    assert db.get_codec() == 'libx264'
+    db.delete_bot_setting('codec')
+    assert db.get_bot_setting('codec') is None
+
+
+def test_users_and_settings(db):
+    db.add_user(1, 'One', 'one')
+    db.add_user(2, 'Two')
+    db.touch_user(1)
+    
+    assert db.get_user(1)['username'] == 'one'
+    assert db.get_total_users() == 2
+    
+    db.set_user_watermark(1, 'mark')
+    assert db.get_user_watermark(1) == 'mark'
+
+
+def test_premium_users(db):
+    db.add_user(1, 'One')
+    db.add_user(2, 'Two')
+    db.flush_user_writes()
+    db.add_premium_user(1, 0)
+    db.add_premium_user(2, 0, datetime.utcnow() + timedelta(days=1))
+    
+    assert db.is_premium_user(1)
+    assert db.is_premium_user(2)
+    assert db.get_premium_count() == 2
+    assert {user['user_id'] for user in db.get_all_premium_users()} == {1, 2}
+    
+    db.remove_premium_user(1)
+    assert not db.is_premium_user(1)
+    assert db.get_premium_count() == 1
+
+
+def test_force_subscribe_channels(db):
+    db.add_force_subscribe_channel(-100, 'https://t.me/c', 'Channel')
+    assert [c['channel_id'] for c in db.get_force_subscribe_channels()] == [-100]
+    db.remove_force_subscribe_channel(-100)
+    assert db.get_force_subscribe_channels() == []
+
+
+def test_job_lifecycle(db):
+    db.create_job('job1', 1, 10, 20, 'file', 'unique', 'a.mkv', 1000, 60)
+    assert db.get_pending_job(1)['job_id'] == 'job1'
+    
+    assert db.queue_job('job1', 'encode_720p', 30) == 1
+    assert db.queue_job('job1', 'encode_720p', 30) == 0
+    db.update_job_state('job1', 'encoding')
+    db.update_job_state('job1', 'done')
+    
+    assert db.get_job('job1')['state'] == 'done'
+    assert db.cancel_pending_job('job1') == 0
+    assert db.get_stats()['counters']['jobs_720p'] == 1
+
+
+def test_crf_cache(db):
+    profile = ('libx264', 'medium', 'crf', 28)
+    assert db.get_cached_crf('unique', '720p', *profile, 'ssim', 0.97) is None
+    db.cache_crf('unique', '720p', *profile, 'ssim', 0.97, 26, 0.975)
+    assert db.get_cached_crf('unique', '720p', *profile, 'ssim', 0.97) == 26
+    
+    # A search under another preset, mode or base CRF is not reused
+    assert db.get_cached_crf('unique', '720p', 'libx264', 'slow', 'crf', 28, 'ssim', 0.97) is None
+    assert db.get_cached_crf('unique', '720p', 'libx264', 'medium', 'capped_crf', 28, 'ssim', 0.97) is None
+    assert db.get_cached_crf('unique', '720p', 'libx264', 'medium', 'crf', 23, 'ssim', 0.97) is None
+
+
+def test_failed_call_in_a_batch_rolls_back_alone(db):
+    adb = AsyncDatabase(db)
+    
+    async def run():
+        return await asyncio.gather(
+            adb.set_bot_setting('kept', '1'),
+            adb.create_job('job1', 1, 1, 1, 'file'),
+            adb.create_job('job1', 1, 1, 1, 'file'),
+            return_exceptions=True
+        )
+    
+    results = asyncio.run(run())
+    assert isinstance(results[2], Exception)
+    assert db.get_bot_setting('kept') == '1'
+    assert db.get_job('job1')['state'] == 'pending'
+
+
+def test_settings_written_by_another_instance_show_up_after_the_ttl(db, monkeypatch):
+    monkeypatch.setattr(db.settings, 'ttl', 0.1)
+    db.set_bot_setting('codec', 'libx264')
+    assert db.get_codec() == 'libx264'
+    
+    # Another bot instance sharing the store writes behind this one's cache
+    conn = db.pool.acquire()
+    conn.execute("UPDATE bot_settings SET value = 'libx265' WHERE key = 'codec'")
+    conn.commit()
+    conn.close()
+    
+    assert db.get_codec() == 'libx264'
+    time.sleep(0.15)
+    assert db.get_codec() == 'libx265'
+
+
+def test_only_jobs_with_an_expired_lease_are_requeued(db, monkeypatch):
+    db.create_job('live', 1, 10, 20, 'file')
+    db.create_job('dead', 1, 10, 21, 'file')
+    
+    # Both started by another instance; only "dead" stopped renewing
+    monkeypatch.setattr(Config, 'INSTANCE_ID', 'other')
+    db.queue_job('live', 'encode_720p')
+    db.update_job_state('live', 'encoding')
+    monkeypatch.setattr(Config, 'JOB_LEASE_SECONDS', -1)
+    db.queue_job('dead', 'encode_720p')
+    db.update_job_state('dead', 'encoding')
+    
+    monkeypatch.setattr(Config, 'INSTANCE_ID', 'this')
+    monkeypatch.setattr(Config, 'JOB_LEASE_SECONDS', 120)
+    assert [job['job_id'] for job in db.requeue_interrupted_jobs(3)] == ['dead']
+    assert db.get_job('dead')['owner'] == 'this'
+    assert db.get_job('live')['state'] == 'encoding'
+    
+    # Claimed under a fresh lease, so it is not claimed twice
+    assert db.requeue_interrupted_jobs(3) == []
+
+
+def test_renewed_leases_keep_jobs_owned(db, monkeypatch):
+    db.create_job('job1', 1, 10, 20, 'file')
+    monkeypatch.setattr(Config, 'JOB_LEASE_SECONDS', -1)
+    db.queue_job('job1', 'encode_720p')
+    
+    monkeypatch.setattr(Config, 'JOB_LEASE_SECONDS', 120)
+    db.renew_job_leases()
+    assert db.requeue_interrupted_jobs(3) == []
+
+
+def test_cancel_pending_job(db):
+    db.create_job('job1', 1, 10, 20, 'file')
+    assert db.cancel_pending_job('job1', 'Task limit reached') == 1
+    assert db.get_job('job1')['state'] == 'cancelled'
+    assert db.queue_job('job1', 'encode_720p') == 0
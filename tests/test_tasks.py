@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+from database import Database, AsyncDatabase
+from tasks import CancellationToken, Task, TaskCancelled, TaskExists, TaskLimitReached, TaskRegistry
+
+
+def test_register_rejects_a_registered_task_id():
+    registry = TaskRegistry()
+    first = registry.register(Task('job1', 1, 'a.mkv', 'encode_720p'))
+    
+    with pytest.raises(TaskExists):
+        registry.register(Task('job1', 1, 'a.mkv', 'encode_720p'))
+    assert registry.get('job1') is first
+    assert registry.count(1) == 1
+
+
+def test_register_enforces_the_limit():
+    registry = TaskRegistry()
+    registry.register(Task('job1', 1, 'a.mkv', 'encode_720p'), limit=1)
+    
+    with pytest.raises(TaskLimitReached):
+        registry.register(Task('job2', 1, 'b.mkv', 'encode_720p'), limit=1)
+
+
+def test_two_taps_queue_a_job_once(tmp_path):
+    db = Database(f"sqlite:///{tmp_path / 'bot.db'}")
+    adb = AsyncDatabase(db)
+    db.create_job('job1', 1, 1, 1, 'file')
+    
+    async def tap():
+        return await adb.queue_job('job1', 'encode_720p', 5)
+    
+    async def run():
+        return await asyncio.gather(tap(), tap())
+    
+    assert sorted(asyncio.run(run())) == [0, 1]
+    assert db.get_job('job1')['state'] == 'queued'
+
+
+def test_cancel_runs_callbacks_once_and_late_ones_immediately():
+    token = CancellationToken()
+    calls = []
+    token.on_cancel(lambda: calls.append('kill'))
+    unregister = token.on_cancel(lambda: calls.append('dropped'))
+    unregister()
+    
+    token.cancel()
+    token.cancel()
+    token.on_cancel(lambda: calls.append('late'))
+    
+    assert calls == ['kill', 'late']
+    with pytest.raises(TaskCancelled):
+        token.raise_if_cancelled()
+
+
+def test_bound_task_is_cancelled_with_the_token():
+    token = CancellationToken()
+    
+    async def job():
+        token.bind_task()
+        await asyncio.sleep(30)
+    
+    async def run():
+        task = asyncio.create_task(job())
+        await asyncio.sleep(0)
+        token.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    
+    asyncio.run(run())
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from pyrogram.errors import UserNotParticipant
+from utils import MembershipCache
+
+
+class FakeClient:
+    """get_chat_member answering from a {user_id: status or exception} map"""
+    
+    def __init__(self, statuses, delay=0):
+        self.statuses = statuses
+        self.delay = delay
+        self.calls = 0
+    
+    async def get_chat_member(self, channel_id, user_id):
+        self.calls += 1
+        status = self.statuses[user_id]
+        await asyncio.sleep(self.delay)
+        if isinstance(status, Exception):
+            raise status
+        return SimpleNamespace(status=status)
+
+
+def test_members_are_cached_longer_than_non_members():
+    cache = MembershipCache(ttl=10, negative_ttl=0.05, size=100)
+    client = FakeClient({1: 'member', 2: 'left'})
+    
+    async def run():
+        first = [await cache.check(client, user, -100) for user in (1, 2)]
+        await asyncio.sleep(0.06)
+        client.statuses[2] = 'member'
+        return first, [await cache.check(client, user, -100) for user in (1, 2)]
+    
+    assert asyncio.run(run()) == ([True, False], [True, True])
+    assert client.calls == 3
+
+
+def test_failed_checks_allow_access_but_are_not_trusted_for_long():
+    cache = MembershipCache(ttl=10, negative_ttl=0.05, size=100)
+    client = FakeClient({1: UserNotParticipant(), 2: ConnectionError()})
+    
+    async def run():
+        return [await cache.check(client, user, -100) for user in (1, 2)]
+    
+    assert asyncio.run(run()) == [False, True]
+    assert all(expiry < time.monotonic() + 1 for expiry, _ in (
+        cache._users[1][-100], cache._users[2][-100]
+    ))
+
+
+def test_concurrent_checks_share_one_call():
+    cache = MembershipCache(ttl=10, negative_ttl=1, size=100)
+    client = FakeClient({1: 'member'}, delay=0.01)
+    
+    async def run():
+        return await asyncio.gather(*(cache.check(client, 1, -100) for _ in range(10)))
+    
+    assert asyncio.run(run()) == [True] * 10
+    assert client.calls == 1
+
+
+def test_invalidate_drops_answers_still_in_flight():
+    cache = MembershipCache(ttl=10, negative_ttl=10, size=100)
+    client = FakeClient({1: 'left'}, delay=0.01)
+    
+    async def run():
+        pending = asyncio.create_task(cache.check(client, 1, -100))
+        await asyncio.sleep(0)
+        cache.invalidate(1)
+        assert await pending is False
+        
+        # The user joined meanwhile; the stale answer was not stored
+        client.statuses[1] = 'member'
+        return await cache.check(client, 1, -100)
+    
+    assert asyncio.run(run()) is True
+    assert client.calls == 2
+
+
+def test_least_recently_checked_users_are_evicted():
+    cache = MembershipCache(ttl=10, negative_ttl=10, size=2)
+    client = FakeClient({1: 'member', 2: 'member', 3: 'member'})
+    
+    async def run():
+        for user in (1, 2, 3):
+            await cache.check(client, user, -100)
+    
+    asyncio.run(run())
+    assert list(cache._users) == [2, 3]
+
+
+def test_checks_after_invalidate_do_not_join_a_stale_call():
+    cache = MembershipCache(ttl=10, negative_ttl=10, size=100)
+    client = FakeClient({1: 'left'}, delay=0.02)
+    
+    async def run():
+        stale = asyncio.create_task(cache.check(client, 1, -100))
+        await asyncio.sleep(0.01)
+        client.statuses[1] = 'member'
+        cache.invalidate(1)
+        fresh = await cache.check(client, 1, -100)
+        return await stale, fresh, await cache.check(client, 1, -100)
+    
+    assert asyncio.run(run()) == (False, True, True)
+    assert client.calls == 2
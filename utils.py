@@ -1,8 +1,15 @@
-import requests
+import asyncio
+import time
+from collections import OrderedDict
 from pyrogram.errors import UserNotParticipant
-from database import Database
+from config import Config
+from database import Database, get_async_database
+from metrics import metrics
+from shortener import shortener
 
 db = Database()
+# Handlers' lookups go through the database threads, never the event loop
+adb = get_async_database(db)
 
 
 def format_progress_bar(percentage):
@@ -37,58 +44,112 @@ def format_size(bytes_size):
     return f"{bytes_size:.2f} PB"
 
 
-async def check_user_subscription(client, user_id):
-    """Check if user is subscribed to required channels"""
-    fsub_mode = db.get_fsub_mode()
+class MembershipCache:
+    """
+    Force-subscribe membership results per (user, channel)
     
-    if fsub_mode == 'off':
-        return True
+    Members are trusted for FSUB_CACHE_TTL seconds; non-members and failed
+    checks only for FSUB_NEGATIVE_TTL, so joining takes effect quickly.
+    Concurrent checks of the same pair share one API call.
+    """
     
-    channels = db.get_force_subscribe_channels()
+    def __init__(self, ttl, negative_ttl, size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self._users = OrderedDict()
+        self._inflight = {}
+        self._generation = 0
     
-    if not channels:
-        return True
+    async def check(self, client, user_id, channel_id):
+        """Check if user may pass channel's force subscribe"""
+        entry = self._users.get(user_id, {}).get(channel_id)
+        if entry and entry[0] > time.monotonic():
+            metrics.inc('fsub_cache_hits')
+            return entry[1]
+        
+        key = (user_id, channel_id)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(client, user_id, channel_id, self._generation))
+            self._inflight[key] = task
+            
+            def forget(done):
+                # A check after invalidate() may own the entry by now
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+            task.add_done_callback(forget)
+        return await asyncio.shield(task)
     
-    for channel in channels:
+    async def _fetch(self, client, user_id, channel_id, generation):
+        """Ask Telegram and cache the answer unless invalidated since `generation`"""
+        metrics.inc('fsub_api_checks')
+        ttl = self.negative_ttl
+        
         try:
-            member = await client.get_chat_member(channel['channel_id'], user_id)
-            if member.status in ['left', 'kicked']:
-                return False
+            member = await client.get_chat_member(channel_id, user_id)
+            status = getattr(member.status, 'value', member.status)
+            allowed = status not in ('left', 'kicked', 'banned')
+            if allowed:
+                ttl = self.ttl
         except UserNotParticipant:
-            return False
+            allowed = False
         except Exception:
             # If we can't check, allow access
-            pass
+            allowed = True
+        
+        # Skip storing if the user was invalidated while we asked
+        if generation == self._generation:
+            self._users.setdefault(user_id, {})[channel_id] = (time.monotonic() + ttl, allowed)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+        return allowed
     
-    return True
+    def invalidate(self, user_id):
+        """Forget a user's results, e.g. after they pressed Joined"""
+        self._generation += 1
+        self._users.pop(user_id, None)
+        
+        # Checks from now on must not join an answer asked for before
+        for key in [key for key in self._inflight if key[0] == user_id]:
+            del self._inflight[key]
 
 
-def generate_shortlink(url, shortener_num=1):
-    """Generate short link using shortener API"""
+# Shared instance
+membership = MembershipCache(Config.FSUB_CACHE_TTL, Config.FSUB_NEGATIVE_TTL, Config.FSUB_CACHE_SIZE)
+
+
+async def check_user_subscription(client, user_id):
+    """Check if user is subscribed to required channels"""
+    # Mode and channels come from the settings caches, membership from ours
+    if await adb.get_fsub_mode() == 'off':
+        return True
+    
+    channels = await adb.get_force_subscribe_channels()
+    
+    if not channels:
+        return True
+    
+    results = await asyncio.gather(*(
+        membership.check(client, user_id, channel['channel_id']) for channel in channels
+    ))
+    return all(results)
+
+
+async def generate_shortlink(url, shortener_num=1):
+    """Generate short link using shortener API (the original URL if it fails)"""
     if shortener_num == 1:
-        api_key = db.get_bot_setting('shortener_1_api')
-        api_url = db.get_bot_setting('shortener_1_url')
+        api_key = await adb.get_bot_setting('shortener_1_api')
+        api_url = await adb.get_bot_setting('shortener_1_url')
     else:
-        api_key = db.get_bot_setting('shortener_2_api')
-        api_url = db.get_bot_setting('shortener_2_url')
+        api_key = await adb.get_bot_setting('shortener_2_api')
+        api_url = await adb.get_bot_setting('shortener_2_url')
     
     if not api_key or not api_url:
         return url
     
-    try:
-        response = requests.get(
-            f"{api_url}/api",
-            params={'api': api_key, 'url': url},
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('shortenedUrl', url)
-    except Exception:
-        pass
-    
-    return url
+    return await shortener.shorten(url, api_url, api_key)
 
 
 def parse_time_format(time_str):